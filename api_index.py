@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+"""
+A structured index of a SOFA-derived library (multi-file or flattened),
+saved as ``api_index.json`` in the source directory.  For each function it
+records the prototype, the file defining it, the byte offsets of its doc
+comment and body, the macros it uses and the other functions it calls, and
+for each macro its definition.  The index is only rebuilt for files that
+changed since it was saved.  Do::
+
+  python api_index.py --help
+
+To see the options.
+"""
+
+import os
+import re
+import json
+import hashlib
+
+import source_parser
+
+INDEX_VERSION = 1
+INDEX_FILENAME = 'api_index.json'
+
+_DEFINE_RE = re.compile(r'^[ \t]*#[ \t]*define[ \t]+(\w+)([^\n]*)$',
+                        re.MULTILINE)
+_IDENTIFIER_RE = re.compile(r'\b[A-Za-z_]\w*')
+_UPPER_NAME_RE = re.compile(r'[A-Z_][A-Z0-9_]+$')
+_BRACE_RE = re.compile(r'[{}]')
+
+
+def _function_def_re(prefix):
+    # a function definition's signature, then (in code with the comments
+    # blanked out) nothing but whitespace up to the body's opening brace
+    return re.compile(r'^[A-Za-z_][^;{}#\n]*?\b(' + re.escape(prefix) +
+                      r'[A-Z0-9]\w*)\s*\([^;{}]*?\)\s*\{', re.MULTILINE)
+
+
+def _matching_brace(code, start):
+    depth = 0
+    for match in _BRACE_RE.finditer(code, start):
+        if match.group(0) == '{':
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return match.end()
+    return len(code)
+
+
+def parse_file(data, prefix='era'):
+    """
+    Parses the bytes `data` of a C source or header file.  Returns a dict
+    with the ``functions`` defined in it (each with its ``name``,
+    ``signature``, ``body`` and ``comment`` byte offsets as ``[start,
+    end]``, the prefixed ``names`` and upper-case ``identifiers`` its code
+    uses), the ``prototypes`` it declares and the ``macros`` it defines.
+    """
+    # latin-1 maps every byte to one character, so string offsets are byte
+    # offsets
+    text = data.decode('latin-1')
+    code = source_parser.blank_comments_and_strings(text)
+
+    namere = re.compile(re.escape(prefix) + r'[A-Z0-9]')
+    functions = []
+    for match in _function_def_re(prefix).finditer(code):
+        bodystart = match.end() - 1
+        bodyend = _matching_brace(code, bodystart)
+        sigend = code.rindex(')', match.start(), bodystart) + 1
+        commentstart = text.find('/*', sigend, bodystart)
+        comment = None
+        if commentstart >= 0:
+            comment = [commentstart, text.index('*/', commentstart) + 2]
+        # the names used in the body are found in one pass over it
+        identifiers = set(_IDENTIFIER_RE.findall(code, bodystart, bodyend))
+        functions.append({'name': match.group(1),
+                          'signature': ' '.join(text[match.start():sigend]
+                                                .split()),
+                          'body': [bodystart, bodyend],
+                          'comment': comment,
+                          'names': sorted([name for name in identifiers
+                                           if namere.match(name)]),
+                          'identifiers': sorted([name for name in identifiers
+                                                 if _UPPER_NAME_RE.match(name)])})
+
+    prototypes = {}
+    # only top-level declarations are prototypes
+    if not functions:
+        for name, lines in source_parser.iter_prototypes(
+                code.splitlines(True), prefix):
+            if name is not None:
+                prototypes[name] = ' '.join(''.join(lines).split())
+
+    macros = {}
+    for match in _DEFINE_RE.finditer(code):
+        value = match.group(2).strip()
+        # skip include guards
+        if value:
+            macros[match.group(1)] = ' '.join(value.split())
+
+    return {'functions': functions, 'prototypes': prototypes,
+            'macros': macros}
+
+
+def _source_files(srcdir):
+    return sorted([fn for fn in os.listdir(srcdir)
+                   if fn.endswith('.c') or fn.endswith('.h')])
+
+
+def build_index(srcdir, prefix='era', old=None, verbose=False):
+    """
+    Builds the index of the library in `srcdir`.  Files whose size and
+    modification time (or else SHA-256) match those in the `old` index are
+    not parsed again.
+    """
+    oldfiles = {}
+    if (old is not None and old.get('version') == INDEX_VERSION and
+            old.get('prefix') == prefix):
+        oldfiles = old['files']
+
+    files = {}
+    nparsed = 0
+    for fn in _source_files(srcdir):
+        fullfn = os.path.join(srcdir, fn)
+        st = os.stat(fullfn)
+        oldentry = oldfiles.get(fn)
+        if (oldentry is not None and oldentry['size'] == st.st_size and
+                oldentry['mtime'] == st.st_mtime):
+            files[fn] = oldentry
+            continue
+
+        with open(fullfn, 'rb') as f:
+            data = f.read()
+        sha256 = hashlib.sha256(data).hexdigest()
+        if oldentry is not None and oldentry['sha256'] == sha256:
+            entry = dict(oldentry)
+        else:
+            entry = parse_file(data, prefix)
+            entry['sha256'] = sha256
+            nparsed += 1
+        entry['size'] = st.st_size
+        entry['mtime'] = st.st_mtime
+        files[fn] = entry
+    if verbose:
+        print('Parsed {0} of {1} files for the index'.format(nparsed,
+                                                             len(files)))
+
+    macros = {}
+    prototypes = {}
+    for fn, entry in files.items():
+        for name, value in entry['macros'].items():
+            macros.setdefault(name, {'file': fn, 'value': value})
+        prototypes.update(entry['prototypes'])
+
+    definitions = {}
+    for fn, entry in sorted(files.items()):
+        for func in entry['functions']:
+            definitions.setdefault(func['name'], (fn, func))
+
+    functions = {}
+    for name, (fn, func) in definitions.items():
+        functions[name] = {
+            'file': fn,
+            'prototype': prototypes.get(name, func['signature'] + ';'),
+            'body': func['body'],
+            'comment': func['comment'],
+            'macros': [m for m in func['identifiers'] if m in macros],
+            'calls': [n for n in func['names']
+                      if n in definitions and n != name]}
+
+    testfns = [fn for fn in files
+               if re.match(r't_.*?_c\.c$|test_.*\.c$', fn)]
+    return {'version': INDEX_VERSION, 'prefix': prefix,
+            'test_file': testfns[0] if testfns else None,
+            'functions': functions, 'macros': macros, 'files': files}
+
+
+def load_index(srcdir, prefix='era', force=False, verbose=False):
+    """
+    Returns the index of the library in `srcdir`, updating the saved
+    ``api_index.json`` there if any source file changed (or rebuilding it
+    from scratch if `force`).
+    """
+    indexfn = os.path.join(srcdir, INDEX_FILENAME)
+    old = None
+    if not force and os.path.isfile(indexfn):
+        with open(indexfn) as f:
+            try:
+                old = json.load(f)
+            except ValueError:
+                old = None
+
+    index = build_index(srcdir, prefix, old, verbose)
+    if index != old:
+        if verbose:
+            print('Writing', indexfn)
+        with open(indexfn, 'w') as f:
+            json.dump(index, f, sort_keys=True)
+    return index
+
+
+def call_graph(index, srcdir=None):
+    """
+    Returns ``(definitions, calls)`` from the `index`, as
+    `source_parser.build_call_graph` does, with the file names joined to
+    `srcdir` if given.
+    """
+    definitions = {}
+    calls = {}
+    for name, func in index['functions'].items():
+        fn = func['file']
+        definitions[name] = fn if srcdir is None else os.path.join(srcdir, fn)
+        calls[name] = func['calls']
+    return definitions, calls
+
+
+def function_text(index, srcdir, name, part='body'):
+    """
+    Returns the text of the `part` (``'body'`` or ``'comment'``) of the
+    function `name`, read from its file in `srcdir` using the index offsets.
+    """
+    func = index['functions'][name]
+    if func[part] is None:
+        return None
+    start, end = func[part]
+    with open(os.path.join(srcdir, func['file']), 'rb') as f:
+        f.seek(start)
+        return f.read(end - start).decode('latin-1')
+
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+
+    from sofa_deriver import find_sourcedir
+
+    parser = argparse.ArgumentParser(description='Builds (or updates) and '
+                                                 'queries the index of a '
+                                                 'SOFA-derived library.')
+    parser.add_argument('srcdir', nargs='?', default=None, help='The '
+                        'directory with the source code.  If not given, '
+                        'one that looks SOFA-derived is searched for.')
+    parser.add_argument('functions', nargs='*', help='Print the index '
+                        'entries of these functions.')
+    parser.add_argument('--func-prefix', default='era',
+                        help='The prefix of the function names.')
+    parser.add_argument('--force', '-f', default=False, action='store_true',
+                        help='Rebuild the whole index.')
+    parser.add_argument('--quiet', '-q', default=False, action='store_true',
+                        help='Print less info to the terminal.')
+    args = parser.parse_intermixed_args()
+
+    srcdir = args.srcdir if args.srcdir is not None else find_sourcedir()
+    index = load_index(srcdir, args.func_prefix, args.force,
+                       verbose=not args.quiet)
+
+    if args.functions:
+        unknown = [name for name in args.functions
+                   if name not in index['functions']]
+        if unknown:
+            print('Not in the index: ' + ', '.join(unknown), file=sys.stderr)
+            sys.exit(1)
+        json.dump(dict([(name, index['functions'][name])
+                        for name in args.functions]),
+                  sys.stdout, indent=1, sort_keys=True)
+        print()
+    elif not args.quiet:
+        print('{0} functions and {1} macros in {2} files'.format(
+              len(index['functions']), len(index['macros']),
+              len(index['files'])))
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+"""
+Fetches SOFA with a small asyncio HTTP/1.1 client.  Connections are kept
+alive and reused, so finding the download URL on the SOFA web page and
+downloading the tar file from the same server take one connection.  The
+download can be split into byte ranges that are fetched in parallel from
+the server and a list of mirrors, and a range that fails on one of them is
+fetched from the next.  This needs Python 3.7 or later (for asyncio),
+unlike the rest of these tools.  Do::
+
+  python async_fetch.py --help
+
+To see the options.
+"""
+
+import os
+import re
+import asyncio
+
+from six.moves.urllib.parse import urlsplit, urljoin
+
+DEFAULT_PAGE_URL = 'http://www.iausofa.org/current_C.html'
+DEFAULT_CHUNK_SIZE = 256 * 1024
+
+_CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/(\d+)$')
+
+
+class FetchError(IOError):
+    """
+    Raised when a URL cannot be fetched (from any of the mirrors).
+    """
+
+
+class _Connection(object):
+    def __init__(self, key, reader, writer):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+
+    def close(self):
+        self.writer.close()
+
+    async def request(self, method, host, path, headers):
+        """
+        Sends a request and returns ``(status, headers, body, keepalive)``,
+        with the header names in lower case.
+        """
+        lines = ['{0} {1} HTTP/1.1'.format(method, path),
+                 'Host: ' + host,
+                 'Accept-Encoding: identity']
+        for name, value in headers.items():
+            lines.append('{0}: {1}'.format(name, value))
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await self.writer.drain()
+
+        statusline = await self.reader.readline()
+        if not statusline:
+            raise ConnectionResetError('connection closed by the server')
+        version, status = statusline.decode('latin-1').split(None, 2)[:2]
+        status = int(status)
+        resheaders = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            resheaders[name.strip().lower()] = value.strip()
+
+        keepalive = (version == 'HTTP/1.1' and
+                     resheaders.get('connection', '').lower() != 'close')
+        if method == 'HEAD' or status in (204, 304) or status < 200:
+            body = b''
+        elif resheaders.get('transfer-encoding', '').lower() == 'chunked':
+            body = await self._read_chunked()
+        elif 'content-length' in resheaders:
+            body = await self.reader.readexactly(
+                int(resheaders['content-length']))
+        else:
+            body = await self.reader.read()
+            keepalive = False
+        return status, resheaders, body, keepalive
+
+    async def _read_chunked(self):
+        chunks = []
+        while True:
+            size = int((await self.reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                # skip any trailers
+                while (await self.reader.readline()) not in (b'\r\n', b'\n',
+                                                              b''):
+                    pass
+                return b''.join(chunks)
+            chunks.append(await self.reader.readexactly(size))
+            await self.reader.readline()
+
+
+class AsyncFetcher(object):
+    """
+    Fetches URLs over at most `connections` kept-alive connections at a
+    time.  Each request times out after `timeout` seconds.  Must be created
+    and used inside a running event loop, and closed with `close`.
+    """
+    def __init__(self, connections=4, timeout=30, verbose=False):
+        self.connections = connections
+        self.timeout = timeout
+        self.verbose = verbose
+        # the number of connections opened, for checking they are reused
+        self.opened = 0
+        self._idle = {}
+        self._slots = asyncio.Semaphore(connections)
+
+    async def _connect(self, key):
+        idle = self._idle.get(key)
+        if idle:
+            return idle.pop(), True
+        scheme, host, port = key
+        reader, writer = await asyncio.open_connection(
+            host, port, ssl=True if scheme == 'https' else None)
+        self.opened += 1
+        return _Connection(key, reader, writer), False
+
+    async def request(self, url, headers=None, method='GET', redirects=5):
+        """
+        Requests `url`, following redirects, and returns ``(url, status,
+        headers, body)`` for the final URL.
+        """
+        for _ in range(redirects + 1):
+            status, resheaders, body = await self._request_once(
+                url, headers or {}, method)
+            if status in (301, 302, 303, 307, 308) and 'location' in resheaders:
+                url = urljoin(url, resheaders['location'])
+                continue
+            return url, status, resheaders, body
+        raise FetchError('Too many redirects for ' + url)
+
+    async def _request_once(self, url, headers, method):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise FetchError('Cannot fetch ' + url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+        host = parts.netloc.rpartition('@')[-1]
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        async with self._slots:
+            while True:
+                # DNS, connection and SSL errors are all OSErrors
+                try:
+                    conn, reused = await asyncio.wait_for(self._connect(key),
+                                                          self.timeout)
+                except (OSError, asyncio.TimeoutError) as e:
+                    raise FetchError('Connecting to {0} failed: '
+                                     '{1!r}'.format(url, e))
+                try:
+                    status, resheaders, body, keepalive = await asyncio.wait_for(
+                        conn.request(method, host, path, headers), self.timeout)
+                except (OSError, asyncio.IncompleteReadError, ValueError,
+                        asyncio.TimeoutError) as e:
+                    conn.close()
+                    # a kept-alive connection may have been closed by the
+                    # server in the meantime, so try a new one
+                    if reused and not isinstance(e, asyncio.TimeoutError):
+                        continue
+                    raise FetchError('Fetching {0} failed: {1!r}'.format(url,
+                                                                          e))
+                break
+
+        if keepalive:
+            self._idle.setdefault(key, []).append(conn)
+        else:
+            conn.close()
+        return status, resheaders, body
+
+    async def close(self):
+        for conns in self._idle.values():
+            for conn in conns:
+                conn.close()
+        self._idle = {}
+
+    async def find_sofa_url(self, pageurl=DEFAULT_PAGE_URL):
+        """
+        Returns the download URL for the latest C SOFA, from the web page at
+        `pageurl`.
+        """
+        from sofa_deriver import _sofa_url_from_page
+
+        url, status, _, page = await self.request(pageurl)
+        if status != 200:
+            raise FetchError('Fetching {0} gave HTTP status {1}'.format(url,
+                                                                        status))
+        return _sofa_url_from_page(page, url)
+
+    async def _fetch_range(self, url, start, end, total):
+        # returns the bytes start to end (inclusive), or raises FetchError
+        rangeurl, status, headers, body = await self.request(
+            url, {'Range': 'bytes={0}-{1}'.format(start, end)})
+        match = _CONTENT_RANGE_RE.match(headers.get('content-range', ''))
+        if (status != 206 or match is None or
+                [int(x) for x in match.groups()] != [start, end, total] or
+                len(body) != end - start + 1):
+            raise FetchError('{0} did not return bytes {1}-{2} of {3} (HTTP '
+                             'status {4})'.format(rangeurl, start, end, total,
+                                                  status))
+        return body
+
+    async def download(self, url, fn, mirrors=(), chunksize=DEFAULT_CHUNK_SIZE,
+                       sha256=None):
+        """
+        Downloads `url` to the file `fn`.  `mirrors` are the base URLs of
+        other servers with the same file (under the same file name).  The
+        file is fetched in `chunksize` byte ranges, spread over the servers
+        that support them, and each range is fetched from the next server if
+        one fails.  If `sha256` is given, the file must have that SHA-256 hex
+        digest.  Returns the number of bytes downloaded.
+        """
+        basename = url.split('/')[-1]
+        sources = [url] + [mirror.rstrip('/') + '/' + basename
+                           for mirror in mirrors]
+        failed = set()
+
+        # the first range tells us the size of the file (and whether the
+        # server supports ranges at all)
+        for source in sources:
+            try:
+                _, status, headers, body = await self.request(
+                    source, {'Range': 'bytes=0-{0}'.format(chunksize - 1)})
+            except FetchError as e:
+                if self.verbose:
+                    print(e)
+                failed.add(source)
+                continue
+            match = _CONTENT_RANGE_RE.match(headers.get('content-range', ''))
+            if status == 206 and match is not None:
+                total = int(match.group(3))
+                break
+            elif status == 200:
+                # no ranges, but this is the whole file
+                total = len(body)
+                break
+            if self.verbose:
+                print('Fetching {0} gave HTTP status {1}'.format(source,
+                                                                 status))
+            failed.add(source)
+        else:
+            raise FetchError('Could not fetch {0} from any of {1}'.format(
+                             basename, sources))
+
+        partfn = fn + '.part'
+        with open(partfn, 'wb') as f:
+            f.truncate(total)
+            f.write(body)
+            # the remaining ranges are handed out to the servers in turn
+            sources = [source for source in sources if source not in failed]
+            tasks = [asyncio.ensure_future(
+                         self._download_range(sources, i, start,
+                                              min(start + chunksize, total) - 1,
+                                              total, f, failed))
+                     for i, start in enumerate(range(len(body), total,
+                                                     chunksize))]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                f.close()
+                os.remove(partfn)
+                raise
+
+        if sha256 is not None:
+            from sofa_deriver import _file_digest
+
+            digest = _file_digest(partfn)
+            if digest != sha256.lower():
+                os.remove(partfn)
+                raise FetchError('Downloaded {0} has SHA-256 {1}, expected '
+                                 '{2}'.format(basename, digest, sha256))
+        if os.path.exists(fn):
+            os.remove(fn)
+        os.rename(partfn, fn)
+        return total
+
+    async def _download_range(self, sources, i, start, end, total, f, failed):
+        # start with a different server for each range, and skip the ones
+        # that have failed unless there are no others left
+        order = sources[i % len(sources):] + sources[:i % len(sources)]
+        order.sort(key=lambda source: source in failed)
+        for source in order:
+            try:
+                body = await self._fetch_range(source, start, end, total)
+            except FetchError as e:
+                if self.verbose:
+                    print(e)
+                failed.add(source)
+                continue
+            f.seek(start)
+            f.write(body)
+            return
+        raise FetchError('Could not fetch bytes {0}-{1} of {2} from any of '
+                         '{3}'.format(start, end, sources[0].split('/')[-1],
+                                      sources))
+
+
+def fetch_sofa(url=None, dlloc='.', mirrors=(), connections=4,
+               chunksize=DEFAULT_CHUNK_SIZE, sha256=None,
+               pageurl=DEFAULT_PAGE_URL, timeout=30, verbose=True):
+    """
+    Downloads the latest SOFA (found on `pageurl`), or the one at `url`, to
+    the `dlloc` directory, as `AsyncFetcher.download` does, and returns the
+    name of the downloaded file.
+    """
+    async def fetch():
+        fetcher = AsyncFetcher(connections, timeout, verbose)
+        try:
+            sofaurl = url
+            if sofaurl is None:
+                sofaurl = await fetcher.find_sofa_url(pageurl)
+            fn = os.path.join(dlloc, sofaurl.split('/')[-1])
+            if verbose:
+                print('Downloading {0} to {1}'.format(sofaurl, fn))
+            nbytes = await fetcher.download(sofaurl, fn, mirrors, chunksize,
+                                            sha256)
+            if verbose:
+                print('Downloaded {0} bytes over {1} connection(s)'.format(
+                      nbytes, fetcher.opened))
+            return fn
+        finally:
+            await fetcher.close()
+
+    if not os.path.isdir(dlloc):
+        raise ValueError('Requested dlloc {0} is not a directory'.format(dlloc))
+    return asyncio.run(fetch())
+
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Downloads SOFA over '
+                                                 'parallel, reused '
+                                                 'connections.')
+    parser.add_argument('url', nargs='?', default=None,
+                        help='The URL of the SOFA file.  If not given, the '
+                             'latest one is found on the SOFA web page.')
+    parser.add_argument('--page-url', default=DEFAULT_PAGE_URL,
+                        help='The web page to find the latest SOFA on.')
+    parser.add_argument('--mirror', '-m', action='append', default=[],
+                        metavar='BASEURL',
+                        help='The base URL of a mirror with the same file '
+                             '(can be given more than once).')
+    parser.add_argument('--connections', '-c', default=4, type=int,
+                        help='The maximum number of connections to use at '
+                             'once.')
+    parser.add_argument('--chunk-size', default=DEFAULT_CHUNK_SIZE, type=int,
+                        help='The size in bytes of the ranges to download in '
+                             'parallel.')
+    parser.add_argument('--timeout', default=30, type=float,
+                        help='The time in seconds to wait for a request.')
+    parser.add_argument('--sha256', default=None,
+                        help='The expected SHA-256 hex digest of the file.')
+    parser.add_argument('--output-dir', '-o', default='.',
+                        help='The directory to download into.')
+    parser.add_argument('--quiet', '-q', default=False, action='store_true',
+                        help='Print less info to the terminal.')
+    args = parser.parse_args()
+
+    try:
+        fetch_sofa(args.url, args.output_dir, args.mirror, args.connections,
+                   args.chunk_size, args.sha256, args.page_url, args.timeout,
+                   verbose=not args.quiet)
+    except FetchError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
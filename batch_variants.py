@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+"""
+Generates batched versions of the functions of a SOFA-derived library: for
+each function ``eraXxx`` in the library header, a function
+``eraXxx_n(ncall, ...)`` that calls it `ncall` times on strided arrays of
+arguments.  They are written as a separate header/source pair (``erfa_n.h``
+and ``erfa_n.c``), along with a test program (``t_erfa_n_c.c``) that checks
+every batched function gives the same results as calling the original in a
+loop.
+
+The loops are simple counted loops over the calls, so when the scalar
+functions are visible to the compiler (e.g. with ``-flto``, or by compiling
+``erfa_n.c`` together with the flattened ``erfa.c``) it can inline and
+vectorise them.
+"""
+
+import re
+
+import source_parser
+
+
+_PARAM_RE = re.compile(r'^(const\s+)?(\w+)\s*(\*?)\s*(\w+)\s*'
+                       r'((?:\[\s*\d*\s*\])*)$')
+
+# the number of calls made by each generated test
+NTEST = 5
+
+HEADER_TEMPL = """#ifndef {guard}
+#define {guard}
+
+/*
+**  Batched versions of the {libname} functions, generated from {libname}.h.
+**
+**  {prefix}Xxx_n(ncall, ...) calls {prefix}Xxx ncall times.  Each argument
+**  x of {prefix}Xxx is replaced by a pointer to its first value and
+**  x_stride, the number of elements (doubles, ints, ...) from one call's
+**  value to the next - the size of the argument for contiguous values, or 0
+**  to use the same value in every call.  Functions that return a value
+**  store the one from call i in ret[i * ret_stride].  Strings are passed
+**  unchanged.
+*/
+
+#include "{libname}.h"
+
+#ifdef __cplusplus
+extern "C" {{
+#endif
+
+{prototypes}
+#ifdef __cplusplus
+}}
+#endif
+
+#endif
+"""
+
+SOURCE_TEMPL = """/*
+**  Batched versions of the {libname} functions, generated from {libname}.h.
+**  See {libname}_n.h.
+*/
+
+#include "{libname}_n.h"
+
+{functions}"""
+
+TEST_TEMPL = """#include "{libname}_n.h"
+#include <stdio.h>
+#include <string.h>
+
+static int verbose = 0;
+
+/*
+**  Validate the batched {libname} functions against the scalar versions.
+**  Generated from {libname}.h.
+*/
+
+static void vmem(const void *val, const void *valok, size_t size,
+                 const char *func, const char *test, int *status)
+{{
+   if (memcmp(val, valok, size)) {{
+      *status = 1;
+      printf("%s failed: %s differs from the scalar version\\n",
+             func, test);
+   }} else if (verbose) {{
+      printf("%s passed: %s\\n", func, test);
+   }}
+}}
+
+static void fill_d(double *a, int n, int seed)
+{{
+   int i;
+
+   for (i = 0; i < n; i++) a[i] = 0.1 + 0.173 * ((seed + 7 * i) % 11);
+}}
+
+static void fill_i(int *a, int n, int seed)
+{{
+   int i;
+
+   for (i = 0; i < n; i++) a[i] = 1 + (seed + 5 * i) % 12;
+}}
+
+{tests}int main(int argc, char *argv[])
+{{
+   int status;
+
+/* If any command-line argument, switch to verbose reporting. */
+   if (argc > 1) {{
+      verbose = 1;
+      argv[0][0] += 0;    /* to avoid compiler warnings */
+   }}
+
+/* Preset the &status to FALSE = success. */
+   status = 0;
+
+/* Test all of the batched functions. */
+{calls}
+/* Report, set up an appropriate exit status, and finish. */
+   if (status) {{
+      printf("t_{libname}_n_c validation failed!\\n");
+   }} else {{
+      printf("t_{libname}_n_c validation successful\\n");
+   }}
+   return status;
+}}
+"""
+
+
+def parse_prototype(lines, prefix='era'):
+    """
+    Parses the prototype in `lines` into ``(rettype, name, params)``, where
+    each of the `params` is a dict with the ``name``, ``ctype`` (without
+    qualifiers), whether it is ``const``, whether it is a ``pointer`` and
+    its array ``dims`` (with None for ``[]``).  Returns None if the
+    prototype can't be parsed.
+    """
+    code = ' '.join(source_parser.blank_comments_and_strings(''.join(lines))
+                    .split())
+    match = re.match(r'^(.*?)\b(' + re.escape(prefix) +
+                     r'[A-Z0-9]\w*)\s*\((.*)\)\s*;$', code)
+    if match is None:
+        return None
+    rettype, name, paramstr = match.groups()
+
+    params = []
+    if paramstr.strip() not in ('', 'void'):
+        for paramtext in paramstr.split(','):
+            pmatch = _PARAM_RE.match(paramtext.strip())
+            if pmatch is None:
+                return None
+            const, ctype, pointer, pname, dims = pmatch.groups()
+            params.append({'name': pname, 'ctype': ctype,
+                           'const': bool(const), 'pointer': bool(pointer),
+                           'dims': [int(d) if d.strip() else None for d in
+                                    re.findall(r'\[([^\]]*)\]', dims)]})
+    return rettype.strip(), name, params
+
+
+def _is_string(param):
+    return param['ctype'] == 'char' and param['const']
+
+
+def _count(param):
+    # the number of elements in one call's value of an array argument
+    count = 1
+    for d in param['dims']:
+        count *= d or 1
+    return count
+
+
+def _call_arg(param, base, i='icall', stride=None):
+    # the expression for call `i`'s value of the argument `param`, whose
+    # values start at `base`
+    if _is_string(param):
+        return base
+    if stride is None:
+        stride = param['name'] + '_stride'
+    if not param['pointer'] and not param['dims']:
+        return '{0}[{1} * {2}]'.format(base, i, stride)
+    offset = '{0} + {1} * {2}'.format(base, i, stride)
+    if len(param['dims']) > 1:
+        return '({0}{1} (*){2}) ({3})'.format(
+            'const ' if param['const'] else '', param['ctype'],
+            ''.join(['[{0}]'.format(d) for d in param['dims'][1:]]), offset)
+    return offset
+
+
+def batch_prototype(rettype, name, params):
+    """
+    Returns the prototype (without the ``;``) of the batched version of the
+    function `name`.
+    """
+    args = ['int ncall']
+    for param in params:
+        if _is_string(param):
+            args.append('const char *' + param['name'])
+            continue
+        const = param['const'] or not (param['pointer'] or param['dims'])
+        args.append('{0}{1} *{2}, int {2}_stride'.format(
+                    'const ' if const else '', param['ctype'], param['name']))
+    if rettype != 'void':
+        args.append('{0} *ret, int ret_stride'.format(rettype))
+
+    return _wrap('void {0}_n('.format(name), args, ')')
+
+
+def _wrap(start, args, end):
+    # joins `args` with commas after `start` and ends with `end`, wrapping
+    # the lines like the SOFA prototypes do
+    lines = []
+    line = start
+    indent = ' ' * len(start)
+    for j, arg in enumerate(args):
+        arg += end if j == len(args) - 1 else ','
+        if len(line) + len(arg) + 1 > 78 and not line.endswith('('):
+            lines.append(line)
+            line = indent + arg
+        else:
+            line += ('' if line.endswith('(') else ' ') + arg
+    lines.append(line)
+    return '\n'.join(lines)
+
+
+def batch_function(rettype, name, params):
+    """
+    Returns the definition of the batched version of the function `name`.
+    """
+    start = '      {0}('.format(name)
+    if rettype != 'void':
+        start = '      ret[icall * ret_stride] = {0}('.format(name)
+    call = _wrap(start, [_call_arg(param, param['name']) for param in params]
+                 or [''], ');')
+    return ('{0}\n{{\n   long icall;\n\n'
+            '   for (icall = 0; icall < ncall; icall++) {{\n'
+            '{1}\n   }}\n}}\n'.format(batch_prototype(rettype, name, params),
+                                     call))
+
+
+def batch_test(rettype, name, params, testname):
+    """
+    Returns the definition of the test function `testname` that checks the
+    batched version of `name` against calling `name` in a loop, or None if
+    it has arguments the test can't make up values for.
+    """
+    for param in params:
+        if (param['ctype'] not in ('double', 'int', 'char') or
+                _is_string(param)):
+            return None
+
+    decls = []
+    setup = []
+    batchargs = []
+    scalarargs = []
+    checks = []
+    for j, param in enumerate(params):
+        pname = param['name']
+        ctype = param['ctype']
+        array = param['pointer'] or param['dims']
+        count = _count(param) if array else 1
+        if array:
+            decls.append('   {0} {1}[{2}], {1}_ok[{2}];\n'.format(
+                         ctype, pname, NTEST * count))
+        else:
+            decls.append('   {0} {1}[{2}];\n'.format(ctype, pname, NTEST))
+        if ctype == 'double':
+            setup.append('   fill_d({0}, {1}, {2});\n'.format(
+                         pname, NTEST * count, j))
+        elif ctype == 'int':
+            setup.append('   fill_i({0}, {1}, {2});\n'.format(
+                         pname, NTEST * count, j))
+        else:
+            setup.append('   memset({0}, 0, sizeof {0});\n'.format(pname))
+        if array:
+            setup.append('   memcpy({0}_ok, {0}, sizeof {0});\n'.format(pname))
+            checks.append(pname)
+        batchargs.append('{0}, {1}'.format(pname, count))
+        scalarargs.append(_call_arg(param, pname + '_ok' if array else pname,
+                                    stride=str(count)))
+
+    start = '      {0}('.format(name)
+    if rettype != 'void':
+        decls.append('   {0} ret[{1}], ret_ok[{1}];\n'.format(rettype, NTEST))
+        batchargs.append('ret, 1')
+        start = '      ret_ok[icall] = {0}('.format(name)
+        checks.append('ret')
+    call = _wrap(start, scalarargs or [''], ');')
+    decls.append('   int icall;\n')
+
+    lines = ['static void {0}(int *status)\n'.format(testname),
+             '/*\n',
+             '**  Test {0}_n against {0}.\n'.format(name),
+             '*/\n',
+             '{\n']
+    lines.extend(decls)
+    lines.append('\n')
+    lines.extend(setup)
+    lines.append('\n')
+    lines.append(_wrap('   {0}_n('.format(name), [str(NTEST)] + batchargs,
+                       ');') + '\n')
+    lines.append('   for (icall = 0; icall < {0}; icall++) {{\n'.format(NTEST))
+    lines.append(call + '\n')
+    lines.append('   }\n\n')
+    for check in checks:
+        lines.append('   vmem({0}, {0}_ok, sizeof {0}, "{1}_n", "{0}", '
+                     'status);\n'.format(check, name))
+    lines.append('}\n\n')
+    return ''.join(lines)
+
+
+def make_batch_variants(headerlines, libname='erfa', prefix='era'):
+    """
+    Generates the batched versions of the functions declared in the library
+    header `headerlines`.  Returns ``(files, skipped)``, where `files` maps
+    the file names (``<libname>_n.h``, ``<libname>_n.c`` and
+    ``t_<libname>_n_c.c``) to their text, and `skipped` lists the functions
+    whose prototypes couldn't be parsed.
+    """
+    prototypes = []
+    functions = []
+    tests = []
+    calls = []
+    skipped = []
+    for name, lines in source_parser.iter_prototypes(headerlines, prefix):
+        if name is None:
+            continue
+        parsed = parse_prototype(lines, prefix)
+        if parsed is None:
+            skipped.append(name)
+            continue
+        prototypes.append(batch_prototype(*parsed) + ';\n')
+        functions.append(batch_function(*parsed))
+        testname = 't_' + name[len(prefix):].lower() + '_n'
+        test = batch_test(parsed[0], parsed[1], parsed[2], testname)
+        if test is not None:
+            tests.append(test)
+            calls.append('   {0}(&status);\n'.format(testname))
+
+    files = {}
+    files[libname + '_n.h'] = HEADER_TEMPL.format(
+        guard=libname.upper() + '_N_H', libname=libname, prefix=prefix,
+        prototypes=''.join(prototypes))
+    files[libname + '_n.c'] = SOURCE_TEMPL.format(
+        libname=libname, functions='\n'.join(functions))
+    files['t_{0}_n_c.c'.format(libname)] = TEST_TEMPL.format(
+        libname=libname, tests=''.join(tests), calls=''.join(calls))
+    return files, skipped
+
+
+def write_batch_variants(headerlines, sink, libname='erfa', prefix='era',
+                         verbose=True):
+    """
+    Generates the batched versions of the functions declared in the library
+    header `headerlines` and writes them to the `output_sinks.OutputSink`
+    `sink`.
+    """
+    files, skipped = make_batch_variants(headerlines, libname, prefix)
+    if skipped:
+        print('Could not make batched versions of: ' + ', '.join(skipped))
+    for fn in sorted(files):
+        if verbose:
+            print('Writing to file', sink.describe(fn))
+        sink.write(fn, files[fn])
+
+
+if __name__ == '__main__':
+    import os
+    import argparse
+
+    from output_sinks import open_sink
+
+    parser = argparse.ArgumentParser(description='Generates batched '
+                                                 'versions of the functions '
+                                                 'of a SOFA-derived '
+                                                 'library.')
+    parser.add_argument('header', help='The library header (e.g. '
+                                       'erfa/erfa.h).')
+    parser.add_argument('--output', '-o', default=None,
+                        help='The directory or archive to write to.  '
+                             'Defaults to <libname>_n.')
+    parser.add_argument('--func-prefix', default='era',
+                        help='The prefix of the function names.')
+    parser.add_argument('--quiet', '-q', default=False, action='store_true',
+                        help='Print less info to the terminal.')
+    args = parser.parse_args()
+
+    libname = os.path.basename(args.header)[:-2]
+    output = args.output if args.output is not None else libname + '_n'
+    with open(args.header) as f, \
+            open_sink(output, verbose=not args.quiet) as sink:
+        write_batch_variants(f, sink, libname, args.func_prefix,
+                             verbose=not args.quiet)
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+"""
+This script compiles a SOFA-derived library (e.g. the ``erfa`` directory made
+by `sofa_deriver`) into a static library and its test program, keeping the
+object files in a content-addressed cache.  An object is only recompiled if
+its source file, the local headers it includes, the compiler, or the flags
+changed, so after a SOFA point release only the routines that actually
+changed are rebuilt.  Do::
+
+  python cached_build.py --help
+
+To see the options.
+"""
+
+import os
+import re
+import sys
+import hashlib
+import threading
+import subprocess
+
+_INCLUDE_RE = re.compile(r'^\s*#\s*include\s*"([^"]+)"', re.MULTILINE)
+
+
+def compiler_id(cc):
+    """
+    Returns a string identifying the compiler `cc` (its ``--version``
+    output), so that upgrading the compiler invalidates the cache.
+    """
+    try:
+        version = subprocess.check_output([cc, '--version'],
+                                          stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        version = b''
+    return cc + '\n' + version.decode('utf-8', 'replace')
+
+
+class ObjectCache(object):
+    """
+    Compiles C files into objects stored in `cachedir` under the SHA-256 of
+    everything that affects the result: the source, the local headers it
+    includes (``#include "..."``, found relative to the source or in
+    `includedirs`), the compiler identity and the flags.
+
+    ``hits`` and ``misses`` count how many `compile` calls reused an object.
+    """
+    def __init__(self, cachedir, cc='cc', cflags=(), includedirs=()):
+        self.cachedir = cachedir
+        self.cc = cc
+        self.cflags = list(cflags)
+        self.includedirs = list(includedirs)
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._compilerid = compiler_id(cc)
+        self._headerdigests = {}
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+
+    def _find_header(self, name, srcdir):
+        for dirnm in [srcdir] + self.includedirs:
+            fn = os.path.join(dirnm, name)
+            if os.path.isfile(fn):
+                return os.path.abspath(fn)
+        # a system header or one that doesn't exist - the compiler will
+        # complain about the latter
+        return None
+
+    def _update_with_includes(self, hasher, text, srcdir, seen):
+        for name in _INCLUDE_RE.findall(text):
+            fn = self._find_header(name, srcdir)
+            if fn is None or fn in seen:
+                continue
+            seen.add(fn)
+            if fn not in self._headerdigests:
+                with open(fn, 'rb') as f:
+                    data = f.read()
+                self._headerdigests[fn] = (hashlib.sha256(data).hexdigest(),
+                                           data.decode('utf-8', 'replace'))
+            digest, htext = self._headerdigests[fn]
+            hasher.update(name.encode('utf-8') + b'\0' +
+                          digest.encode('ascii') + b'\0')
+            self._update_with_includes(hasher, htext, os.path.dirname(fn),
+                                       seen)
+
+    def key(self, srcfn):
+        """
+        Returns the cache key of the object for the C file `srcfn`.
+        """
+        with open(srcfn, 'rb') as f:
+            data = f.read()
+        hasher = hashlib.sha256()
+        for part in [self._compilerid] + self.cflags:
+            hasher.update(part.encode('utf-8') + b'\0')
+        hasher.update(data + b'\0')
+        self._update_with_includes(hasher, data.decode('utf-8', 'replace'),
+                                   os.path.dirname(os.path.abspath(srcfn)),
+                                   set())
+        return hasher.hexdigest()
+
+    def compile(self, srcfn):
+        """
+        Returns the path of the object file for `srcfn`, compiling it only if
+        it is not already in the cache.
+        """
+        key = self.key(srcfn)
+        objfn = os.path.join(self.cachedir, key[:2], key + '.o')
+        hit = os.path.isfile(objfn)
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if hit:
+            return objfn
+
+        if not os.path.isdir(os.path.dirname(objfn)):
+            try:
+                os.makedirs(os.path.dirname(objfn))
+            except OSError:
+                # another thread may have just made it
+                pass
+        # compile to a temporary name so an interrupted build never leaves a
+        # truncated object in the cache
+        tmpfn = '{0}.{1}.tmp'.format(objfn, os.getpid())
+        cmd = ([self.cc] + self.cflags +
+               ['-I' + dirnm for dirnm in self.includedirs] +
+               ['-c', srcfn, '-o', tmpfn])
+        try:
+            subprocess.check_call(cmd)
+        except subprocess.CalledProcessError:
+            if os.path.exists(tmpfn):
+                os.remove(tmpfn)
+            raise
+        os.rename(tmpfn, objfn)
+        return objfn
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / float(total) if total else 0.0
+
+
+def build_library(srcdir, builddir='build', libname=None, cachedir=None,
+                  cc='cc', cflags=('-O2',), jobs=None, testfn=None,
+                  verbose=True):
+    """
+    Compiles the C files in `srcdir` through an `ObjectCache` in `cachedir`
+    (``<builddir>/objcache`` if None), `jobs` at a time (one per CPU if None),
+    and links ``lib<libname>.a`` and ``test_<libname>`` in `builddir`.
+    `libname` defaults to the name of `srcdir`, and `testfn` to the test
+    program in `srcdir`.
+
+    Returns the ObjectCache, so its ``hits`` and ``misses`` can be inspected.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    from parallel_tests import find_test_file
+
+    if libname is None:
+        libname = os.path.basename(os.path.abspath(srcdir))
+    if cachedir is None:
+        cachedir = os.path.join(builddir, 'objcache')
+    if testfn is None:
+        testfn = find_test_file(srcdir)
+    if not os.path.isdir(builddir):
+        os.makedirs(builddir)
+
+    cache = ObjectCache(cachedir, cc, cflags, [srcdir])
+    libfns = [os.path.join(srcdir, fn) for fn in sorted(os.listdir(srcdir))
+              if fn.endswith('.c') and
+              os.path.join(srcdir, fn) != testfn]
+
+    # the compiler does the work, so threads are enough to run it in parallel
+    executor = ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1)
+    try:
+        objfns = list(executor.map(cache.compile, libfns + [testfn]))
+    finally:
+        executor.shutdown()
+    testobjfn = objfns.pop()
+
+    libfn = os.path.join(builddir, 'lib{0}.a'.format(libname))
+    if os.path.exists(libfn):
+        os.remove(libfn)
+    if verbose:
+        print('Linking', libfn)
+    subprocess.check_call(['ar', 'rcs', libfn] + objfns)
+
+    exefn = os.path.join(builddir, 'test_' + libname)
+    if verbose:
+        print('Linking', exefn)
+    subprocess.check_call([cc] + list(cflags) +
+                          ['-o', exefn, testobjfn, libfn, '-lm'])
+
+    if verbose:
+        print('Object cache: {0} hits, {1} misses ({2:.0%} hit rate)'
+              ''.format(cache.hits, cache.misses, cache.hit_rate()))
+    return cache
+
+
+if __name__ == '__main__':
+    import shlex
+    import argparse
+
+    from sofa_deriver import find_sourcedir
+
+    parser = argparse.ArgumentParser(description='Compiles a SOFA-derived '
+                                                 'library and its tests, '
+                                                 'reusing cached objects.')
+    parser.add_argument('srcdir', nargs='?', default=None, help='The '
+                        'directory with the source code.  If not given, '
+                        'one that looks SOFA-derived is searched for.')
+    parser.add_argument('--build-dir', '-b', default='build',
+                        help='Where to put the library and test program.')
+    parser.add_argument('--cache-dir', default=None, help='Where to keep '
+                        'the object cache.  Defaults to objcache in the '
+                        'build directory.')
+    parser.add_argument('--libname', '-l', default=None,
+                        help='The name of the library.  Defaults to the '
+                             'name of srcdir.')
+    parser.add_argument('--cc', default=os.environ.get('CC', 'cc'),
+                        help='The C compiler (defaults to $CC or cc).')
+    parser.add_argument('--cflags', default=os.environ.get('CFLAGS', '-O2'),
+                        help='Flags for the C compiler (defaults to $CFLAGS '
+                             'or -O2).')
+    parser.add_argument('--jobs', '-j', default=0, type=int,
+                        help='The number of files to compile at once.  '
+                             'Defaults to one per CPU.')
+    parser.add_argument('--quiet', '-q', default=False, action='store_true',
+                        help='Print less info to the terminal.')
+    args = parser.parse_args()
+
+    srcdir = args.srcdir if args.srcdir is not None else find_sourcedir()
+
+    try:
+        build_library(srcdir, args.build_dir, args.libname, args.cache_dir,
+                      args.cc, shlex.split(args.cflags), args.jobs or None,
+                      verbose=not args.quiet)
+    except subprocess.CalledProcessError as e:
+        print('Build failed: ' + str(e), file=sys.stderr)
+        sys.exit(1)
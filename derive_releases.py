@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+"""
+Derives every SOFA release (``sofa_c-*.tar.gz`` file) in a directory at once,
+e.g. to bisect a change in behaviour between releases.  Each release goes
+into its own output directory, named after its version, and the releases are
+derived concurrently.  Members that are the same in several releases are
+only transformed once, through a cache shared by all of them.  A summary of
+the number of files and functions in each release is printed at the end.
+Do::
+
+  python derive_releases.py --help
+
+To see the options.
+"""
+
+import os
+import re
+import sys
+import glob
+import time
+import json
+
+_SOFA_TARFILE_RE = re.compile(r'sofa_c-(.*)\.tar\.gz$')
+
+
+def find_sofa_tarfiles(sofadir):
+    """
+    Returns ``(version, filename)`` for each ``sofa_c-*.tar.gz`` file in
+    `sofadir`, sorted by version.
+    """
+    releases = []
+    for fn in glob.glob(os.path.join(sofadir, 'sofa_c-*.tar.gz')):
+        match = _SOFA_TARFILE_RE.search(os.path.basename(fn))
+        releases.append((match.group(1), fn))
+    return sorted(releases)
+
+
+def derive_release(sofatarfn, outdir, libname='erfa', func_prefix='era',
+                   copyrightyear=None, membercache=None, flatten=False,
+                   force=False):
+    """
+    Derives the SOFA release in `sofatarfn` into `outdir` (a ``<libname>``
+    directory in it, or the flattened files themselves if `flatten`), and
+    returns a dict summarizing it: the ``output`` directory, the number of
+    ``files``, ``functions`` and ``macros`` in it, how many members were
+    found in the `membercache` (``cached``) and the ``seconds`` taken.
+
+    This is a module-level function so it can be run in worker processes.
+    """
+    from api_index import build_index
+    from output_sinks import DirectorySink
+    from pipeline_profile import PipelineProfile
+    from sofa_deriver import reprocess_sofa_tarfile, flatten_sofa_tarfile
+
+    start = time.time()
+    profile = PipelineProfile()
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    if flatten:
+        output = outdir
+        with DirectorySink(output) as sink:
+            flatten_sofa_tarfile(sofatarfn, libname=libname,
+                                 func_prefix=func_prefix, verbose=False,
+                                 copyrightyear=copyrightyear, profile=profile,
+                                 sink=sink, membercache=membercache)
+    else:
+        output = os.path.join(outdir, libname)
+        with DirectorySink(output) as sink:
+            reprocess_sofa_tarfile(sofatarfn, libname=libname,
+                                   func_prefix=func_prefix, verbose=False,
+                                   copyrightyear=copyrightyear, force=force,
+                                   profile=profile, sink=sink,
+                                   membercache=membercache)
+
+    index = build_index(output, func_prefix)
+    cachestage = profile.stages.get('member cache', {})
+    return {'output': output,
+            'files': len(index['files']),
+            'functions': len(index['functions']),
+            'macros': len(index['macros']),
+            'cached': cachestage.get('files', 0),
+            'seconds': time.time() - start}
+
+
+def derive_releases(sofadir, outroot='releases', libname='erfa',
+                    func_prefix='era', copyrightyear=None, membercache=None,
+                    flatten=False, force=False, jobs=None, verbose=True):
+    """
+    Derives each SOFA release found by `find_sofa_tarfiles` in `sofadir`
+    into ``<outroot>/<version>`` (see `derive_release`), in `jobs` worker
+    processes (one per CPU if None, or none if 1).  The transformed members
+    are shared through `membercache` (by default, ``.member_cache`` in
+    `outroot`).  Returns the summaries, with the ``version`` and ``sofafile``
+    added, in version order.
+    """
+    import datetime
+
+    releases = find_sofa_tarfiles(sofadir)
+    if membercache is None:
+        membercache = os.path.join(outroot, '.member_cache')
+    # the same year for every release, so they can share the cache
+    if copyrightyear is None:
+        copyrightyear = datetime.datetime.now().year
+
+    argtuples = [(fn, os.path.join(outroot, version), libname, func_prefix,
+                  copyrightyear, membercache, flatten, force)
+                 for version, fn in releases]
+    summaries = {}
+
+    def add_summary(version, fn, summary):
+        summary['version'] = version
+        summary['sofafile'] = fn
+        summaries[version] = summary
+        if verbose:
+            print('Derived {0} into {1} in {2:.2f} s'.format(
+                  fn, summary['output'], summary['seconds']))
+
+    if jobs == 1 or len(releases) < 2:
+        for (version, fn), args in zip(releases, argtuples):
+            add_summary(version, fn, derive_release(*args))
+    else:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = dict([(executor.submit(derive_release, *args), release)
+                            for release, args in zip(releases, argtuples)])
+            for future in as_completed(futures):
+                version, fn = futures[future]
+                add_summary(version, fn, future.result())
+
+    return [summaries[version] for version, _ in releases]
+
+
+def format_summary(summaries):
+    """
+    Returns a table of the release `summaries` from `derive_releases`.
+    """
+    lines = ['{0:<12} {1:>6} {2:>10} {3:>7} {4:>7} {5:>9}'.format(
+             'version', 'files', 'functions', 'macros', 'cached', 'seconds')]
+    for summary in summaries:
+        lines.append('{version:<12} {files:>6} {functions:>10} {macros:>7} '
+                     '{cached:>7} {seconds:>9.2f}'.format(**summary))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Derives all the SOFA '
+                                                 'releases in a directory '
+                                                 'concurrently.')
+    parser.add_argument('sofadir', nargs='?', default='.',
+                        help='The directory with the sofa_c-*.tar.gz files.  '
+                             'Defaults to the current directory.')
+    parser.add_argument('--output', '-o', default='releases',
+                        help='The directory to write a directory for each '
+                             'release into.  Defaults to "releases".')
+    parser.add_argument('--member-cache', default=None, metavar='DIR',
+                        help='The directory to share transformed files '
+                             'between releases in.  Defaults to '
+                             '".member_cache" in the output directory.')
+    parser.add_argument('--copyright-year', '-y', default=None,
+                        help='The "current" year for the end of the '
+                             'copyright in each file.  Defaults to the '
+                             'current year.')
+    parser.add_argument('--flatten', default=False, action='store_true',
+                        help='Write the single-file versions of each '
+                             'release instead of a directory of files.')
+    parser.add_argument('--force', '-f', default=False, action='store_true',
+                        help='Rewrite every file, even if the manifest from '
+                             'a previous run says it has not changed.')
+    parser.add_argument('--jobs', '-j', default=0, type=int,
+                        help='The number of releases to derive at once.  0 '
+                             '(the default) means one per CPU.')
+    parser.add_argument('--json', default=None, metavar='FILE',
+                        help='Also write the summary to this JSON file.')
+    parser.add_argument('--quiet', '-q', default=False, action='store_true',
+                        help='Only print the summary.')
+    args = parser.parse_args()
+
+    summaries = derive_releases(args.sofadir, args.output,
+                                copyrightyear=args.copyright_year,
+                                membercache=args.member_cache,
+                                flatten=args.flatten, force=args.force,
+                                jobs=args.jobs or None,
+                                verbose=not args.quiet)
+    if not summaries:
+        print('No sofa_c-*.tar.gz files found in "{0}"'.format(args.sofadir),
+              file=sys.stderr)
+        sys.exit(1)
+
+    if not args.quiet:
+        print()
+    print(format_summary(summaries))
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(summaries, f, indent=1, sort_keys=True)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+"""
+Compares two SOFA-derived libraries (multi-file or flattened) function by
+function, ignoring comments and whitespace, so the license and revision
+changes every new SOFA release brings do not show up.  Lists the functions
+(and macros) that were added, removed or changed, with a unified diff of
+each changed function.  Do::
+
+  python function_diff.py --help
+
+To see the options.
+"""
+
+import os
+import sys
+import json
+import difflib
+import hashlib
+
+import api_index
+import source_parser
+
+def normalize_code(text):
+    """
+    Returns the C code `text` with the comments removed and all whitespace
+    (outside of string literals) collapsed to single spaces.
+    """
+    return ' '.join(source_parser.strip_comments(text).split())
+
+
+def function_units(srcdir, prefix='era', verbose=False):
+    """
+    Returns ``(units, macros)`` for the library in `srcdir`.  `units` maps
+    the name of each function to a dict with its ``file``, its ``text`` (the
+    prototype and the body) and the SHA-256 ``hash`` of the normalized text
+    (see `normalize_code`), and `macros` is as in the index from
+    `api_index.load_index`, which is used to find the functions.
+    """
+    index = api_index.load_index(srcdir, prefix, verbose=verbose)
+
+    contents = {}
+    units = {}
+    for name, func in index['functions'].items():
+        fn = func['file']
+        if fn not in contents:
+            with open(os.path.join(srcdir, fn), 'rb') as f:
+                contents[fn] = f.read().decode('latin-1')
+        start, end = func['body']
+        text = func['prototype'].rstrip(';') + '\n' + contents[fn][start:end]
+        units[name] = {'file': fn, 'text': text,
+                       'hash': hashlib.sha256(normalize_code(text)
+                                              .encode('latin-1')).hexdigest()}
+    return units, index['macros']
+
+
+def diff_libraries(olddir, newdir, prefix='era', context=3, diffs=True,
+                   verbose=False):
+    """
+    Compares the libraries in `olddir` and `newdir`.  Returns a dict with
+    the sorted names of the ``added``, ``removed``, ``changed`` and
+    ``unchanged`` functions, the ``diffs`` of the changed ones (a dict of
+    unified diffs with `context` lines, empty unless `diffs` is True), and
+    the names of the ``added_macros``, ``removed_macros`` and
+    ``changed_macros``.
+    """
+    oldunits, oldmacros = function_units(olddir, prefix, verbose)
+    newunits, newmacros = function_units(newdir, prefix, verbose)
+
+    result = {'added': sorted(set(newunits) - set(oldunits)),
+              'removed': sorted(set(oldunits) - set(newunits)),
+              'changed': [], 'unchanged': [], 'diffs': {}}
+    for name in sorted(set(oldunits) & set(newunits)):
+        old = oldunits[name]
+        new = newunits[name]
+        if old['hash'] == new['hash']:
+            result['unchanged'].append(name)
+            continue
+        result['changed'].append(name)
+        if not diffs:
+            continue
+        result['diffs'][name] = ''.join(difflib.unified_diff(
+            old['text'].splitlines(True), new['text'].splitlines(True),
+            'a/{0}:{1}'.format(old['file'], name),
+            'b/{0}:{1}'.format(new['file'], name), n=context))
+
+    result['added_macros'] = sorted(set(newmacros) - set(oldmacros))
+    result['removed_macros'] = sorted(set(oldmacros) - set(newmacros))
+    result['changed_macros'] = sorted(
+        [name for name in set(oldmacros) & set(newmacros)
+         if oldmacros[name]['value'] != newmacros[name]['value']])
+    return result
+
+
+def format_diff(result, diffs=True):
+    """
+    Returns the comparison `result` from `diff_libraries` as text, with the
+    unified diffs of the changed functions if `diffs` is True.
+    """
+    lines = []
+    for kind in ('added', 'removed', 'changed'):
+        for name in result[kind]:
+            lines.append('{0} function {1}'.format(kind.capitalize(), name))
+        for name in result[kind + '_macros']:
+            lines.append('{0} macro {1}'.format(kind.capitalize(), name))
+    if diffs:
+        for name in result['changed']:
+            lines.append('')
+            lines.append(result['diffs'][name].rstrip('\n'))
+    if lines:
+        lines.append('')
+    lines.append('{0} added, {1} removed, {2} changed and {3} unchanged '
+                 'functions'.format(*[len(result[kind]) for kind in
+                                      ('added', 'removed', 'changed',
+                                       'unchanged')]))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compares the functions in '
+                                                 'two SOFA-derived libraries, '
+                                                 'ignoring comments.')
+    parser.add_argument('olddir', help='The directory with the old library '
+                                       '(source files or flattened ones).')
+    parser.add_argument('newdir', help='The directory with the new library.')
+    parser.add_argument('--func-prefix', default='era',
+                        help='The prefix of the function names.')
+    parser.add_argument('--unified', '-U', default=3, type=int,
+                        help='The number of context lines in the diffs.')
+    parser.add_argument('--brief', '-b', default=False, action='store_true',
+                        help='Only list the differences, without the diffs.')
+    parser.add_argument('--json', default=False, action='store_true',
+                        help='Print the result as JSON.')
+    args = parser.parse_args()
+
+    for dirnm in (args.olddir, args.newdir):
+        if not os.path.isdir(dirnm):
+            print('"{0}" is not a directory'.format(dirnm), file=sys.stderr)
+            sys.exit(2)
+
+    result = diff_libraries(args.olddir, args.newdir, args.func_prefix,
+                            args.unified, diffs=not args.brief)
+    if args.json:
+        if args.brief:
+            del result['diffs']
+        json.dump(result, sys.stdout, indent=1, sort_keys=True)
+        print()
+    else:
+        print(format_diff(result, diffs=not args.brief))
+
+    # like diff, exit with 1 if there are differences
+    if any([result[kind] for kind in ('added', 'removed', 'changed',
+                                      'added_macros', 'removed_macros',
+                                      'changed_macros')]):
+        sys.exit(1)
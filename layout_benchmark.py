@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+"""
+This script measures how well a function ordering profile (see
+``source_flattener.py --order-profile``) packs the hot code of the flattened
+library together, for instruction-cache locality.  The library is flattened
+both in the default (file name) order and in the profiled order, and for the
+hot functions (the profiled ones and everything they call) it reports how
+many cache lines and pages they cover, the span from the first to the last,
+and the mean distance between callers and their callees.  This is done on
+the flattened C source, and on the object code it compiles to (as placed by
+the compiler, read with ``nm``).  Do::
+
+  python layout_benchmark.py --help
+
+To see the options.
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+
+import api_index
+import source_parser
+from output_sinks import MemorySink
+from source_flattener import flatten_source, parse_order_profile
+
+
+def flatten_to_memory(srcdir, libname, orderprofile=None, func_prefix='era'):
+    """
+    Returns the files of the flattened library in `srcdir` (a dict of file
+    names to text), laid out according to `orderprofile` if given.
+    """
+    sink = MemorySink()
+    flatten_source(srcdir, libname, sink=sink, func_prefix=func_prefix,
+                   orderprofile=orderprofile)
+    return sink.files
+
+
+def source_layout(text, func_prefix='era'):
+    """
+    Returns a dict mapping each function defined in the C code `text` to
+    the ``(start, end)`` byte offsets of its body.
+    """
+    parsed = api_index.parse_file(text.encode('utf-8'), func_prefix)
+    return dict([(func['name'], tuple(func['body']))
+                 for func in parsed['functions']])
+
+
+def object_layout(files, libname, cc='cc', cflags=('-O2',), nm='nm'):
+    """
+    Compiles the flattened library `files` (as from `flatten_to_memory`) and
+    returns a dict mapping each function in the object code to its ``(start,
+    end)`` address in it.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for fn, text in files.items():
+            with open(os.path.join(tmpdir, fn), 'w') as f:
+                f.write(text)
+        objfn = os.path.join(tmpdir, libname + '.o')
+        subprocess.check_call([cc] + list(cflags) +
+                              ['-c', '-o', objfn,
+                               os.path.join(tmpdir, libname + '.c')])
+        output = subprocess.check_output([nm, '-S', '--defined-only', objfn])
+    finally:
+        shutil.rmtree(tmpdir)
+
+    layout = {}
+    for l in output.decode('utf-8').splitlines():
+        words = l.split()
+        if len(words) == 4 and words[2] in 'Tt':
+            start = int(words[0], 16)
+            layout[words[3]] = (start, start + int(words[1], 16))
+    return layout
+
+
+def locality(layout, calls, counts, linesize=64, pagesize=4096):
+    """
+    Returns a dict of locality measures for the hot functions in `layout`
+    (mapping function names to ``(start, end)`` offsets): those in the
+    profile `counts` (a list of ``(name, count)`` pairs) and those they
+    call, according to `calls`.  The ``call_distance`` is the mean distance
+    from a hot function to each function it calls, weighted by its count.
+    """
+    roots = [name for name, count in counts if name in calls]
+    hot = sorted([name for name in source_parser.reachable(calls, roots)
+                  if name in layout])
+    countof = dict(counts)
+
+    lines = set()
+    pages = set()
+    for name in hot:
+        start, end = layout[name]
+        lines.update(range(start // linesize, (end - 1) // linesize + 1))
+        pages.update(range(start // pagesize, (end - 1) // pagesize + 1))
+
+    distance = weight = 0
+    for name in hot:
+        for callee in calls[name]:
+            if callee in layout:
+                w = max(countof.get(name, 0), 1)
+                distance += w * abs(layout[callee][0] - layout[name][0])
+                weight += w
+
+    return {'functions': len(hot),
+            'bytes': sum([layout[name][1] - layout[name][0]
+                          for name in hot]),
+            'span': (max([layout[name][1] for name in hot]) -
+                     min([layout[name][0] for name in hot])) if hot else 0,
+            'cache_lines': len(lines),
+            'pages': len(pages),
+            'call_distance': float(distance) / weight if weight else 0.}
+
+
+def benchmark_layout(srcdir, orderprofile, libname=None, func_prefix='era',
+                     cc='cc', cflags=('-O2',), compile=True, linesize=64,
+                     pagesize=4096):
+    """
+    Flattens the library in `srcdir` in the default order and according to
+    `orderprofile`, and returns a list of dicts with the `locality` of each
+    (``order`` is ``'default'`` or ``'profile'``) in the C source and, if
+    `compile`, in the object code (``layout`` is ``'source'`` or
+    ``'object'``).
+    """
+    if libname is None:
+        libname = os.path.basename(os.path.abspath(srcdir))
+    index = api_index.load_index(srcdir, func_prefix)
+    calls = api_index.call_graph(index)[1]
+
+    results = []
+    for order, profile in (('default', None), ('profile', orderprofile)):
+        files = flatten_to_memory(srcdir, libname, profile, func_prefix)
+        layouts = [('source', source_layout(files[libname + '.c'],
+                                            func_prefix))]
+        if compile:
+            layouts.append(('object', object_layout(files, libname, cc,
+                                                    cflags)))
+        for kind, layout in layouts:
+            result = locality(layout, calls, orderprofile, linesize,
+                              pagesize)
+            result['order'] = order
+            result['layout'] = kind
+            results.append(result)
+    return results
+
+
+def format_results(results):
+    """
+    Returns a table comparing the default and profiled layouts in the
+    `results` from `benchmark_layout`.
+    """
+    lines = ['{0:<8}{1:<15}{2:>12}{3:>12}{4:>9}'.format(
+             'layout', 'measure', 'default', 'profile', 'ratio')]
+    for kind in ('source', 'object'):
+        byorder = dict([(r['order'], r) for r in results
+                        if r['layout'] == kind])
+        if not byorder:
+            continue
+        for measure in ('functions', 'bytes', 'span', 'cache_lines', 'pages',
+                        'call_distance'):
+            old = byorder['default'][measure]
+            new = byorder['profile'][measure]
+            lines.append('{0:<8}{1:<15}{2:>12.0f}{3:>12.0f}{4:>9}'.format(
+                         kind, measure, old, new,
+                         '{0:.3f}'.format(float(new) / old) if old else '-'))
+    return '\n'.join(lines)
+
+
+def check_results(results):
+    """
+    Returns the layouts (``'source'`` or ``'object'``) in the `results` from
+    `benchmark_layout` where the profiled order has a longer
+    ``call_distance`` than the default order.
+    """
+    worse = []
+    for kind in ('source', 'object'):
+        byorder = dict([(r['order'], r) for r in results
+                        if r['layout'] == kind])
+        if byorder and (byorder['profile']['call_distance'] >
+                        byorder['default']['call_distance']):
+            worse.append(kind)
+    return worse
+
+
+if __name__ == '__main__':
+    import shlex
+    import argparse
+
+    from sofa_deriver import find_sourcedir
+
+    parser = argparse.ArgumentParser(description='Measures the code locality '
+                                                 'of the hot functions of a '
+                                                 'flattened library with and '
+                                                 'without a function ordering '
+                                                 'profile.')
+    parser.add_argument('srcdir', nargs='?', default=None, help='The '
+                        'directory with the (multi-file) source code.  If not '
+                        'given, one that looks SOFA-derived is searched for.')
+    parser.add_argument('--order-profile', required=True,
+                        help='The profile, as for source_flattener.py: a '
+                             'microbench.py JSON output, a JSON object of '
+                             'call counts, a file with one function per '
+                             'line, or a comma-separated list of functions.')
+    parser.add_argument('--libname', '-n', default=None,
+                        help='The name of the library.  Defaults to the '
+                             'name of srcdir.')
+    parser.add_argument('--func-prefix', default='era',
+                        help='The prefix of the library\'s function names.')
+    parser.add_argument('--cc', default=os.environ.get('CC', 'cc'),
+                        help='The C compiler (defaults to $CC or cc).')
+    parser.add_argument('--cflags', default=os.environ.get('CFLAGS', '-O2'),
+                        help='Flags for the C compiler (defaults to $CFLAGS '
+                             'or -O2).')
+    parser.add_argument('--no-compile', default=False, action='store_true',
+                        help='Only measure the layout of the C source.')
+    parser.add_argument('--line-size', default=64, type=int,
+                        help='The cache line size in bytes.')
+    parser.add_argument('--page-size', default=4096, type=int,
+                        help='The page size in bytes.')
+    parser.add_argument('--output', '-o', default=None, metavar='JSONFILE',
+                        help='Also write the results to this file.')
+    parser.add_argument('--check', default=False, action='store_true',
+                        help='Exit with status 1 if the profiled order has '
+                             'a longer call distance than the default one.')
+    args = parser.parse_args()
+
+    srcdir = args.srcdir if args.srcdir is not None else find_sourcedir()
+    results = benchmark_layout(srcdir, parse_order_profile(args.order_profile),
+                               args.libname,
+                               args.func_prefix, args.cc,
+                               shlex.split(args.cflags),
+                               compile=not args.no_compile,
+                               linesize=args.line_size,
+                               pagesize=args.page_size)
+    print(format_results(results))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.check:
+        worse = check_results(results)
+        if worse:
+            print('The profile makes the call distance worse in the ' +
+                  ' and '.join(worse))
+            sys.exit(1)
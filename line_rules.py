@@ -0,0 +1,145 @@
+from __future__ import print_function
+
+"""
+A small rule engine for line-by-line source transformations, as used by
+`sofa_deriver` to turn the SOFA files into ERFA ones.  A `LineRuleSet` is a
+set of named states, each with an ordered list of `LineRule` triggers and a
+default rule for the lines that match none of them.  The triggers of each
+state are compiled into one regular expression, so the lines between two
+triggered lines are found, and transformed, as one block of text.
+"""
+
+import re
+
+# splits text into lines, keeping the newlines (unlike str.splitlines, only
+# on '\n', like iterating over a binary file)
+_LINE_RE = re.compile(r'[^\n]*\n|[^\n]+')
+
+
+class LineRule(object):
+    """
+    A rule that applies to the lines starting with `prefix`, containing
+    `contains` and/or equal to `stripped` once stripped of whitespace (any
+    that are given must all hold).  A rule without any of these is only
+    useful as the default rule of a state.
+
+    The line is replaced by `text` if given, dropped if `drop` is True, or
+    else passed through each function in `subs` in turn.  If `unemit` is
+    given and the previous output line is that once stripped, it is removed.
+    Then the rule set switches to the state `goto` (if given), or stops if
+    `stop` is True.  If `once` is given, the rule only applies to the first
+    line it matches, along with any other rules with the same `once` name.
+    """
+    def __init__(self, prefix=None, contains=None, stripped=None, subs=(),
+                 text=None, drop=False, unemit=None, goto=None, stop=False,
+                 once=None):
+        self.prefix = prefix
+        self.contains = contains
+        self.stripped = stripped
+        self.subs = tuple(subs)
+        self.text = text
+        self.drop = drop
+        self.unemit = unemit
+        self.goto = goto
+        self.stop = stop
+        self.once = once
+
+    def pattern(self):
+        """
+        Returns the regular expression for the lines the rule applies to,
+        matching from the start of the line (in `re.MULTILINE` mode).
+        """
+        pattern = ''
+        if self.contains is not None:
+            pattern += r'(?=[^\n]*?' + re.escape(self.contains) + ')'
+        if self.stripped is not None:
+            pattern += (r'(?=[^\S\n]*' + re.escape(self.stripped) +
+                        r'[^\S\n]*$)')
+        if self.prefix is not None:
+            pattern += re.escape(self.prefix)
+        return pattern
+
+    def transform(self, text):
+        """
+        Returns `text` (one line or several) passed through `subs`.
+        """
+        for sub in self.subs:
+            text = sub(text)
+        return text
+
+
+class LineRuleSet(object):
+    """
+    Transforms text according to `states`, a dict mapping each state name to
+    ``(rules, default)``, where `rules` is a list of `LineRule` in order of
+    priority and `default` is the `LineRule` for the other lines.  Starts in
+    the state `initial`.
+    """
+    def __init__(self, states, initial):
+        self.states = states
+        self.initial = initial
+        # (state, used once names) -> (regexes or None, rules, default)
+        self._tables = {}
+
+    def _table(self, state, used):
+        key = (state, used)
+        if key not in self._tables:
+            rules, default = self.states[state]
+            rules = [rule for rule in rules if rule.once not in used]
+            regexes = None
+            if rules:
+                pattern = '(?:' + '|'.join(
+                    ['(?P<r{0}>{1})'.format(i, rule.pattern())
+                     for i, rule in enumerate(rules)]) + ')'
+                # one for a line starting where the search starts, and one
+                # to find the next line after that.  Starting the latter with
+                # a newline (rather than ^) lets the regex engine skip
+                # straight from one line to the next
+                regexes = (re.compile(pattern, re.MULTILINE),
+                           re.compile('\n' + pattern, re.MULTILINE))
+            self._tables[key] = regexes, rules, default
+        return self._tables[key]
+
+    def apply(self, text):
+        """
+        Returns the list of output lines (or, for rules with a `text`, those
+        texts) for `text`.
+        """
+        outlns = []
+        state = self.initial
+        used = frozenset()
+        pos = 0
+        while pos < len(text):
+            regexes, rules, default = self._table(state, used)
+            match = None if regexes is None else regexes[0].match(text, pos)
+            if match is not None:
+                end = pos
+            else:
+                if regexes is not None:
+                    match = regexes[1].search(text, pos)
+                # the triggered line starts after the newline
+                end = len(text) if match is None else match.start() + 1
+
+            # every line up to the next triggered one gets the default rule,
+            # all at once (none of the substitutions span lines)
+            if end > pos and not default.drop:
+                outlns.extend(_LINE_RE.findall(default.transform(
+                    text[pos:end])))
+            if match is None:
+                break
+
+            rule = rules[int(match.lastgroup[1:])]
+            pos = text.find('\n', end) + 1 or len(text)
+            if rule.unemit is not None and outlns[-1].strip() == rule.unemit:
+                del outlns[-1]
+            if rule.text is not None:
+                outlns.append(rule.text)
+            elif not rule.drop:
+                outlns.append(rule.transform(text[end:pos]))
+            if rule.once is not None:
+                used = used | frozenset([rule.once])
+            if rule.stop:
+                break
+            if rule.goto is not None:
+                state = rule.goto
+        return outlns
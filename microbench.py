@@ -0,0 +1,438 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+"""
+This script generates, compiles and runs a C program that measures the time
+per call of every function of a SOFA-derived library, and writes the results
+to JSON so releases and compiler flags can be compared.  Do::
+
+  python microbench.py --help
+
+To see the options.
+
+Each function is timed with the arguments its test in the test program sets
+up (everything in the test before the first call of the function), calling
+it in a loop whose length is calibrated to run for at least ``--min-time``
+seconds.  Where the test passes the result straight to a checker, as in
+``vvd(eraAnp(-0.1), ...)``, only the call is timed, not the check.  Functions without a usable test but with simple arguments (numbers,
+arrays of numbers and strings) are timed with synthetic arguments instead,
+and are marked as such in the results.  Functions that write their results
+back into their inputs are timed on those changing inputs.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import subprocess
+
+import source_parser
+
+
+BENCH_PRELUDE = """#define _POSIX_C_SOURCE 199309L
+#include <time.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+"""
+
+BENCH_HELPERS = """
+static double bench_now(void)
+{
+   struct timespec ts;
+
+   clock_gettime(CLOCK_MONOTONIC, &ts);
+   return ts.tv_sec + 1e-9 * ts.tv_nsec;
+}
+
+static void bench_fill(double *a, size_t n)
+{
+   size_t i;
+
+   for (i = 0; i < n; i++) a[i] = 0.5 + 0.1 * (i % 7);
+}
+"""
+
+BENCH_MAIN_TEMPL = """
+static const struct {{
+   const char *name;
+   const char *fixture;
+   double (*func)(long, int *);
+}} benchmarks[] = {{
+{table}
+}};
+
+int main(int argc, char *argv[])
+/*
+**  Usage: bench MINTIME REPEATS [FUNCTION ...]
+**
+**  Prints a JSON list with, for each function (or just those named), the
+**  number of calls per timed loop and the seconds taken by each of the
+**  REPEATS loops.  The number of calls is doubled until a loop takes at
+**  least MINTIME seconds.
+*/
+{{
+   int status, i, j, k, first;
+   long n;
+   double mintime, t;
+   int repeats;
+   const int nbench = (int) (sizeof benchmarks / sizeof benchmarks[0]);
+
+   if (argc < 3) {{
+      printf("usage: %s MINTIME REPEATS [FUNCTION ...]\\n", argv[0]);
+      return 2;
+   }}
+   mintime = atof(argv[1]);
+   repeats = atoi(argv[2]);
+
+   status = 0;
+   first = 1;
+   printf("[");
+   for (j = 0; j < nbench; j++) {{
+      int wanted = argc == 3;
+      for (i = 3; i < argc && !wanted; i++) {{
+         wanted = !strcmp(argv[i], benchmarks[j].name);
+      }}
+      if (!wanted) continue;
+
+      n = 1;
+      while (benchmarks[j].func(n, &status) < mintime && n < (1L << 40)) {{
+         n *= 2;
+      }}
+
+      printf("%s\\n {{\\"name\\": \\"%s\\", \\"fixture\\": \\"%s\\", "
+             "\\"iterations\\": %ld, \\"seconds\\": [",
+             first ? "" : ",", benchmarks[j].name, benchmarks[j].fixture, n);
+      for (k = 0; k < repeats; k++) {{
+         t = benchmarks[j].func(n, &status);
+         printf("%s%.9g", k ? ", " : "", t);
+      }}
+      printf("]}}");
+      fflush(stdout);
+      first = 0;
+   }}
+   printf("\\n]\\n");
+   return 0;
+}}
+"""
+
+_PARAM_RE = re.compile(r'^(?:const\s+)?(double|int|char)\s*(\*?)\s*(\w+)\s*'
+                       r'((?:\[\s*\d*\s*\])*)$')
+
+
+def _function_name(testname, prefix):
+    # t_jd2cal -> eraJd2cal
+    return prefix + testname[2].upper() + testname[3:]
+
+
+_CHECKER_RE = re.compile(r'^\s*(?:vvd|viv)\s*\(')
+
+
+def _loop_lines(setuplines, calllines, benchname, sink=False):
+    lines = ['static double {0}(long n, int *status)\n'.format(benchname),
+             '{\n',
+             '   long bench_i_;\n',
+             '   double bench_t0_;\n']
+    if sink:
+        # so the result of a call that is only stored here isn't optimised out
+        lines.append('   volatile double bench_sink_;\n')
+    lines.extend(setuplines)
+    lines.append('   bench_t0_ = bench_now();\n')
+    lines.append('   for (bench_i_ = 0; bench_i_ < n; bench_i_++) {\n')
+    lines.extend(['   ' + l for l in calllines])
+    lines.append('   }\n')
+    if sink:
+        lines.append('   (void) bench_sink_;\n')
+    lines.append('   return bench_now() - bench_t0_;\n')
+    lines.append('}\n\n')
+    return lines
+
+
+def _closing_paren(code, start):
+    # the index of the parenthesis closing the one at code[start]
+    depth = 0
+    for i in range(start, len(code)):
+        if code[i] == '(':
+            depth += 1
+        elif code[i] == ')':
+            depth -= 1
+            if not depth:
+                return i
+    return None
+
+
+def bench_from_test(funcname, testlines, benchname):
+    """
+    Turns the lines of the test function `testlines` into the lines of a
+    benchmark function `benchname` that runs the test's setup once and then
+    times a loop over the first statement calling `funcname`.  If that
+    statement checks the result with ``vvd`` or ``viv``, only the call of
+    `funcname` is timed, stored in a volatile variable, and the check is
+    left out.  Returns None if there is no such statement at the top level
+    of the test.
+    """
+    text = ''.join(testlines)
+    codelines = source_parser.blank_comments_and_strings(text).splitlines(True)
+    lines = text.splitlines(True)
+
+    callre = re.compile(r'\b' + re.escape(funcname) + r'\s*\(')
+    body = None
+    depth = 0
+    for i, code in enumerate(codelines):
+        if body is None:
+            if '{' in code:
+                body = i + 1
+                depth = code.count('{') - code.count('}')
+            continue
+        if depth == 1 and callre.search(code):
+            end = i
+            while not codelines[end].rstrip().endswith(';'):
+                end += 1
+                if end == len(codelines):
+                    return None
+            code = ''.join(codelines[i:end + 1])
+            if _CHECKER_RE.match(code):
+                start = callre.search(code).start()
+                close = _closing_paren(code, code.index('(', start))
+                if close is None:
+                    return None
+                stmt = ''.join(lines[i:end + 1])
+                call = '   bench_sink_ = {0};\n'.format(stmt[start:close + 1])
+                return _loop_lines(lines[body:i], [call], benchname, True)
+            return _loop_lines(lines[body:i], lines[i:end + 1], benchname)
+        depth += code.count('{') - code.count('}')
+    return None
+
+
+def bench_from_prototype(funcname, protolines, benchname):
+    """
+    Returns the lines of a benchmark function `benchname` that calls
+    `funcname` with synthetic arguments, based on its prototype
+    `protolines`, or None if it has arguments of types this can't make up.
+    """
+    code = source_parser.blank_comments_and_strings(''.join(protolines))
+    match = re.search(r'\((.*)\)', code, re.DOTALL)
+    if match is None:
+        return None
+    params = [p.strip() for p in match.group(1).split(',')]
+    if params == ['void']:
+        params = []
+
+    decls = []
+    setup = []
+    args = []
+    for i, param in enumerate(params):
+        pmatch = _PARAM_RE.match(' '.join(param.split()))
+        if pmatch is None:
+            return None
+        ctype, pointer, _, dims = pmatch.groups()
+        argnm = 'a{0}'.format(i)
+        dims = re.sub(r'\[\s*\]', '[16]', dims.replace(' ', ''))
+        if pointer:
+            dims = '[64]' if ctype == 'char' else '[16]'
+        if not dims:
+            decls.append('   {0} {1} = {2};\n'.format(ctype, argnm,
+                                                     '0.5' if ctype == 'double'
+                                                     else '1'))
+        else:
+            decls.append('   {0} {1}{2};\n'.format(ctype, argnm, dims))
+            if ctype == 'double':
+                setup.append('   bench_fill((double *) {0}, sizeof {0} / '
+                             'sizeof(double));\n'.format(argnm))
+            else:
+                setup.append('   memset({0}, 0, sizeof {0});\n'.format(argnm))
+        args.append(argnm)
+
+    call = '   (void) {0}({1});\n'.format(funcname, ', '.join(args))
+    return _loop_lines(decls + ['\n'] + setup, [call], benchname)
+
+
+def make_benchmark(testlines, headerlines, prefix='era'):
+    """
+    Generates the benchmark program from the lines of the test program
+    `testlines` and of the library header `headerlines`.
+
+    Returns ``(source, fixtures)``, where `fixtures` maps each function
+    benchmarked to ``'test'`` or ``'synthetic'`` (where its arguments came
+    from), and ``None`` for each function that could not be benchmarked.
+    """
+    prelude = []
+    benchlines = []
+    fixtures = {}
+    order = []
+    inmain = False
+    for name, lines in source_parser.iter_test_functions(testlines):
+        if name is not None:
+            funcname = _function_name(name, prefix)
+            benchname = 'bench_' + name[2:]
+            bench = bench_from_test(funcname, lines, benchname)
+            if bench is not None and funcname not in fixtures:
+                benchlines.extend(bench)
+                fixtures[funcname] = 'test'
+                order.append((funcname, benchname))
+            continue
+        for l in lines:
+            if inmain:
+                inmain = not l.startswith('}')
+            elif re.match(r'^int\s+main\s*\(', l):
+                inmain = True
+            else:
+                prelude.append(l)
+
+    for name, lines in source_parser.iter_prototypes(headerlines, prefix):
+        if name is None or name in fixtures:
+            continue
+        benchname = 'bench_proto_' + name[len(prefix):].lower()
+        bench = bench_from_prototype(name, lines, benchname)
+        if bench is None:
+            fixtures[name] = None
+        else:
+            benchlines.extend(bench)
+            fixtures[name] = 'synthetic'
+            order.append((name, benchname))
+
+    table = ',\n'.join(['   {{"{0}", "{1}", {2}}}'.format(funcname,
+                                                         fixtures[funcname],
+                                                         benchname)
+                        for funcname, benchname in sorted(order)])
+    source = (BENCH_PRELUDE + ''.join(prelude) + BENCH_HELPERS + '\n' +
+              ''.join(benchlines) + BENCH_MAIN_TEMPL.format(table=table))
+    return source, fixtures
+
+
+def _find_header(srcdir, libname):
+    headerfn = os.path.join(srcdir, libname + '.h')
+    if not os.path.isfile(headerfn):
+        raise ValueError('No header {0} in {1}'.format(libname + '.h', srcdir))
+    return headerfn
+
+
+def run_benchmark(srcdir, builddir='build', functions=None, mintime=0.02,
+                  repeats=5, cc='cc', cflags=('-O2',), libname=None,
+                  prefix='era', verbose=True):
+    """
+    Builds the library in `srcdir` (with `cached_build.build_library`) and
+    the benchmark program for it in `builddir`, runs it for `functions` (or
+    all of them if None), and returns the results as a dict.
+    """
+    from cached_build import build_library, compiler_id
+    from parallel_tests import find_test_file
+
+    if libname is None:
+        libname = os.path.basename(os.path.abspath(srcdir))
+    testfn = find_test_file(srcdir)
+    with open(testfn) as testf, \
+            open(_find_header(srcdir, libname)) as headerf:
+        source, fixtures = make_benchmark(testf, headerf, prefix)
+
+    build_library(srcdir, builddir, libname, cc=cc, cflags=cflags,
+                  testfn=testfn, verbose=verbose)
+    benchsrcfn = os.path.join(builddir, 'bench_{0}.c'.format(libname))
+    with open(benchsrcfn, 'w') as f:
+        f.write(source)
+    exefn = os.path.join(builddir, 'bench_' + libname)
+    if verbose:
+        print('Linking', exefn)
+    subprocess.check_call([cc] + list(cflags) +
+                          ['-I' + srcdir, '-o', exefn, benchsrcfn,
+                           os.path.join(builddir, 'lib{0}.a'.format(libname)),
+                           '-lm'])
+
+    if verbose:
+        print('Running', exefn)
+    output = subprocess.check_output([exefn, repr(mintime), str(repeats)] +
+                                     list(functions or []))
+    results = json.loads(output.decode('utf-8'))
+    for result in results:
+        times = sorted(result['seconds'])
+        result['ns_per_call'] = 1e9 * times[0] / result['iterations']
+        result['median_ns_per_call'] = (1e9 * times[len(times) // 2] /
+                                        result['iterations'])
+
+    return {'cc': cc, 'cflags': list(cflags), 'compiler': compiler_id(cc),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'min_time': mintime, 'repeats': repeats,
+            'not_benchmarked': sorted([name for name, fixture
+                                       in fixtures.items()
+                                       if fixture is None]),
+            'results': results}
+
+
+def compare_results(old, new):
+    """
+    Returns a table comparing the ns/call of the functions in two results
+    dicts from `run_benchmark`.
+    """
+    oldns = dict([(r['name'], r['ns_per_call']) for r in old['results']])
+    lines = ['{0:<16}{1:>12}{2:>12}{3:>9}'.format('function', 'old ns',
+                                                  'new ns', 'ratio')]
+    for result in new['results']:
+        name = result['name']
+        if name in oldns:
+            lines.append('{0:<16}{1:>12.1f}{2:>12.1f}{3:>9.3f}'.format(
+                         name, oldns[name], result['ns_per_call'],
+                         result['ns_per_call'] / oldns[name]))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import shlex
+    import argparse
+
+    from sofa_deriver import find_sourcedir
+
+    parser = argparse.ArgumentParser(description='Measures the time per '
+                                                 'call of the functions of '
+                                                 'a SOFA-derived library.')
+    parser.add_argument('srcdir', nargs='?', default=None, help='The '
+                        'directory with the source code (multi-file or '
+                        'flattened).  If not given, one that looks '
+                        'SOFA-derived is searched for.')
+    parser.add_argument('functions', nargs='*', help='The functions to '
+                        'benchmark (e.g. eraPnm06a).  Defaults to all of '
+                        'them.')
+    parser.add_argument('--build-dir', '-b', default='build',
+                        help='Where to build the library and benchmark.')
+    parser.add_argument('--libname', '-l', default=None,
+                        help='The name of the library.  Defaults to the '
+                             'name of srcdir.')
+    parser.add_argument('--cc', default=os.environ.get('CC', 'cc'),
+                        help='The C compiler (defaults to $CC or cc).')
+    parser.add_argument('--cflags', default=os.environ.get('CFLAGS', '-O2'),
+                        help='Flags for the C compiler (defaults to $CFLAGS '
+                             'or -O2).')
+    parser.add_argument('--min-time', default=0.02, type=float,
+                        help='The minimum seconds for each timed loop.')
+    parser.add_argument('--repeats', '-r', default=5, type=int,
+                        help='How many times to time each function.')
+    parser.add_argument('--output', '-o', default=None, metavar='JSONFILE',
+                        help='Write the results to this file.')
+    parser.add_argument('--compare', default=None, metavar='JSONFILE',
+                        help='Compare the results to an earlier output '
+                             'file.')
+    parser.add_argument('--quiet', '-q', default=False, action='store_true',
+                        help='Print less info to the terminal.')
+    args = parser.parse_intermixed_args()
+
+    srcdir = args.srcdir if args.srcdir is not None else find_sourcedir()
+
+    results = run_benchmark(srcdir, args.build_dir, args.functions,
+                            args.min_time, args.repeats, args.cc,
+                            shlex.split(args.cflags), args.libname,
+                            verbose=not args.quiet)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare_results(json.load(f), results))
+    elif not args.quiet:
+        for result in results['results']:
+            print('{name:<16}{ns_per_call:>12.1f} ns/call  ({fixture})'
+                  ''.format(**result))
+        if results['not_benchmarked']:
+            print('Not benchmarked: ' + ', '.join(results['not_benchmarked']),
+                  file=sys.stderr)
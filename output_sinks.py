@@ -0,0 +1,208 @@
+from __future__ import print_function
+
+"""
+Output sinks for the files generated by `sofa_deriver` and
+`source_flattener`.  A sink takes (file name, text) pairs and puts them
+somewhere: a directory (the default), a .tar.gz or .zip archive, or a dict
+in memory.
+"""
+
+import os
+import io
+import time
+import shutil
+import tempfile
+
+
+class OutputSink(object):
+    """
+    Base class for sinks.
+
+    ``persistent`` is True if what is already in the sink can be read back
+    with `read`, so that unchanged files can be left alone rather than
+    written again.
+    """
+    persistent = False
+
+    def describe(self, fn):
+        """
+        Returns a human-readable location for the file `fn`.
+        """
+        raise NotImplementedError
+
+    def read(self, fn):
+        """
+        Returns the existing text of the file `fn`, or None if there isn't
+        one.
+        """
+        return None
+
+    def open(self, fn):
+        """
+        Returns a writable text file object for the file `fn`.  The file is
+        stored in the sink when the file object is closed.
+        """
+        raise NotImplementedError
+
+    def write(self, fn, contents):
+        """
+        Stores the text `contents` as the file `fn`.
+        """
+        with self.open(fn) as f:
+            f.write(contents)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class DirectorySink(OutputSink):
+    """
+    Writes each file into the directory `dirnm`, creating it if needed.
+    """
+    persistent = True
+
+    def __init__(self, dirnm, verbose=False):
+        self.dirnm = os.path.abspath(dirnm)
+        if not os.path.isdir(self.dirnm):
+            if verbose:
+                print('Making directory', self.dirnm)
+            os.mkdir(self.dirnm)
+
+    def describe(self, fn):
+        return os.path.join(self.dirnm, fn)
+
+    def read(self, fn):
+        fullfn = os.path.join(self.dirnm, fn)
+        if not os.path.isfile(fullfn):
+            return None
+        with open(fullfn) as f:
+            return f.read()
+
+    def open(self, fn):
+        return open(os.path.join(self.dirnm, fn), 'w')
+
+
+class MemorySink(OutputSink):
+    """
+    Keeps the files in the dict ``files``, mapping file names to text.
+    """
+    def __init__(self):
+        self.files = {}
+
+    def describe(self, fn):
+        return '<memory>:' + fn
+
+    def read(self, fn):
+        return self.files.get(fn)
+
+    def open(self, fn):
+        def store(buffer):
+            self.files[fn] = buffer.read().decode('utf-8')
+        return _StoredFile(io.BytesIO(), store)
+
+
+class TarSink(OutputSink):
+    """
+    Writes the files into a new tar file `tarfn` (compressed according to its
+    extension, e.g. ``.tar.gz``), inside the directory `arcdir` in the
+    archive.
+    """
+    def __init__(self, tarfn, arcdir=''):
+        import tarfile
+
+        self.tarfn = tarfn
+        self.arcdir = arcdir
+        mode = 'w'
+        for ext in ('gz', 'bz2', 'xz'):
+            if tarfn.endswith('.' + ext) or tarfn.endswith('.t' + ext):
+                mode = 'w:' + ext
+        self._tf = tarfile.open(tarfn, mode)
+
+    def describe(self, fn):
+        return '{0}:{1}'.format(self.tarfn, _arcname(self.arcdir, fn))
+
+    def open(self, fn):
+        import tarfile
+
+        # the tar header needs the size, so spool the file to disk first
+        def store(buffer):
+            ti = tarfile.TarInfo(_arcname(self.arcdir, fn))
+            ti.size = os.fstat(buffer.fileno()).st_size
+            ti.mtime = time.time()
+            ti.mode = 0o644
+            self._tf.addfile(ti, buffer)
+        return _StoredFile(tempfile.TemporaryFile(), store)
+
+    def close(self):
+        self._tf.close()
+
+
+class ZipSink(OutputSink):
+    """
+    Writes the files into a new zip file `zipfn`, inside the directory
+    `arcdir` in the archive.
+    """
+    def __init__(self, zipfn, arcdir=''):
+        import zipfile
+
+        self.zipfn = zipfn
+        self.arcdir = arcdir
+        self._zf = zipfile.ZipFile(zipfn, 'w', zipfile.ZIP_DEFLATED)
+
+    def describe(self, fn):
+        return '{0}:{1}'.format(self.zipfn, _arcname(self.arcdir, fn))
+
+    def open(self, fn):
+        def store(buffer):
+            with self._zf.open(_arcname(self.arcdir, fn), 'w') as zw:
+                shutil.copyfileobj(buffer, zw)
+        return _StoredFile(tempfile.TemporaryFile(), store)
+
+    def close(self):
+        self._zf.close()
+
+
+class _StoredFile(io.TextIOWrapper):
+    """
+    A UTF-8 text file over the binary `buffer` that, when closed, rewinds the
+    buffer and passes it to `store`.
+    """
+    def __init__(self, buffer, store):
+        io.TextIOWrapper.__init__(self, buffer, encoding='utf-8', newline='\n')
+        self._store = store
+
+    def close(self):
+        if not self.closed:
+            self.flush()
+            self.buffer.seek(0)
+            self._store(self.buffer)
+        io.TextIOWrapper.close(self)
+
+
+def _arcname(arcdir, fn):
+    if arcdir:
+        return arcdir.rstrip('/') + '/' + fn
+    else:
+        return fn
+
+
+def open_sink(path, arcdir='', verbose=False):
+    """
+    Returns a sink for `path` based on its extension: a `TarSink` for tar
+    files, a `ZipSink` for .zip files, or otherwise a `DirectorySink`.
+    `arcdir` is the directory inside an archive to put the files in.
+    """
+    lpath = path.lower()
+    if lpath.endswith('.zip'):
+        return ZipSink(path, arcdir)
+    for ext in ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz',
+                '.txz'):
+        if lpath.endswith(ext):
+            return TarSink(path, arcdir)
+    return DirectorySink(path, verbose)
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+"""
+This script compiles the tests of a SOFA-derived library and runs each test
+function as a separate process, in parallel, reporting which tests failed
+and how long each one took.
+
+It works by turning the test program (e.g. ``t_erfa_c.c``) into a harness
+whose ``main`` runs only the tests named on its command line.  Do::
+
+  python parallel_tests.py --help
+
+To see the options.
+"""
+
+import os
+import re
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+import source_parser
+
+
+HARNESS_MAIN_TEMPL = """
+static const struct {{
+   const char *name;
+   void (*func)(int *);
+}} tests[] = {{
+{table}
+}};
+
+int main(int argc, char *argv[])
+/*
+**  Runs the tests named on the command line (or all of them if none are),
+**  with --verbose to report passes as well as failures, or with --list to
+**  print the names of the tests.
+*/
+{{
+   int status, i, j, nnames;
+   const int ntests = (int) (sizeof tests / sizeof tests[0]);
+
+   status = 0;
+   nnames = 0;
+   for (i = 1; i < argc; i++) {{
+      if (!strcmp(argv[i], "--verbose")) {{
+         verbose = 1;
+      }} else if (!strcmp(argv[i], "--list")) {{
+         for (j = 0; j < ntests; j++) printf("%s\\n", tests[j].name);
+         return 0;
+      }} else {{
+         nnames++;
+      }}
+   }}
+
+   for (j = 0; j < ntests; j++) {{
+      int wanted = !nnames;
+      for (i = 1; i < argc && !wanted; i++) {{
+         wanted = !strcmp(argv[i], tests[j].name);
+      }}
+      if (wanted) tests[j].func(&status);
+   }}
+
+   for (i = 1; i < argc; i++) {{
+      int found = !strcmp(argv[i], "--verbose");
+      for (j = 0; j < ntests && !found; j++) {{
+         found = !strcmp(argv[i], tests[j].name);
+      }}
+      if (!found) {{
+         printf("unknown test %s\\n", argv[i]);
+         status = 1;
+      }}
+   }}
+
+   if (status) {{
+      printf("{progname} validation failed!\\n");
+   }} else {{
+      printf("{progname} validation successful\\n");
+   }}
+   return status;
+}}
+"""
+
+
+def make_test_harness(lines, progname='test'):
+    """
+    Takes the `lines` of a SOFA-style test program and returns the source
+    code of a version whose ``main`` runs only the tests named on the command
+    line, and the list of test names (in the order the original ran them).
+    """
+    out = []
+    testnames = []
+    inmain = False
+    for l in lines:
+        if inmain:
+            match = source_parser.TEST_CALL_RE.match(l)
+            if match:
+                testnames.append(match.group(1))
+            if l.startswith('}'):
+                inmain = False
+        elif re.match(r'^int\s+main\s*\(', l):
+            inmain = True
+        else:
+            out.append(l)
+
+    if not testnames:
+        raise ValueError('Did not find any tests run from main()')
+
+    table = ',\n'.join(['   {{"{0}", {0}}}'.format(name)
+                        for name in testnames])
+    out.append('#include <string.h>\n')
+    out.append(HARNESS_MAIN_TEMPL.format(table=table, progname=progname))
+    return ''.join(out), testnames
+
+
+def find_test_file(srcdir):
+    """
+    Returns the test program in `srcdir` (``t_<lib>_c.c`` or
+    ``test_<lib>.c``).
+    """
+    for fn in sorted(os.listdir(srcdir)):
+        if re.match(r't_.*?_c\.c$', fn) or re.match(r'test_.*\.c$', fn):
+            return os.path.join(srcdir, fn)
+    raise ValueError('No test program found in ' + srcdir)
+
+
+def build_harness(srcdir, builddir, testfn=None, cc='cc', cflags=('-O1',),
+                  verbose=False):
+    """
+    Compiles the library in `srcdir` and the harness made from its test
+    program `testfn` (found automatically if not given) into `builddir`.
+    Returns the path of the harness executable and the list of test names.
+    """
+    if testfn is None:
+        testfn = find_test_file(srcdir)
+    with open(testfn) as f:
+        progname = os.path.basename(testfn)[:-2]
+        harness, testnames = make_test_harness(f, progname)
+
+    harnessfn = os.path.join(builddir, progname + '_harness.c')
+    with open(harnessfn, 'w') as f:
+        f.write(harness)
+
+    libfns = [os.path.join(srcdir, fn) for fn in sorted(os.listdir(srcdir))
+              if fn.endswith('.c') and
+              os.path.join(srcdir, fn) != testfn]
+    exefn = os.path.join(builddir, progname + '_harness')
+    cmd = [cc] + list(cflags) + ['-I' + srcdir, '-o', exefn,
+                                 harnessfn] + libfns + ['-lm']
+    if verbose:
+        print('Compiling', exefn)
+    subprocess.check_call(cmd)
+    return exefn, testnames
+
+
+def _run_one(exefn, name, timeout):
+    start = time.time()
+    try:
+        proc = subprocess.Popen([exefn, name], stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        output = proc.communicate(timeout=timeout)[0]
+        passed = proc.returncode == 0
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        output = proc.communicate()[0] + b'\ntimed out\n'
+        passed = False
+    return {'name': name, 'passed': passed,
+            'seconds': time.time() - start,
+            'output': output.decode(errors='replace')}
+
+
+def run_tests(exefn, testnames, jobs=None, timeout=60, verbose=True):
+    """
+    Runs each of the `testnames` in the harness `exefn` as its own process,
+    `jobs` at a time (or one per CPU if None), and returns a list of dicts
+    with the ``name``, whether it ``passed``, the ``seconds`` it took and its
+    ``output``, in the same order as `testnames`.  Failures are printed as
+    soon as they happen if `verbose`.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    # the work is done by the subprocesses, so threads are enough here
+    executor = ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1)
+    try:
+        futures = [executor.submit(_run_one, exefn, name, timeout)
+                   for name in testnames]
+        for future in as_completed(futures):
+            result = future.result()
+            if verbose and not result['passed']:
+                print('FAILED {0}:\n{1}'.format(result['name'],
+                                                result['output']))
+    finally:
+        executor.shutdown()
+
+    return [future.result() for future in futures]
+
+
+if __name__ == '__main__':
+    import json
+    import shlex
+    import argparse
+
+    from sofa_deriver import find_sourcedir
+
+    parser = argparse.ArgumentParser(description='Compiles the tests of a '
+                                                 'SOFA-derived library and '
+                                                 'runs them in parallel.')
+    parser.add_argument('srcdir', nargs='?', default=None, help='The '
+                        'directory with the source code.  If not given, '
+                        'one that looks SOFA-derived is searched for.')
+    parser.add_argument('tests', nargs='*', help='The tests to run (e.g. '
+                        't_a2af).  Defaults to all of them.')
+    parser.add_argument('--test-file', '-t', default=None,
+                        help='The test program.  Defaults to the '
+                             't_*_c.c or test_*.c file in srcdir.')
+    parser.add_argument('--cc', default=os.environ.get('CC', 'cc'),
+                        help='The C compiler (defaults to $CC or cc).')
+    parser.add_argument('--cflags', default=os.environ.get('CFLAGS', '-O1'),
+                        help='Flags for the C compiler (defaults to $CFLAGS '
+                             'or -O1).')
+    parser.add_argument('--jobs', '-j', default=0, type=int,
+                        help='The number of tests to run at once.  Defaults '
+                             'to one per CPU.')
+    parser.add_argument('--timeout', default=60, type=float,
+                        help='Seconds before a test is considered hung.')
+    parser.add_argument('--json', default=None, metavar='FILE',
+                        help='Write the results to this file as JSON.')
+    parser.add_argument('--quiet', '-q', default=False, action='store_true',
+                        help='Print less info to the terminal.')
+    args = parser.parse_intermixed_args()
+
+    srcdir = args.srcdir if args.srcdir is not None else find_sourcedir()
+
+    builddir = tempfile.mkdtemp()
+    try:
+        exefn, testnames = build_harness(srcdir, builddir, args.test_file,
+                                         args.cc, shlex.split(args.cflags),
+                                         verbose=not args.quiet)
+        if args.tests:
+            unknown = [name for name in args.tests if name not in testnames]
+            if unknown:
+                print('Unknown tests: ' + ', '.join(unknown), file=sys.stderr)
+                sys.exit(1)
+            testnames = args.tests
+
+        start = time.time()
+        results = run_tests(exefn, testnames, jobs=args.jobs or None,
+                            timeout=args.timeout, verbose=not args.quiet)
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(builddir)
+
+    failed = [result['name'] for result in results if not result['passed']]
+    if not args.quiet:
+        slowest = sorted(results, key=lambda r: -r['seconds'])[:5]
+        print('Slowest tests: ' + ', '.join(['{0} ({1:.3f}s)'.format(r['name'],
+                                                                     r['seconds'])
+                                             for r in slowest]))
+    print('{0} of {1} tests passed in {2:.2f}s'.format(len(results) - len(failed),
+                                                       len(results), elapsed))
+    if failed:
+        print('Failed: ' + ', '.join(failed))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'seconds': elapsed, 'results': results}, f, indent=1)
+
+    sys.exit(1 if failed else 0)
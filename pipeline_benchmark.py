@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+"""
+This script times the stages of the SOFA-to-ERFA pipeline on synthetic SOFA
+libraries (from `synthetic_sofa`) of several sizes, and reports the results
+as JSON so they can be compared between versions of these tools.
+
+Do::
+
+  python pipeline_benchmark.py --help
+
+To see the options.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+
+import six
+
+import sofa_deriver
+import source_flattener
+from synthetic_sofa import make_synthetic_sofa
+
+
+def _best_time(func, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def _dir_bytes(dirnm):
+    return sum([os.path.getsize(os.path.join(dirnm, fn))
+                for fn in os.listdir(dirnm)])
+
+
+def benchmark_size(nfiles, lines_per_file=30, nmacros=50, comment_density=0.2,
+                   repeat=3):
+    """
+    Generates a synthetic SOFA with `nfiles` files (and the other arguments
+    as in `synthetic_sofa.SyntheticSOFA`), and times each stage of the
+    pipeline on it.  Returns a list of dicts, one per stage, with the best
+    time of `repeat` runs.
+    """
+    results = []
+
+    def record(stage, seconds, nbytes):
+        results.append({'stage': stage, 'seconds': seconds, 'bytes': nbytes,
+                        'nfiles': nfiles, 'lines_per_file': lines_per_file,
+                        'nmacros': nmacros,
+                        'comment_density': comment_density})
+
+    olddir = os.getcwd()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        os.chdir(tmpdir)
+        sofa = make_synthetic_sofa('sofa_c-synthetic.tar.gz', nfiles=nfiles,
+                                   lines_per_file=lines_per_file,
+                                   nmacros=nmacros,
+                                   comment_density=comment_density)
+        tarbytes = os.path.getsize('sofa_c-synthetic.tar.gz')
+
+        sofamlines = [l.encode() for l in six.StringIO(sofa.sofam_h())]
+        record('extract_macro_names',
+               _best_time(lambda: sofa_deriver.extract_macro_names(sofamlines,
+                                                                   ['SOFAMHDEF']),
+                          repeat),
+               sum([len(l) for l in sofamlines]))
+
+        record('reprocess_sofa_tarfile',
+               _best_time(lambda: sofa_deriver.reprocess_sofa_tarfile(
+                              'sofa_c-synthetic.tar.gz', verbose=False,
+                              copyrightyear=2021, force=True),
+                          repeat),
+               tarbytes)
+
+        derived = {}
+        for fn in os.listdir('erfa'):
+            with open(os.path.join('erfa', fn)) as f:
+                derived[fn] = f.read().split('\n')
+
+        def check_all():
+            out = six.StringIO()
+            for fn, lns in derived.items():
+                sofa_deriver.check_for_sofa(lns, fn, printfile=out)
+
+        record('check_for_sofa', _best_time(check_all, repeat),
+               _dir_bytes('erfa'))
+
+        record('flatten_source',
+               _best_time(lambda: source_flattener.flatten_source('erfa'),
+                          repeat),
+               _dir_bytes('erfa'))
+    finally:
+        os.chdir(olddir)
+        shutil.rmtree(tmpdir)
+
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Times the SOFA derivation '
+                                                 'and flattening pipeline on '
+                                                 'synthetic SOFA libraries.')
+    parser.add_argument('--sizes', '-n', default='50,200,800',
+                        help='Comma-separated numbers of files to benchmark.')
+    parser.add_argument('--lines', '-l', type=int, default=30,
+                        help='The number of statements in each function.')
+    parser.add_argument('--macros', '-m', type=int, default=50,
+                        help='The number of macros in sofam.h.')
+    parser.add_argument('--comment-density', '-c', type=float, default=0.2,
+                        help='The fraction of function lines that are '
+                             'comments.')
+    parser.add_argument('--repeat', '-r', type=int, default=3,
+                        help='The number of times to run each stage (the best '
+                             'time is reported).')
+    parser.add_argument('--output', '-o', default=None,
+                        help='A file to write the JSON results to.  If not '
+                             'given, they are written to stdout.')
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes.split(','):
+        results.extend(benchmark_size(int(size), lines_per_file=args.lines,
+                                      nmacros=args.macros,
+                                      comment_density=args.comment_density,
+                                      repeat=args.repeat))
+
+    report = {'python': platform.python_version(),
+              'platform': platform.platform(),
+              'results': results}
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
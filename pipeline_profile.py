@@ -0,0 +1,84 @@
+from __future__ import print_function
+
+"""
+Instrumentation for timing the stages of `sofa_deriver` and
+`source_flattener`.  Each stage records its wall time, number of calls, bytes
+read and written, and number of files handled.
+"""
+
+import json
+import time
+import contextlib
+import collections
+
+# time.perf_counter is not in py2
+_timer = getattr(time, 'perf_counter', time.time)
+
+_FIELDS = ('seconds', 'calls', 'bytes_in', 'bytes_out', 'files')
+
+
+class PipelineProfile(object):
+    """
+    Accumulates statistics for named pipeline stages, in the order the stages
+    were first seen.
+    """
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+
+    def add(self, name, seconds=0.0, calls=1, bytes_in=0, bytes_out=0,
+            files=0):
+        """
+        Adds the given amounts to the stage `name`.
+        """
+        if name not in self.stages:
+            self.stages[name] = dict([(field, 0) for field in _FIELDS])
+        stage = self.stages[name]
+        stage['seconds'] += seconds
+        stage['calls'] += calls
+        stage['bytes_in'] += bytes_in
+        stage['bytes_out'] += bytes_out
+        stage['files'] += files
+
+    @contextlib.contextmanager
+    def stage(self, name, bytes_in=0, bytes_out=0, files=0):
+        """
+        Context manager that times its block as a call of stage `name`.  The
+        yielded dict can be updated with ``bytes_in``, ``bytes_out`` or
+        ``files`` if they are only known inside the block.
+        """
+        counts = {'bytes_in': bytes_in, 'bytes_out': bytes_out, 'files': files}
+        start = _timer()
+        try:
+            yield counts
+        finally:
+            self.add(name, seconds=_timer() - start, **counts)
+
+    def merge(self, stages):
+        """
+        Adds in the stages from another profile's `stages` (e.g., one that was
+        sent back from a worker process).
+        """
+        for name, stage in stages.items():
+            self.add(name, **stage)
+
+    def as_dict(self):
+        return {'stages': [dict(name=name, **stage)
+                           for name, stage in self.stages.items()]}
+
+    def write_json(self, fn):
+        with open(fn, 'w') as f:
+            json.dump(self.as_dict(), f, indent=1)
+
+    def summary(self):
+        """
+        Returns a table of the stages as a string.
+        """
+        lines = ['{0:<24}{1:>10}{2:>8}{3:>8}{4:>12}{5:>12}'.format(
+                 'stage', 'seconds', 'calls', 'files', 'bytes in', 'bytes out')]
+        total = 0
+        for name, stage in self.stages.items():
+            total += stage['seconds']
+            lines.append('{0:<24}{seconds:>10.4f}{calls:>8}{files:>8}'
+                         '{bytes_in:>12}{bytes_out:>12}'.format(name, **stage))
+        lines.append('{0:<24}{1:>10.4f}'.format('total', total))
+        return '\n'.join(lines)
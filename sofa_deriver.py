@@ -1,12 +1,21 @@
 #!/usr/bin/env python
 from __future__ import print_function
 
+import io
 import re
 import sys
+import json
+import hashlib
+import functools
+import collections
 
 # for py2/py3 compatibility
 import six
 
+from line_rules import LineRule, LineRuleSet
+from output_sinks import DirectorySink, MemorySink, open_sink
+from pipeline_profile import PipelineProfile
+
 """
 This script downloads the latest SOFA, and then transforms the code to
 include the appropriate copyright and function name changes.
@@ -24,6 +33,9 @@ To see the options.
 """
 
 
+# bump this if the transformations change, so old manifests are not trusted
+MANIFEST_VERSION = 1
+
 DEFAULT_INLINE_LICENSE_STR = """
 Copyright (C) 2013-{curryr}, NumFOCUS Foundation.
 Derived, with permission, from the SOFA library.  See notes at end of file.
@@ -93,13 +105,38 @@ POSSIBILITY OF SUCH DAMAGE.
 def reprocess_sofa_tarfile(sofatarfn, libname='erfa', func_prefix='era',
                            inlinelicensestr=DEFAULT_INLINE_LICENSE_STR,
                            endlicensestr=DEFAULT_FILE_END_LICENSE_STR,
-                           verbose=True, copyrightyear=None):
+                           verbose=True, copyrightyear=None, jobs=1,
+                           manifestfn=None, force=False, profile=None,
+                           sink=None, batchsink=None, membercache=None):
     """
     Takes a SOFA .tar.gz file and produces a derived version of the
     source code with custom licensing and copyright.
 
     The resulting source code will be placed in a directory matching
-    `libname`.
+    `libname`, unless `sink` is given, in which case the files are written
+    to that `output_sinks.OutputSink` (which the caller must close).
+
+    If `jobs` is not 1, the files are transformed in that many worker
+    processes (or one per CPU if None or less than 1, as with ``--jobs
+    0``).  The output is identical either way.
+
+    A manifest of the input and output file hashes and the settings used is
+    saved to `manifestfn` (by default, ``<libname>.manifest.json`` next to the
+    output directory, if the output is a directory).  On later runs with the same settings, members that
+    have not changed are not re-derived, and output files whose contents
+    would not change are not rewritten.  Set `force` to ignore the manifest.
+
+    If `profile` is a `pipeline_profile.PipelineProfile`, the time spent in
+    each stage is recorded in it.
+
+    If `batchsink` is given, the batched versions of the functions made by
+    `batch_variants` (``<libname>_n.h``, ``<libname>_n.c`` and their tests)
+    are written to that sink.
+
+    If `membercache` is a directory, each transformed member is also saved
+    there, keyed on its contents and the settings, and members found there
+    are not transformed again.  This lets several runs (e.g. for different
+    SOFA releases) share the work for the files they have in common.
 
     Note that `inlinelicensestr` and `endlicensestr` should be plain
     license/copyright statements (possibly with ``{libnameuppercase}`` or
@@ -109,9 +146,10 @@ def reprocess_sofa_tarfile(sofatarfn, libname='erfa', func_prefix='era',
     import tarfile
     import datetime
 
-    # this dict maps filenames to the code in the form of a list of strings.
-    # they do *not* have the end license, as that gets added when writing.
-    filecontents = {}
+    if profile is None:
+        profile = PipelineProfile()
+    if jobs is not None and jobs < 1:
+        jobs = None
 
     # this is the current year for whoever is running this.
     if copyrightyear is None:
@@ -133,212 +171,528 @@ def reprocess_sofa_tarfile(sofatarfn, libname='erfa', func_prefix='era',
     endlicensestr = '/*' + ('-' * 70) + '\n' + endlicensestr + '\n*/\n'
     #first open the tar file
     tfn = tarfile.open(sofatarfn)
+    executor = outsink = None
     try:
         # extract macro names from sofam.h
         # except SOFAMHDEF
-        # we will use it later
+        # we will use it when transforming each file.  The macros have to be
+        # known before any file is transformed, and there's no guarantee that
+        # sofam.h comes first, so find it in the tar index up front.  That
+        # lets every other member be transformed and written as soon as it
+        # is read, rather than holding the whole library in memory.
         macros = []
         macros_exclude = ['SOFAMHDEF']
-
-        for ti in tfn:
-            contents = None
-
-            if ti.name.endswith('t_sofa_c.c'):
-                #test file
-                contents = reprocess_sofa_test_lines(tfn.extractfile(ti),
-                                                     func_prefix,
-                                                     libname,
-                                                     inlinelicensestr)
-            elif ti.name.endswith('.h'):
-                extractedh = list(tfn.extractfile(ti))
+        with profile.stage('tar index'):
+            for ti in tfn.getmembers():
                 if ti.name.endswith('sofam.h'):
-                    macros = extract_macro_names(extractedh, macros_exclude)
-                contents = reprocess_sofa_h_lines(extractedh,
-                                                  func_prefix,
-                                                  libname,
-                                                  inlinelicensestr)
-            elif ti.name.endswith('.c'):
-                contents = reprocess_sofa_c_lines(tfn.extractfile(ti),
-                                                  func_prefix,
-                                                  libname,
-                                                  inlinelicensestr)
-            #ignore everything else
-            if contents is not None:
-                # if "sofa" appears in the name, change appropriately
-                filename = ti.name.split('/')[-1].replace('sofa', libname.lower())
-
-                filecontents[filename] = contents
+                    macros = extract_macro_names(tfn.extractfile(ti),
+                                                 macros_exclude)
+                    break
+
+        if sink is None:
+            outsink = DirectorySink(os.path.join('.', libname), verbose)
+        else:
+            outsink = sink
+
+        # the manifest records what each output file was derived from, so
+        # members that haven't changed since the last run can be skipped.
+        # That only makes sense if the old output is still there to keep
+        if manifestfn is None and isinstance(outsink, DirectorySink):
+            manifestfn = outsink.dirnm + '.manifest.json'
+        if not outsink.persistent:
+            manifestfn = None
+        settings = {'version': MANIFEST_VERSION,
+                    'libname': libname,
+                    'func_prefix': func_prefix,
+                    'inlinelicensestr': inlinelicensestr,
+                    'endlicensestr': endlicensestr,
+                    'macros': macros}
+        oldfiles = {}
+        if not force and manifestfn and os.path.isfile(manifestfn):
+            with open(manifestfn) as f:
+                oldmanifest = json.load(f)
+            if oldmanifest.get('settings') == settings:
+                oldfiles = oldmanifest['files']
+        newfiles = {}
+        inhashes = {}
+        headerfn = libname + '.h'
+        headercontents = None
+
+        def changed_members():
+            # yields (name, data) for each member that needs to be
+            # transformed, reading one at a time
+            for ti in tfn:
+                if _sofa_member_kind(ti.name) is None:
+                    continue
+                with profile.stage('tar read', files=1) as counts:
+                    data = tfn.extractfile(ti).read()
+                    counts['bytes_in'] = len(data)
+
+                with profile.stage('manifest check', bytes_in=len(data)):
+                    inhash = hashlib.sha256(data).hexdigest()
+                    fn = _derived_filename(ti.name, libname)
+                    old = oldfiles.get(fn)
+                    unchanged = (old is not None and
+                                 old['member'] == ti.name and
+                                 old['input'] == inhash and
+                                 _text_sha256(outsink.read(fn)) ==
+                                 old['output'])
+                if unchanged:
+                    if verbose:
+                        print('Skipping unchanged', ti.name)
+                    newfiles[fn] = old
+                    continue
+
+                inhashes[ti.name] = inhash
+                yield ti.name, data
+
+        reprocess = functools.partial(_reprocess_sofa_member,
+                                      func_prefix=func_prefix, libname=libname,
+                                      inlinelicensestr=inlinelicensestr,
+                                      macros=macros, lint=verbose)
+        if membercache is not None:
+            # the end license is added afterwards, so it doesn't matter here
+            cachesettings = dict(settings, lint=verbose)
+            del cachesettings['endlicensestr']
+            reprocess = functools.partial(_cached_reprocess_member, reprocess,
+                                          membercache,
+                                          json.dumps(cachesettings,
+                                                     sort_keys=True))
+        if jobs == 1:
+            results = (reprocess(name, data) for name, data in changed_members())
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+
+            executor = ProcessPoolExecutor(max_workers=jobs)
+            # only keep a few files per worker in flight so memory stays
+            # bounded no matter how big the tar file is
+            window = 4 * (jobs or os.cpu_count() or 1)
+            results = _ordered_imap(executor, reprocess, changed_members(),
+                                    window)
 
         #now write out all the files, including the end license
-        dirnm = os.path.abspath(os.path.join('.', libname))
-        if not os.path.isdir(dirnm):
+        for name, fn, contents, warnings, stages in results:
+            profile.merge(stages)
+
+            if warnings:
+                sys.stderr.write(warnings)
+
+            contents = contents + endlicensestr
+            if fn == headerfn:
+                headercontents = contents
+            with profile.stage('manifest check', bytes_in=len(contents)):
+                outhash = _text_sha256(contents)
+                newfiles[fn] = {'member': name, 'input': inhashes.pop(name),
+                                'output': outhash}
+
+                # leave identical files alone so their mtimes don't change
+                unchanged = (not force and outsink.persistent and
+                             _text_sha256(outsink.read(fn)) == outhash)
+            if unchanged:
+                if verbose:
+                    print('Not rewriting unchanged file',
+                          outsink.describe(fn))
+                continue
+
             if verbose:
-                print('Making directory', dirnm)
-            os.mkdir(dirnm)
+                print('Writing to file', outsink.describe(fn))
+            with profile.stage('write', bytes_out=len(contents), files=1):
+                outsink.write(fn, contents)
+
+        if manifestfn:
+            with open(manifestfn, 'w') as f:
+                json.dump({'settings': settings, 'files': newfiles}, f,
+                          indent=1, sort_keys=True)
+
+        if batchsink is not None:
+            from batch_variants import write_batch_variants
+
+            # the header may have been skipped as unchanged
+            if headercontents is None:
+                headercontents = outsink.read(headerfn)
+            with profile.stage('batch variants', files=3):
+                write_batch_variants(six.StringIO(headercontents), batchsink,
+                                     libname, func_prefix, verbose)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        tfn.close()
+        if sink is None and outsink is not None:
+            outsink.close()
 
-        # prepare to prefix the macros.
-        # this is done here instead of in the `reprocess_sofa_*_lines`
-        # functions because the macros have to be extracted from sofam.h, and
-        # there's no guarantee above that it will come first
 
-        # given a re match obj, return
-        # the match (the macro name), prefixed and upper cased
-        def prefix_macro(matchobj):
-            macro = matchobj.group(0)
-            return 'ERFA_%s' % macro.upper()
+def flatten_sofa_tarfile(sofatarfn, libname='erfa', func_prefix='era',
+                         inlinelicensestr=DEFAULT_INLINE_LICENSE_STR,
+                         endlicensestr=DEFAULT_FILE_END_LICENSE_STR,
+                         verbose=True, copyrightyear=None, jobs=1,
+                         addversion=None, profile=None, sink=None,
+                         split=None, splitby='bytes', entrypoints=None,
+                         batchsink=None, membercache=None, orderprofile=None):
+    """
+    Takes a SOFA .tar.gz file and produces the single-file versions of the
+    derived source code (``<libname>.c``, ``<libname>.h`` and
+    ``test_<libname>.c``) directly, without writing the individual files to
+    a directory first.
+
+    The arguments are the same as for `reprocess_sofa_tarfile`, except that
+    `addversion`, `split`, `splitby`, `entrypoints` and `orderprofile` are as
+    in `source_flattener.flatten_source`, and the output goes into the
+    current directory unless `sink` is given.  The batched versions written
+    to `batchsink` are not flattened.
+    """
+    from source_flattener import flatten_files
+
+    derived = MemorySink()
+    reprocess_sofa_tarfile(sofatarfn, libname=libname, func_prefix=func_prefix,
+                           inlinelicensestr=inlinelicensestr,
+                           endlicensestr=endlicensestr, verbose=verbose,
+                           copyrightyear=copyrightyear, jobs=jobs,
+                           profile=profile, sink=derived, batchsink=batchsink,
+                           membercache=membercache)
+    # read the files with universal newlines, as flattening the files
+    # written to a directory does, so CRLF sources come out the same
+    flatten_files(sorted(derived.files),
+                  lambda fn: io.StringIO(derived.files[fn], newline=None),
+                  libname,
+                  verbose=verbose, addversion=addversion, profile=profile,
+                  sink=sink, split=split, splitby=splitby,
+                  entrypoints=entrypoints, func_prefix=func_prefix,
+                  orderprofile=orderprofile)
+
+
+def _text_sha256(text):
+    """
+    Returns the SHA-256 hex digest of `text` encoded as UTF-8, or None if
+    `text` is None.
+    """
+    if text is None:
+        return None
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
 
-        # precompile a regular expresion for each macro name
-        repls = [re.compile(r'\b%s\b' % macro) for macro in macros]
 
-        for fn, lines in filecontents.items():
-            fullfn = os.path.join(dirnm, fn)
+def _ordered_imap(executor, func, argtuples, window):
+    """
+    Like ``executor.map(func, *zip(*argtuples))``, but lazily consumes
+    `argtuples`, keeping at most `window` calls pending at a time.  Results
+    are yielded in order.
+    """
+    pending = collections.deque()
+    for args in argtuples:
+        pending.append(executor.submit(func, *args))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
 
-            if verbose:
-                check_for_sofa(lines, fn)
 
-            alllines = ''.join(lines)
-            # join the lines and replace the macros with the versions with an ERFA prefix
-            for repl in repls:
-                alllines = repl.sub(prefix_macro, alllines)
+def _sofa_member_kind(name):
+    """
+    Returns which of the ``reprocess_sofa_*_lines`` functions applies to the
+    tar member `name` ('test', 'h' or 'c'), or None if it should be ignored.
+    """
+    if name.endswith('t_sofa_c.c'):
+        return 'test'
+    elif name.endswith('.h'):
+        return 'h'
+    elif name.endswith('.c'):
+        return 'c'
+    else:
+        return None
 
-            if verbose:
-                print('Writing to file', fullfn)
-            with open(fullfn, 'w') as f:
-                f.write(alllines)
-                f.write(endlicensestr)
 
-    finally:
-        tfn.close()
+def _reprocess_sofa_member(name, data, func_prefix, libname, inlinelicensestr,
+                           macros, lint):
+    """
+    Transforms the contents (`data`, as bytes) of the SOFA tar member `name`,
+    including prefixing the `macros` (in the same pass as the renames).
+    Returns `name`, the output file name, the new contents without the end
+    license, any warnings from `check_for_sofa` (if `lint` is True), and the
+    `pipeline_profile.PipelineProfile` stages for the work done here.
 
+    This is a module-level function so it can be run in worker processes.
+    """
+    profile = PipelineProfile()
+    processor = {'test': reprocess_sofa_test_lines,
+                 'h': reprocess_sofa_h_lines,
+                 'c': reprocess_sofa_c_lines}[_sofa_member_kind(name)]
+    with profile.stage('transform', bytes_in=len(data), files=1) as counts:
+        lines = processor(data, func_prefix, libname, inlinelicensestr,
+                          macros)
+        contents = ''.join(lines)
+        counts['bytes_out'] = len(contents)
+    filename = _derived_filename(name, libname)
+
+    warnings = ''
+    if lint:
+        with profile.stage('lint', files=1):
+            warningsio = six.StringIO()
+            check_for_sofa(lines, filename, printfile=warningsio)
+            warnings = warningsio.getvalue()
+
+    return name, filename, contents, warnings, profile.stages
+
+
+def _cached_reprocess_member(reprocess, cachedir, settingskey, name, data):
+    """
+    Returns ``reprocess(name, data)`` (see `_reprocess_sofa_member`), from
+    `cachedir` if a member with the same file name and `data` was transformed
+    there before with the same `settingskey`, or else saving it there.
+    """
+    import os
 
-def reprocess_sofa_h_lines(inlns, func_prefix, libname, inlinelicensestr):
-    outlns = []
-    donewheader = False
-
-    for l in inlns:
-        l = l.decode()
-        if l.startswith('#'):
-            #includes and #ifdef/#define directives
-            outlns.append(l.replace('SOFA', libname.upper()).replace('sofa', libname.lower()))
-        elif l.startswith('**'):
-            if not donewheader:
-                if l.startswith('**  This file is part of the International Astronomical Union'):
-                    #after this it's all IAU/SOFA-specific stuff, so replace with ours
-                    donewheader = True
-                    outlns.append(inlinelicensestr)
-                elif 's o f a' in l:
-                    outlns.append(l.replace('s o f a', ' '.join(libname.lower())))
-                else:
-                    outlns.append(l.replace('SOFA', libname.upper()))
-
-        elif l.startswith('/*----------------------------------------------------------------------'):
-            #in license section at end of file
-            outlns.append('\n')
-            break
-        else:
-            outlns.append(l.replace('iau', func_prefix))
+    # the member name includes the release's directory, so only the file
+    # name goes into the key
+    key = hashlib.sha256('\n'.join([settingskey, name.split('/')[-1],
+                                    hashlib.sha256(data).hexdigest()])
+                         .encode('utf-8')).hexdigest()
+    cachefn = os.path.join(cachedir, key[:2], key + '.json')
 
+    profile = PipelineProfile()
+    with profile.stage('member cache', bytes_in=len(data)) as counts:
+        try:
+            with open(cachefn) as f:
+                cached = json.load(f)
+            counts['files'] = 1
+        except (IOError, ValueError):
+            cached = None
+    if cached is not None:
+        return (name, cached['filename'], cached['contents'],
+                cached['warnings'], profile.stages)
+
+    name, filename, contents, warnings, stages = reprocess(name, data)
+    profile.merge(stages)
+    if not os.path.isdir(os.path.dirname(cachefn)):
+        try:
+            os.makedirs(os.path.dirname(cachefn))
+        except OSError:
+            # another process may have just made it
+            pass
+    # write to a temporary name so another process never reads half a file
+    tmpfn = '{0}.{1}.tmp'.format(cachefn, os.getpid())
+    with open(tmpfn, 'w') as f:
+        json.dump({'filename': filename, 'contents': contents,
+                   'warnings': warnings}, f)
+    os.rename(tmpfn, cachefn)
+    return name, filename, contents, warnings, profile.stages
+
+
+def _derived_filename(name, libname):
+    """
+    Returns the output file name for the SOFA tar member `name`.
+    """
+    # if "sofa" appears in the name, change appropriately
+    return name.split('/')[-1].replace('sofa', libname.lower())
 
-    return outlns
 
+# the line that starts the SOFA license at the end of each file
+_SOFA_LICENSE_START = '/*' + '-' * 70
 
-def reprocess_sofa_c_lines(inlns, func_prefix, libname, inlinelicensestr):
-    spaced_prefix = ' '.join(func_prefix)
+# compiled rule sets, by the kind of file and the arguments they were made
+# for
+_rule_sets = {}
 
-    outlns = []
-    inhdr = True  # start inside the header before the function def'n
-    insofapart = False  # the part of the header that's SOFA-specific
-    replacedprefix = False  # indicates if the "iau" line has been hit
-    replacedspacedprefix = False  # indicates if the "i a u" line has been hit
-    incopyright = False  # indicates being inside the copyright/revision part of the doc comment of the SOFA function
 
-    for l in inlns:
-        l = l.decode()
-        if inhdr:
-            if (not replacedprefix) and 'iau' in l:
-                # this is the function definition and the end of the header
-                outlns.append(l.replace('iau', func_prefix))
-                replacedprefix = True
-                inhdr = False
-            else:
-                # make sure the includes are correct for the new libname
-                outlns.append(l.replace('sofa', libname.lower()).replace('SOFA', libname.upper()))
-        elif insofapart:
+def sofa_rule_set(kind, func_prefix, libname, inlinelicensestr, macros=()):
+    """
+    Returns the `line_rules.LineRuleSet` that turns a SOFA file of this
+    `kind` ('h', 'c' or 'test', see `_sofa_member_kind`) into the derived
+    one, with the functions prefixed with `func_prefix`, the library called
+    `libname`, the SOFA license lines replaced with `inlinelicensestr` and
+    the `macros` prefixed with ``ERFA_``.  The renames and the macro prefixes
+    for each line are done by one rewriter, in a single pass.  Rule sets are
+    only compiled once for each set of arguments.
+    """
+    key = (kind, func_prefix, libname, inlinelicensestr, tuple(macros))
+    if key not in _rule_sets:
+        _rule_sets[key] = {'h': _sofa_h_rules,
+                           'c': _sofa_c_rules,
+                           'test': _sofa_test_rules}[kind](
+            func_prefix, libname, inlinelicensestr,
+            _macro_renamer(macros))
+    return _rule_sets[key]
+
+
+def _macro_renamer(macros):
+    # returns a function making a rewriter for some renames that also
+    # prefixes the macros, in the same pass
+    words = dict([(macro, 'ERFA_' + macro.upper()) for macro in macros])
+    return lambda replacements={}: make_token_rewriter(replacements,
+                                                       words=words)
+
+
+def _sofa_h_rules(func_prefix, libname, inlinelicensestr, rename):
+    #includes and #ifdef/#define directives
+    directive = LineRule(prefix='#', subs=[rename(
+        {'SOFA': libname.upper(), 'sofa': libname.lower()})])
+    #in license section at end of file
+    license = LineRule(prefix=_SOFA_LICENSE_START, text='\n', stop=True)
+    body = LineRule(subs=[rename({'iau': func_prefix})])
+
+    header = [
+        directive,
+        #after this it's all IAU/SOFA-specific stuff, so replace with ours
+        LineRule(prefix='**  This file is part of the International '
+                        'Astronomical Union', text=rename()(inlinelicensestr),
+                 goto='done'),
+        LineRule(prefix='**', contains='s o f a',
+                 subs=[rename({'s o f a': ' '.join(libname.lower())})]),
+        LineRule(prefix='**', subs=[rename({'SOFA': libname.upper()})]),
+        license,
+    ]
+    done = [directive, LineRule(prefix='**', drop=True), license]
+    return LineRuleSet({'header': (header, body), 'done': (done, body)},
+                       'header')
+
+
+def _sofa_c_rules(func_prefix, libname, inlinelicensestr, rename):
+    # the first line with "iau" is the function definition and the end of
+    # the header, before which the includes need the new libname
+    header = [LineRule(contains='iau', subs=[rename({'iau': func_prefix})],
+                       goto='body')]
+    rename_include = LineRule(subs=[rename(
+        {'sofa': libname.lower(), 'SOFA': libname.upper()})])
+
+    def doc_rules(sofapart):
+        return [
             #don't write out any of the disclaimer about being part of SOFA
-            if l.strip() == '**':
-                insofapart = False
-        elif l.startswith('**  This function is part of the International Astronomical Union'):
-            insofapart = True
-        elif l.startswith('**  Status:'):
+            LineRule(prefix='**  This function is part of the International '
+                            'Astronomical Union', drop=True, goto=sofapart),
             #don't include the status line which states if a function is
-            #canonical - ERFA isn't "canonical" as it is not IAU official
-            if outlns[-1].strip() == '**':
-                #Also drop the line with just '**' before it
-                del outlns[-1]
-        elif (not replacedspacedprefix) and 'i a u' in l:
-            outlns.append(l.replace('i a u', spaced_prefix))
-            replacedspacedprefix = True
-        elif incopyright:
-            # skip the copyright/versioning section unless it's the end
-            if l.startswith('*/'):  # indicates end of the doc comment
-                incopyright = False
-                outlns.append(l)
-        elif l.startswith('/*----------------------------------------------------------------------'):
-            #this means we are in the license section, so we are done
-            #except for the final close-bracket always comes after the
-            #license section
-            outlns.append('}\n')
-            break
-        elif l.startswith('**  This revision:'):
-            incopyright = True
-            #start of the copyright/versioning section - need to strip this because it contains SOFA references.
-
-            #but put in the correct inline license instead
-            if inlinelicensestr:
-                outlns.append(inlinelicensestr)
-        else:
-            # need to replace 'iau' b/c other SOFA functions are often called
-            outlns.append(l.replace('iau', func_prefix)
-                           .replace('sofa', libname)
-                           .replace('SOFA', libname.upper()))
-
-    return outlns
-
-
-def reprocess_sofa_test_lines(inlns, func_prefix, libname, inlinelicensestr):
-    spaced_libname = ' '.join(libname)
-    libnamelow = libname.lower()
-    libnameup = libname.upper()
-
-    outlns = []
-    inhdr = True
-    insofapart = False
-    for l in inlns:
-        l = l.decode()
-        if inhdr:
-            if l.startswith('**  SOFA release'):
-                insofapart = True
-
-            if insofapart:
-                if l.startswith('*/'):
-                    insofapart = inhdr = False
-                    outlns.append(l)
-                continue
+            #canonical - ERFA isn't "canonical" as it is not IAU official.
+            #Also drop the line with just '**' before it
+            LineRule(prefix='**  Status:', drop=True, unemit='**'),
+            LineRule(contains='i a u', once='i a u',
+                     subs=[rename({'i a u': ' '.join(func_prefix)})]),
+        ]
+
+    body = doc_rules('sofapart') + [
+        #this means we are in the license section, so we are done except
+        #for the final close-bracket always comes after the license section
+        LineRule(prefix=_SOFA_LICENSE_START, text='}\n', stop=True),
+        #start of the copyright/versioning section - need to strip this
+        #because it contains SOFA references, but put in the correct inline
+        #license instead
+        LineRule(prefix='**  This revision:',
+                 text=rename()(inlinelicensestr) or None,
+                 drop=not inlinelicensestr, goto='copyright'),
+    ]
+    # need to replace 'iau' b/c other SOFA functions are often called
+    rename_body = LineRule(subs=[rename(
+        {'iau': func_prefix, 'sofa': libname, 'SOFA': libname.upper()})])
+
+    # skip the copyright/versioning section up to the end of the doc comment
+    copyright = doc_rules('copyrightsofapart') + [
+        LineRule(prefix='*/', subs=[rename()], goto='body')]
+
+    def sofapart(after):
+        return [LineRule(stripped='**', drop=True, goto=after)]
+
+    skip = LineRule(drop=True)
+    return LineRuleSet({'header': (header, rename_include),
+                        'body': (body, rename_body),
+                        'copyright': (copyright, skip),
+                        'sofapart': (sofapart('body'), skip),
+                        'copyrightsofapart': (sofapart('copyright'), skip)},
+                       'header')
+
+
+def _sofa_test_rules(func_prefix, libname, inlinelicensestr, rename):
+    renames = {'iau': func_prefix, 'sofa': libname.lower(),
+               'SOFA': libname.upper()}
+    header = [LineRule(prefix='**  SOFA release', drop=True, goto='sofapart')]
+    sofapart = [LineRule(prefix='*/', subs=[rename()], goto='body')]
+    #the license section means we are done.  Note that prior to SOFA
+    #20170420, this was absent from t_erfa_c.c
+    body = [LineRule(prefix=_SOFA_LICENSE_START, drop=True, stop=True)]
+    return LineRuleSet(
+        {'header': (header,
+                    LineRule(subs=[rename(dict(renames, **{
+                        's o f a': ' '.join(libname)}))])),
+         'sofapart': (sofapart, LineRule(drop=True)),
+         'body': (body, LineRule(subs=[rename(renames)]))},
+        'header')
+
+
+def _sofa_file_text(inlns):
+    # the whole file decoded at once, from its bytes or its lines of bytes
+    if isinstance(inlns, bytes):
+        return inlns.decode()
+    return b''.join(inlns).decode()
+
+
+def reprocess_sofa_h_lines(inlns, func_prefix, libname, inlinelicensestr,
+                           macros=()):
+    return sofa_rule_set('h', func_prefix, libname, inlinelicensestr,
+                         macros).apply(_sofa_file_text(inlns))
+
+
+def reprocess_sofa_c_lines(inlns, func_prefix, libname, inlinelicensestr,
+                           macros=()):
+    return sofa_rule_set('c', func_prefix, libname, inlinelicensestr,
+                         macros).apply(_sofa_file_text(inlns))
+
+
+def reprocess_sofa_test_lines(inlns, func_prefix, libname, inlinelicensestr,
+                              macros=()):
+    return sofa_rule_set('test', func_prefix, libname, inlinelicensestr,
+                         macros).apply(_sofa_file_text(inlns))
+
+
+def make_token_rewriter(replacements, wholewords=False, words=None):
+    """
+    Returns a function that applies every substitution in `replacements` (a
+    dict mapping old strings to new ones) to a string in a single pass,
+    rather than scanning the string once per substitution.
+
+    If `wholewords` is True, only complete identifiers are replaced (i.e.,
+    the same as surrounding each one with ``\\b`` in a regular expression).
+    `words` is a dict of further substitutions that only apply to complete
+    identifiers, done in the same pass.  Where both could match at the same
+    place, `replacements` win.
+    """
+    words = words or {}
+    if not replacements and not words:
+        return lambda s: s
+
+    patterns = []
+    for keys, whole in ((replacements, wholewords), (words, True)):
+        if keys and whole:
+            patterns.append(_whole_word_pattern(keys))
+        elif keys:
+            # longest first so that keys that are prefixes of others don't
+            # win
+            patterns.append('|'.join([re.escape(k) for k in
+                                      sorted(keys, key=len, reverse=True)]))
+    sub = re.compile('|'.join(patterns)).sub
+    replacements = dict(words, **replacements)
 
-            l = l.replace('s o f a', spaced_libname)
+    def lookup(matchobj):
+        return replacements[matchobj.group(0)]
 
-        elif l.startswith('/*----------------------------------------------------------------------'):
-            #this means we are starting the license section, so we are done.
-            # Note that prior to SOFA 20170420, this was absent from t_erfa_c.c
-            break
+    return lambda s: sub(lookup, s)
 
-        l = l.replace('iau', func_prefix)
-        l = l.replace('sofa', libnamelow)
-        l = l.replace('SOFA', libnameup)
 
-        outlns.append(l)
+def _whole_word_pattern(keys):
+    """
+    Returns a regular expression matching any of `keys` as a complete
+    identifier, like ``\\b(?:key1|key2|...)\\b`` but much faster to search
+    with: the keys are grouped by their first character, which the pattern
+    starts with, so the regex engine can skip to the places one could start.
+    """
+    groups = {}
+    other = []
+    for k in sorted(keys, key=len, reverse=True):
+        if re.match(r'\w', k):
+            groups.setdefault(k[0], []).append(re.escape(k[1:]))
+        else:
+            other.append(re.escape(k))
+    # after the first character, check the one before it isn't a word one
+    patterns = [re.escape(c) + r'(?<!\w.)(?:' + '|'.join(rests) + r')\b'
+                for c, rests in sorted(groups.items())]
+    if other:
+        patterns.append(r'\b(?:' + '|'.join(other) + r')\b')
+    return '|'.join(patterns)
 
-    return outlns
 
 def extract_macro_names(m, exclude):
     macros = []
@@ -357,9 +711,17 @@ def extract_macro_names(m, exclude):
 ACCEPTSOFASTRS = ['Derived, with permission, from the SOFA library']
 
 
+_SOFA_RE = re.compile('(?i)sofa')
+
+
 def check_for_sofa(lns, fn='', printfile=sys.stderr):
     if isinstance(lns, six.string_types):
         lns = lns.split('\n')
+    # most files have nothing to report, so look at the lines one by one
+    # only if the text as a whole mentions SOFA (see sofa_lint.py for a
+    # full check of a tree)
+    if not _SOFA_RE.search('\n'.join(lns)):
+        return
     for i, l in enumerate(lns):
         if 'sofa' in l.lower():
             for s in ACCEPTSOFASTRS:
@@ -371,36 +733,234 @@ def check_for_sofa(lns, fn='', printfile=sys.stderr):
                 print('WARNING: Found "SOFA"{infile}:\n{ln}'.format(infile=infile, ln=l), file=printfile)
 
 
-def download_sofa(url=None, dlloc='.', verbose=True):
+def download_sofa(url=None, dlloc='.', verbose=True, cachedir=None,
+                  sha256=None, profile=None, mirrors=None, connections=1):
     """
     Downloads the latest version of SOFA (or one specified via `url`) to
     the `dlloc` directory.
 
-    If `extract`, also extract that .tar.gz file
+    If `cachedir` is given, downloads go through a cache in that directory
+    (see `cached_download`), so repeated calls only cost a conditional
+    request to check that the cached copy is still current.  If `sha256` is
+    given, the download must have that SHA-256 hex digest.
+
+    If `mirrors` (base URLs of other servers with the same file) are given
+    or `connections` is more than 1, the download goes through
+    `async_fetch.fetch_sofa` instead, which reuses one connection to find
+    and download the file, and downloads it in parallel byte ranges over up
+    to `connections` connections, failing over between the mirrors.  This
+    can't be combined with `cachedir`, and needs Python 3.7 or later.
+
+    If `profile` is a `pipeline_profile.PipelineProfile`, the time spent
+    finding and downloading the file is recorded in it.
     """
     import os
+    import shutil
     from six.moves.urllib.request import urlretrieve
 
+    if profile is None:
+        profile = PipelineProfile()
+
+    if mirrors or connections > 1:
+        if sys.version_info < (3, 7):
+            raise RuntimeError('Downloading from mirrors or over parallel '
+                               'connections needs Python 3.7 or later')
+        from async_fetch import fetch_sofa
+
+        if cachedir is not None:
+            raise ValueError('A download cache cannot be used with mirrors '
+                             'or parallel connections')
+        # finding the URL and downloading share a connection, so they are
+        # one stage here
+        with profile.stage('download', files=1) as counts:
+            retfn = fetch_sofa(url, dlloc, mirrors or (), connections,
+                               sha256=sha256, verbose=verbose)
+            counts['bytes_out'] = os.path.getsize(retfn)
+        return retfn
+
     if url is None:
-        url = _find_sofa_url_on_web_page()
+        with profile.stage('url discovery'):
+            url = _find_sofa_url_on_web_page(cachedir=cachedir)
 
     fn = url.split('/')[-1]
     if not os.path.isdir(dlloc):
         raise ValueError('Requested dlloc {0} is not a directory'.format(dlloc))
 
     fnpath = os.path.join(dlloc, fn)
-    if verbose:
-        print('Downloading {fn} to {fnpath}'.format(fn=fn, fnpath=fnpath))
-    retfn, headers = urlretrieve(url, fnpath)
+    with profile.stage('download', files=1) as counts:
+        if cachedir is not None:
+            cachedfn = cached_download(url, cachedir, sha256=sha256,
+                                       verbose=verbose)
+            if verbose:
+                print('Copying {cachedfn} to {fnpath}'.format(cachedfn=cachedfn,
+                                                              fnpath=fnpath))
+            shutil.copyfile(cachedfn, fnpath)
+            retfn = fnpath
+        else:
+            if verbose:
+                print('Downloading {fn} to {fnpath}'.format(fn=fn,
+                                                            fnpath=fnpath))
+            retfn, headers = urlretrieve(url, fnpath)
+            if sha256 is not None:
+                _verify_sha256(retfn, sha256)
+        counts['bytes_out'] = os.path.getsize(retfn)
 
     return retfn
 
 
-def _find_sofa_url_on_web_page(url='http://www.iausofa.org/current_C.html'):
+def cached_download(url, cachedir, sha256=None, verbose=True):
+    """
+    Downloads `url` into `cachedir` (which is created if needed) and returns
+    the name of the cached file.
+
+    Files are cached by URL along with their ETag/Last-Modified headers.  If
+    there is already a cached copy, the server is asked for it with
+    If-None-Match/If-Modified-Since and the cached copy is used if it has not
+    changed.  An interrupted download is resumed with an HTTP Range request
+    the next time.  The cached file is checked against the SHA-256 digest
+    recorded when it was downloaded, and against `sha256` if that is given.
+    """
+    import os
+    from six.moves.urllib.request import Request, urlopen
+    from six.moves.urllib.error import HTTPError
+
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    datafn = os.path.join(cachedir, key)
+    metafn = datafn + '.json'
+    partfn = datafn + '.part'
+    partmetafn = partfn + '.json'
+
+    meta = None
+    if os.path.isfile(datafn) and os.path.isfile(metafn):
+        with open(metafn) as f:
+            meta = json.load(f)
+        if _file_digest(datafn) != meta['sha256']:
+            if verbose:
+                print('Cached copy of {0} is corrupt, downloading '
+                      'again'.format(url))
+            meta = None
+
+    req = Request(url)
+    resumefrom = 0
+    if meta is not None:
+        if meta.get('etag'):
+            req.add_header('If-None-Match', meta['etag'])
+        if meta.get('last_modified'):
+            req.add_header('If-Modified-Since', meta['last_modified'])
+    elif os.path.isfile(partfn) and os.path.isfile(partmetafn):
+        with open(partmetafn) as f:
+            partmeta = json.load(f)
+        # If-Range makes the server send the whole file if it has changed
+        validator = partmeta.get('etag') or partmeta.get('last_modified')
+        if validator:
+            resumefrom = os.path.getsize(partfn)
+            req.add_header('Range', 'bytes={0}-'.format(resumefrom))
+            req.add_header('If-Range', validator)
+
+    try:
+        u = urlopen(req)
+    except HTTPError as e:
+        if e.code == 304 and meta is not None:
+            if verbose:
+                print('Cached copy of {0} is up to date'.format(url))
+            if sha256 is not None:
+                _verify_sha256(datafn, sha256)
+            return datafn
+        elif e.code == 416 and resumefrom:
+            # the partial file can't be resumed, so start over
+            os.remove(partfn)
+            os.remove(partmetafn)
+            return cached_download(url, cachedir, sha256=sha256,
+                                   verbose=verbose)
+        raise
+
+    try:
+        headers = u.info()
+        newmeta = {'url': url,
+                   'etag': headers.get('ETag'),
+                   'last_modified': headers.get('Last-Modified')}
+        if u.getcode() == 206:
+            if verbose:
+                print('Resuming download of {0} from byte '
+                      '{1}'.format(url, resumefrom))
+            mode = 'ab'
+        else:
+            if verbose:
+                print('Downloading {0} to cache {1}'.format(url, cachedir))
+            mode = 'wb'
+        with open(partmetafn, 'w') as f:
+            json.dump(newmeta, f)
+        with open(partfn, mode) as f:
+            for chunk in iter(functools.partial(u.read, 1024 * 64), b''):
+                f.write(chunk)
+    finally:
+        u.close()
+
+    newmeta['sha256'] = _file_digest(partfn)
+    if sha256 is not None and newmeta['sha256'] != sha256.lower():
+        # the partial file is no good for resuming either
+        os.remove(partfn)
+        os.remove(partmetafn)
+        raise ValueError('Downloaded {0} has SHA-256 {1}, expected '
+                         '{2}'.format(url, newmeta['sha256'], sha256))
+
+    if os.path.exists(datafn):
+        os.remove(datafn)
+    os.rename(partfn, datafn)
+    with open(metafn, 'w') as f:
+        json.dump(newmeta, f)
+    os.remove(partmetafn)
+
+    return datafn
+
+
+def _file_digest(fn):
+    """
+    Returns the SHA-256 hex digest of the bytes in the file `fn`.
+    """
+    h = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for chunk in iter(functools.partial(f.read, 1024 * 64), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _verify_sha256(fn, sha256):
+    digest = _file_digest(fn)
+    if digest != sha256.lower():
+        raise ValueError('{0} has SHA-256 {1}, expected {2}'.format(fn, digest,
+                                                                    sha256))
+
+
+def _find_sofa_url_on_web_page(url='http://www.iausofa.org/current_C.html',
+                               cachedir=None):
     """
     Finds and returns the download URL for the latest C SOFA.
+
+    If `cachedir` is given, the page is fetched via `cached_download`.
     """
     from six.moves.urllib.request import urlopen
+
+    if cachedir is None:
+        u = urlopen(url)
+    else:
+        u = open(cached_download(url, cachedir, verbose=False), 'rb')
+    try:
+        page = u.read()
+    finally:
+        u.close()
+
+    return _sofa_url_from_page(page, url)
+
+
+def _sofa_url_from_page(page, url):
+    """
+    Returns the download URL for the latest C SOFA linked from `page` (the
+    bytes of the SOFA web page at `url`).
+    """
     from six.moves.html_parser import HTMLParser
 
     # create a subclass and override the handler methods
@@ -414,12 +974,8 @@ def _find_sofa_url_on_web_page(url='http://www.iausofa.org/current_C.html'):
                 self.matched_urls.append(attrs[-1][-1])
 
     parser = SOFAParser()
-    u = urlopen(url)
-    try:
-        for l in u:
-            parser.feed(l.decode())
-    finally:
-        u.close()
+    parser.feed(page.decode())
+    parser.close()
 
     baseurl = '/'.join(url.split('/')[:-1])
     fullurls = [(baseurl + m) for m in parser.matched_urls]
@@ -430,6 +986,57 @@ def _find_sofa_url_on_web_page(url='http://www.iausofa.org/current_C.html'):
 
     return fullurls[0]
 
+def watch_sofa_dir(watchdir, rederive, interval=0.2, verbose=True):
+    """
+    Watches `watchdir` for new or changed ``sofa_c*.tar.gz`` files, and calls
+    ``rederive(sofatarfn)`` with the most recently modified of them each time
+    (including for the files already there when it starts).  A file is only
+    used once its size and modification time are the same in two polls
+    `interval` seconds apart, so files that are still being written are left
+    alone.  Errors from `rederive` are printed, not raised.  Runs until
+    interrupted.
+    """
+    import os
+    import glob
+    import time
+    import traceback
+
+    derived = {}
+    lastpoll = {}
+    if verbose:
+        print('Watching {0} for SOFA files'.format(watchdir))
+    while True:
+        poll = {}
+        for fn in glob.glob(os.path.join(watchdir, 'sofa_c*.tar.gz')):
+            try:
+                st = os.stat(fn)
+            except OSError:
+                # it was removed since the glob
+                continue
+            poll[fn] = (st.st_size, st.st_mtime)
+        ready = [fn for fn, state in poll.items()
+                 if lastpoll.get(fn) == state and derived.get(fn) != state]
+        lastpoll = poll
+
+        if ready:
+            # only the newest matters, since they all go to the same place
+            for fn in ready:
+                derived[fn] = poll[fn]
+            sofatarfn = max(ready, key=lambda fn: (poll[fn][1], fn))
+            start = time.time()
+            try:
+                rederive(sofatarfn)
+            except Exception:
+                print('Could not derive from {0}:'.format(sofatarfn),
+                      file=sys.stderr)
+                traceback.print_exc()
+            else:
+                if verbose:
+                    print('Regenerated from {0} in {1:.2f} s'.format(
+                          sofatarfn, time.time() - start))
+        time.sleep(interval)
+
+
 def find_sourcedir():
     """
     This function is used by the other scripts to find a directory that looks
@@ -437,6 +1044,7 @@ def find_sourcedir():
 
     Takes in a
     """
+    import os
     import glob
 
     dirfns = [fn for fn in os.listdir('.') if os.path.isdir(fn)]
@@ -462,6 +1070,7 @@ def find_sourcedir():
 
 
 if __name__ == '__main__':
+    import os
     import glob
     import tarfile
     import argparse
@@ -475,20 +1084,86 @@ if __name__ == '__main__':
                         help='Download the latest SOFA regardless regardless '
                         'of whether there is already a SOFA in the current '
                         'directory')
+    parser.add_argument('--cache-dir', default=None,
+                        help='A directory to cache downloads in.  If given, '
+                             'a download that is already cached only costs a '
+                             'request to check it is still current, and an '
+                             'interrupted download is resumed.')
+    parser.add_argument('--sha256', default=None,
+                        help='The expected SHA-256 hex digest of the '
+                             'downloaded SOFA file.')
+    parser.add_argument('--mirror', action='append', default=[],
+                        metavar='BASEURL',
+                        help='The base URL of a mirror to download SOFA '
+                             'from as well (can be given more than once).  '
+                             'Parts of the file are downloaded from each, '
+                             'and a mirror that fails is skipped.')
+    parser.add_argument('--connections', default=1, type=int,
+                        help='The number of connections to download SOFA '
+                             'over in parallel.  Defaults to 1.')
     parser.add_argument('--copyright-year', '-y', default=None,
                         help='The "current" year for the purposes of the end '
                               'of the copyright in each file.  If not given, '
                               'defaults to the current year when this script '
                               'is run')
+    parser.add_argument('--output', '-o', default=None,
+                        help='Where to write the derived source code.  Can be '
+                             'a directory, or a .tar.gz/.zip file to write '
+                             'them into directly.  Defaults to a directory '
+                             'named after the library ("erfa"), or the '
+                             'current directory with --flatten.')
+    parser.add_argument('--flatten', default=False, action='store_true',
+                        help='Write single-file versions of the source code '
+                             '(as source_flattener.py does) instead of a '
+                             'directory of files.')
+    parser.add_argument('--batch', nargs='?', default=None, const='erfa_n',
+                        metavar='OUTPUT',
+                        help='Also write batched versions of the functions '
+                             '(eraXxx_n) and their tests to this directory or '
+                             'archive (by default, "erfa_n").')
+    parser.add_argument('--jobs', '-j', default=1, type=int,
+                        help='The number of worker processes to use for '
+                             'transforming the source files.  0 means one per '
+                             'CPU.  Defaults to 1 (no worker processes).')
+    parser.add_argument('--force', '-f', default=False, action='store_true',
+                        help='Re-derive and rewrite every file, even if the '
+                             'manifest from a previous run says it has not '
+                             'changed.')
+    parser.add_argument('--profile', '-p', nargs='?', default=None,
+                        const='-', metavar='JSONFILE',
+                        help='Record how long each stage takes.  Prints a '
+                             'summary, or writes a JSON report if a file name '
+                             'is given.')
+    parser.add_argument('--cprofile', default=None, metavar='FILE',
+                        help='Run the reprocessing under cProfile and dump '
+                             'the stats to this file.')
+    parser.add_argument('--watch', default=None, metavar='DIR',
+                        help='Keep running, and regenerate the output each '
+                             'time a sofa_c*.tar.gz file appears or changes '
+                             'in this directory.  Only the files that '
+                             'changed are transformed again.')
+    parser.add_argument('--poll-interval', default=0.2, type=float,
+                        help='How often (in seconds) to check the --watch '
+                             'directory.')
     parser.add_argument('--quiet', '-q', default=False, action='store_true',
                         help='Print less info to the terminal.')
     args = parser.parse_args()
 
-    if args.download:
+    profile = PipelineProfile()
+
+    if args.watch is not None:
+        if args.download or args.sofafile is not None:
+            print('Cannot give --watch with --download or sofafile!',
+                  file=sys.stderr)
+            sys.exit(1)
+    elif args.download:
         if args.sofafile is not None:
             print('Cannot give both --download and sofafile!', file=sys.stderr)
             sys.exit(1)
-        sofatarfn = download_sofa(verbose=not args.quiet)
+        sofatarfn = download_sofa(verbose=not args.quiet,
+                                  cachedir=args.cache_dir, sha256=args.sha256,
+                                  profile=profile, mirrors=args.mirror,
+                                  connections=args.connections)
     elif args.sofafile is not None:
         try:
             #try to open the file as a tar file
@@ -510,18 +1185,87 @@ if __name__ == '__main__':
         elif len(lstar) == 0:
             if not args.quiet:
                 print('Did not find any sofa_c*.tar.gz files - downloading.')
-            sofatarfn = download_sofa(verbose=not args.quiet)
+            sofatarfn = download_sofa(verbose=not args.quiet,
+                                      cachedir=args.cache_dir,
+                                      sha256=args.sha256, profile=profile,
+                                      mirrors=args.mirror,
+                                      connections=args.connections)
         else:
             sofatarfn = lstar[0]  # there is only one
 
-    if not args.quiet:
-        print('Using sofa tarfile "{0}" for reprocessing'.format(sofatarfn))
-
-    reprocess_sofa_tarfile(sofatarfn, verbose=not args.quiet,
-                           copyrightyear=args.copyright_year)
-
-    if not args.quiet:
-        print('\nCreated new set of source files based on SOFA version '
-              '"{0}".'.format(sofatarfn.replace('sofa_c-', '').replace('.tar.gz', '')))
-        print('Be sure to update any relevant version information when you '
-              'copy this to its new home.')
+    def derive(sofatarfn, membercache=None):
+        if args.output is None:
+            sink = None
+        else:
+            sink = open_sink(args.output,
+                             arcdir='' if args.flatten else 'erfa',
+                             verbose=not args.quiet)
+        if args.batch is None:
+            batchsink = None
+        else:
+            batchsink = open_sink(args.batch, arcdir='erfa_n',
+                                  verbose=not args.quiet)
+        try:
+            if args.flatten:
+                flatten_sofa_tarfile(sofatarfn, verbose=not args.quiet,
+                                     copyrightyear=args.copyright_year,
+                                     jobs=args.jobs or None, profile=profile,
+                                     sink=sink, batchsink=batchsink,
+                                     membercache=membercache)
+            else:
+                reprocess_sofa_tarfile(sofatarfn, verbose=not args.quiet,
+                                       copyrightyear=args.copyright_year,
+                                       jobs=args.jobs or None,
+                                       force=args.force, profile=profile,
+                                       sink=sink, batchsink=batchsink,
+                                       membercache=membercache)
+        finally:
+            if sink is not None:
+                sink.close()
+            if batchsink is not None:
+                batchsink.close()
+
+        if not args.quiet:
+            version = os.path.basename(sofatarfn).replace('sofa_c-', '')
+            print('\nCreated new set of source files based on SOFA version '
+                  '"{0}".'.format(version.replace('.tar.gz', '')))
+            print('Be sure to update any relevant version information when '
+                  'you copy this to its new home.')
+
+    if args.cprofile:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if args.watch is not None:
+        import shutil
+        import signal
+        import tempfile
+
+        # being stopped by the release automation is a normal exit
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+        # the transformed files are kept for the whole session, so each
+        # change only transforms the files that changed, even when the
+        # output is not a directory with a manifest
+        membercache = tempfile.mkdtemp(prefix='sofa_members_')
+        try:
+            watch_sofa_dir(args.watch,
+                           functools.partial(derive, membercache=membercache),
+                           args.poll_interval, verbose=not args.quiet)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            shutil.rmtree(membercache)
+    else:
+        if not args.quiet:
+            print('Using sofa tarfile "{0}" for reprocessing'.format(sofatarfn))
+        derive(sofatarfn)
+    if args.cprofile:
+        profiler.disable()
+        profiler.dump_stats(args.cprofile)
+
+    if args.profile == '-':
+        print()
+        print(profile.summary())
+    elif args.profile is not None:
+        profile.write_json(args.profile)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+"""
+Checks SOFA-derived source trees (or flattened files) for leftovers of the
+SOFA originals that the derivation should have replaced: mentions of SOFA,
+``iau``-prefixed names and the spaced-out ``i a u`` of the SOFA comment
+banners.  All the rules and the allowed phrases are combined into one
+regular expression that is run over each whole file, and files are checked
+in parallel.  Do::
+
+  python sofa_lint.py --help
+
+To see the options.
+"""
+
+import os
+import re
+import sys
+import json
+
+from sofa_deriver import ACCEPTSOFASTRS
+
+# (rule name, regular expression) for the text that should not be there
+DEFAULT_RULES = [
+    ('sofa', r'(?i:sofa)'),
+    ('iau-name', r'\b(?:iau|IAU_)(?=[A-Z0-9_])'),
+    ('iau-banner', r'\bi a u\b'),
+]
+
+# regular expressions for text that may contain what the rules match: the
+# accepted phrases, and the license comment the deriver puts at the end of
+# each file (but not the SOFA one it replaces)
+DEFAULT_ALLOWED = [re.escape(s) for s in ACCEPTSOFASTRS] + [
+    r'/\*-{70}\n(?:\*\*[ \t]*\n)*\*\*  Copyright \(C\) \d{4}-\d{4}, '
+    r'NumFOCUS Foundation\..*?\*/',
+]
+
+
+class SofaLinter(object):
+    """
+    Finds the matches of `rules` (a list of ``(name, regex)``) in text,
+    except those inside text matching any of the `allowed` regular
+    expressions.
+    """
+    def __init__(self, rules=None, allowed=None):
+        if rules is None:
+            rules = DEFAULT_RULES
+        if allowed is None:
+            allowed = DEFAULT_ALLOWED
+        self.rules = list(rules)
+        self.allowed = list(allowed)
+
+        # the allowed text comes first so that at any position where it
+        # starts, it is matched (and skipped over) instead of a rule
+        parts = ['(?:{0})'.format('|'.join(allowed))] if allowed else []
+        for i, (_, regex) in enumerate(self.rules):
+            parts.append('(?P<r{0}>{1})'.format(i, regex))
+        self._re = re.compile('|'.join(parts), re.DOTALL)
+
+    def lint_text(self, text, fn=''):
+        """
+        Returns a list of findings in `text`, each a dict with the ``file``
+        (`fn`), ``line`` and ``column`` (both starting at 1), ``rule``,
+        ``match`` and the text of the ``source`` line.
+        """
+        findings = []
+        lineno = 1
+        linestart = 0
+        for match in self._re.finditer(text):
+            if match.lastgroup is None:
+                # an allowed phrase
+                continue
+            start = match.start()
+            lineno += text.count('\n', linestart, start)
+            linestart = text.rfind('\n', 0, start) + 1
+            lineend = text.find('\n', start)
+            if lineend < 0:
+                lineend = len(text)
+            findings.append({'file': fn, 'line': lineno,
+                             'column': start - linestart + 1,
+                             'rule': self.rules[int(match.lastgroup[1:])][0],
+                             'match': match.group(0),
+                             'source': text[linestart:lineend]})
+        return findings
+
+    def lint_file(self, fn):
+        with open(fn, 'rb') as f:
+            text = f.read().decode('utf-8', 'replace')
+        return self.lint_text(text, fn)
+
+
+def iter_source_files(paths):
+    """
+    Yields the C source and header files in `paths`, which can be files or
+    directories (searched recursively).
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for fn in sorted(filenames):
+                if fn.endswith('.c') or fn.endswith('.h'):
+                    yield os.path.join(dirpath, fn)
+
+
+def _lint_files(fns, rules, allowed):
+    linter = SofaLinter(rules, allowed)
+    findings = []
+    for fn in fns:
+        findings.extend(linter.lint_file(fn))
+    return findings
+
+
+def lint_paths(paths, rules=None, allowed=None, jobs=1):
+    """
+    Lints all the files in `paths` (see `iter_source_files`), in `jobs`
+    worker processes (one per CPU if None, or none if 1), and returns the
+    findings (as `SofaLinter.lint_text` does) in file order.
+    """
+    fns = list(iter_source_files(paths))
+    if jobs == 1 or len(fns) < 2:
+        return _lint_files(fns, rules, allowed)
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    njobs = jobs or os.cpu_count() or 1
+    # a few chunks per worker keeps the work even without sending each file
+    # to a worker separately
+    nchunks = min(len(fns), 4 * njobs)
+    chunks = [fns[i::nchunks] for i in range(nchunks)]
+    findings = []
+    with ProcessPoolExecutor(max_workers=njobs) as executor:
+        for result in executor.map(_lint_files, chunks,
+                                   [rules] * nchunks, [allowed] * nchunks):
+            findings.extend(result)
+    order = dict([(fn, i) for i, fn in enumerate(fns)])
+    findings.sort(key=lambda f: (order[f['file']], f['line'], f['column']))
+    return findings
+
+
+def format_findings(findings):
+    """
+    Returns the findings as ``file:line:column: [rule] source`` lines.
+    """
+    return '\n'.join(['{file}:{line}:{column}: [{rule}] {source}'.format(**f)
+                      for f in findings])
+
+
+if __name__ == '__main__':
+    import argparse
+    import collections
+
+    parser = argparse.ArgumentParser(description='Checks SOFA-derived '
+                                                 'source code for leftover '
+                                                 'SOFA names and text.')
+    parser.add_argument('paths', nargs='*', default=['erfa'],
+                        help='The files or directories to check.  Defaults '
+                             'to "erfa".')
+    parser.add_argument('--allow', action='append', default=[],
+                        metavar='PHRASE',
+                        help='Another phrase that may mention SOFA (can be '
+                             'given more than once).')
+    parser.add_argument('--reject', action='append', default=[],
+                        metavar='REGEX',
+                        help='Another regular expression for text that '
+                             'should not be there (can be given more than '
+                             'once).')
+    parser.add_argument('--format', default='text', choices=['text', 'json'],
+                        help='How to print the findings.')
+    parser.add_argument('--jobs', '-j', default=0, type=int,
+                        help='The number of worker processes.  0 (the '
+                             'default) means one per CPU.')
+    parser.add_argument('--check', default=False, action='store_true',
+                        help='Exit with status 1 if anything is found (for '
+                             'CI).')
+    args = parser.parse_args()
+
+    rules = DEFAULT_RULES + [('custom', regex) for regex in args.reject]
+    allowed = DEFAULT_ALLOWED + [re.escape(phrase) for phrase in args.allow]
+    findings = lint_paths(args.paths, rules, allowed, args.jobs or None)
+
+    if args.format == 'json':
+        counts = collections.Counter([f['rule'] for f in findings])
+        json.dump({'findings': findings, 'counts': counts}, sys.stdout,
+                  indent=1, sort_keys=True)
+        print()
+    elif findings:
+        print(format_findings(findings))
+        print('{0} finding(s) in {1} file(s)'.format(
+              len(findings), len(set([f['file'] for f in findings]))),
+              file=sys.stderr)
+
+    if args.check and findings:
+        sys.exit(1)
@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 from __future__ import print_function
 
+from output_sinks import DirectorySink, open_sink
+from pipeline_profile import PipelineProfile
+import source_parser
+
 
 hhdrtempl = """#ifndef {libnameup}HDEF
 #define {libnameup}HDEF
@@ -26,9 +30,36 @@ chdrtempl = """#include "{houtfn}"
 """
 
 
-def flatten_source(srcdir, newname=None, verbose=False, addversion=None):
+def flatten_source(srcdir, newname=None, verbose=False, addversion=None,
+                   profile=None, sink=None, split=None, splitby='bytes',
+                   entrypoints=None, func_prefix='era', orderprofile=None):
+    """
+    Combines the source code in `srcdir` into a single C file, header, and
+    test file, named after `newname` (or `srcdir` if not given).
+
+    If `split` is given (at least 1), the C code is instead split into that
+    many files (``<newname>_1.c``, ``<newname>_2.c``, ...), with roughly
+    equal numbers of bytes (or of input files, if `splitby` is 'files') in
+    each, so they can be compiled in parallel.
+
+    If `entrypoints` is a list of function names, only those functions and
+    the functions they call (directly or indirectly) are included, along with
+    the tests that only use those functions.  `func_prefix` is the prefix of
+    the library's function names.
+
+    If `orderprofile` is a list of ``(name, count)`` pairs (see
+    `read_order_profile`), the hot functions are laid out first, each
+    before the functions it calls, rather than in file name order (see
+    `source_parser.order_functions`).
+
+    The call graph for `entrypoints` and `orderprofile` comes from the
+    `api_index` of `srcdir`, which is updated if needed.
+
+    The files are written into the current directory, unless `sink` is
+    given, in which case they are written to that `output_sinks.OutputSink`
+    (which the caller must close).
+    """
     import os
-    import re
     import glob
 
     if newname is None:
@@ -36,12 +67,48 @@ def flatten_source(srcdir, newname=None, verbose=False, addversion=None):
     else:
         libname = newname
 
+    infns = (glob.glob(os.path.join(srcdir, '*.c')) +
+             glob.glob(os.path.join(srcdir, '*.h')))
+
+    callgraph = None
+    if entrypoints is not None or orderprofile is not None:
+        from api_index import load_index, call_graph
+
+        with (profile or PipelineProfile()).stage('api index'):
+            callgraph = call_graph(load_index(srcdir, func_prefix,
+                                              verbose=verbose), srcdir)
+
+    flatten_files(infns, open, libname, verbose, addversion, profile, sink,
+                  split, splitby, entrypoints, func_prefix, callgraph,
+                  orderprofile)
+
+
+def flatten_files(infns, openfile, libname, verbose=False, addversion=None,
+                  profile=None, sink=None, split=None, splitby='bytes',
+                  entrypoints=None, func_prefix='era', callgraph=None,
+                  orderprofile=None):
+    """
+    Does the work of `flatten_source` on the .c and .h files named in `infns`
+    (and ignores any others).  ``openfile(fn)`` must return the text file
+    object for each one, which makes it possible to flatten files that aren't
+    in a directory.  `callgraph` is the ``(definitions, calls)`` to prune
+    with, if already known (otherwise it is worked out from the files).
+    """
+    import re
+
+    if split is not None and split < 1:
+        raise ValueError('split must be at least 1, not {0!r}'.format(split))
+    if profile is None:
+        profile = PipelineProfile()
+    if sink is None:
+        sink = DirectorySink('.')
+
     coutfn = libname + '.c'
     houtfn = libname + '.h'
     testoutfn = 'test_{fn}.c'.format(fn=libname)
 
-    cinfns = glob.glob(os.path.join(srcdir, '*.c'))
-    hinfns = glob.glob(os.path.join(srcdir, '*.h'))
+    cinfns = [fn for fn in infns if fn.endswith('.c')]
+    hinfns = [fn for fn in infns if fn.endswith('.h')]
 
     testrex = re.compile('.*t_.*?_c.c')
     for fn in cinfns:
@@ -50,49 +117,52 @@ def flatten_source(srcdir, newname=None, verbose=False, addversion=None):
             break
     cinfns.remove(testinfn)
 
+    # work out which functions to keep, if only some are wanted
+    keep = None
+    droppedtests = set()
+    if entrypoints is not None:
+        with profile.stage('call graph'):
+            if callgraph is None:
+                callgraph = source_parser.build_call_graph(cinfns, openfile,
+                                                           func_prefix)
+            definitions, calls = callgraph
+            keep = source_parser.reachable(calls, entrypoints)
+            definedfns = set(definitions.values())
+            keptfns = set([definitions[name] for name in keep])
+            cinfns = [fn for fn in cinfns
+                      if fn in keptfns or fn not in definedfns]
+
+            # drop the tests that use any of the functions left out
+            with openfile(testinfn) as f:
+                for name, lines in source_parser.iter_test_functions(f):
+                    if name is None:
+                        continue
+                    refs = source_parser.referenced_names(''.join(lines),
+                                                          func_prefix)
+                    if [ref for ref in refs
+                            if ref in definitions and ref not in keep]:
+                        droppedtests.add(name)
+        if verbose:
+            print('Keeping {0} of {1} functions and dropping {2} '
+                  'tests'.format(len(keep), len(definitions),
+                                 len(droppedtests)))
+
     # first make sure the macros come first so that any types/structures are
     # defined before the actual
     reordered_hinfns = []
     macrodone = False
-    for hinfn in sorted(hinfns):
-        if hinfn.endswith('m.h'):
-            if macrodone:
-                raise ValueError('Encountered *two* files of the form "*m.h" - '
-                                 'can\'t proceed with this ambiguity, because '
-                                 'the macro definitions have to come first.')
-            reordered_hinfns.insert(0, hinfn)
-            macrodone = True
-        else:
-            reordered_hinfns.append(hinfn)
-
-    #now actually process the header files and combine into one
-    hlines = []
-    for i, fn in enumerate(reordered_hinfns):
-        contentlines, hlicense = extract_content(fn)
-
-        # first remove the header up through the end of the license comment
-        for j, l in enumerate(contentlines):
-            if l.startswith('*/'):
-                hdrendidx = j
-                break
-        else:
-            raise ValueError('Never found comment end in {0}'.format(fn))
-
-        #now look for where the final #ifdef __cplusplus is, and remove all after
-        ifdefidxs = [idx for idx, l in enumerate(contentlines) if l.startswith('#ifdef __cplusplus')]
-        if len(ifdefidxs) > 0:
-            upto = max(ifdefidxs)
-        else:
-            #if no cplusplus's, strip from the last #endif
-            ifdefidxs = [idx for idx, l in enumerate(contentlines) if l.startswith('#endif')]
-            upto = max(ifdefidxs)
-
-        hlines.extend(contentlines[(hdrendidx + 1):upto])
-
-    clines = []
-    for fn in sorted(cinfns):
-        contentlines, clicense = extract_content(fn)
-        clines.extend(contentlines)
+    with profile.stage('header reorder'):
+        for hinfn in sorted(hinfns):
+            if hinfn.endswith('m.h'):
+                if macrodone:
+                    raise ValueError('Encountered *two* files of the form '
+                                     '"*m.h" - can\'t proceed with this '
+                                     'ambiguity, because the macro '
+                                     'definitions have to come first.')
+                reordered_hinfns.insert(0, hinfn)
+                macrodone = True
+            else:
+                reordered_hinfns.append(hinfn)
 
     #construct the version info string, if needed
     if addversion:
@@ -100,28 +170,77 @@ def flatten_source(srcdir, newname=None, verbose=False, addversion=None):
     else:
         versionstr = ''
 
-    #now save out the hlines and clines, putting in the appropriate headers and ending license
+    # now write out the header and C files, streaming the content of each
+    # input file straight into them, and putting in the appropriate headers
+    # and ending license.  Only the license from the last file is used.
     if verbose:
-        print('Writing', houtfn)
-    with open(houtfn, 'w') as fw:
+        print('Writing', sink.describe(houtfn))
+    with profile.stage('write', files=1):
+        fw = sink.open(houtfn)
+    try:
         if versionstr:
             fw.write(versionstr)
         fw.write(hhdrtempl.format(libnamespace=' '.join(libname),
                                   libnameup=libname.upper(),
                                   libname=libname))
-        fw.write(''.join(hlines))
-        #need to add an extra endif
-        fw.write('#endif\n\n')
-        fw.write(hlicense)
-
-    if verbose:
-        print('Writing', coutfn)
-    with open(coutfn, 'w') as fw:
-        if versionstr:
-            fw.write(versionstr)
-        fw.write(chdrtempl.format(houtfn=houtfn))
-        fw.write(''.join(clines))
-        fw.write(clicense)
+        for fn in reordered_hinfns:
+            with profile.stage('extract_content', files=1) as counts:
+                start = fw.tell()
+                lines = _iter_header_content(fn, openfile)
+                if keep is not None:
+                    lines = _pruned_prototypes(lines, keep, func_prefix)
+                fw.writelines(lines)
+                counts['bytes_out'] = fw.tell() - start
+        with profile.stage('write'):
+            #need to add an extra endif
+            fw.write('#endif\n\n')
+            fw.write(extract_content(reordered_hinfns[-1], openfile)[1])
+    finally:
+        fw.close()
+
+    cinfns = sorted(cinfns)
+    clicense = extract_content(cinfns[-1], openfile)[1]
+    if orderprofile is not None:
+        with profile.stage('function order'):
+            if callgraph is None:
+                callgraph = source_parser.build_call_graph(cinfns, openfile,
+                                                           func_prefix)
+            cinfns = order_files(cinfns, callgraph, orderprofile)
+    if split is None:
+        cgroups = [(coutfn, cinfns)]
+    else:
+        with profile.stage('split'):
+            if splitby == 'bytes':
+                weights = [sum([len(l) for l in iter_content(fn, openfile)])
+                           for fn in cinfns]
+            elif splitby == 'files':
+                weights = [1] * len(cinfns)
+            else:
+                raise ValueError('splitby must be "bytes" or "files", not '
+                                 '{0!r}'.format(splitby))
+            width = len(str(split))
+            coutfns = ['{0}_{1:0{2}d}.c'.format(libname, i + 1, width)
+                       for i in range(split)]
+            cgroups = zip(coutfns, split_evenly(cinfns, weights, split))
+
+    for outfn, groupfns in cgroups:
+        if verbose:
+            print('Writing', sink.describe(outfn))
+        with profile.stage('write', files=1):
+            fw = sink.open(outfn)
+        try:
+            if versionstr:
+                fw.write(versionstr)
+            fw.write(chdrtempl.format(houtfn=houtfn))
+            for fn in groupfns:
+                with profile.stage('extract_content', files=1) as counts:
+                    start = fw.tell()
+                    fw.writelines(iter_content(fn, openfile))
+                    counts['bytes_out'] = fw.tell() - start
+            with profile.stage('write'):
+                fw.write(clicense)
+        finally:
+            fw.close()
 
     #finally, save out the test file with relevant modifications
     macroincludestr = '#include "{0}"'.format(houtfn.replace('.h', 'm.h'))
@@ -129,22 +248,187 @@ def flatten_source(srcdir, newname=None, verbose=False, addversion=None):
     quotedinclstr = angledinclstr.replace('<','"').replace('>','"')
 
     if verbose:
-        print('Writing', testoutfn)
-    with open(testoutfn, 'w') as fw:
-        with open(testinfn) as fr:
-            s = fr.read()
+        print('Writing', sink.describe(testoutfn))
+    with profile.stage('write', files=1) as counts:
+        with sink.open(testoutfn) as fw:
+            with openfile(testinfn) as fr:
+                if versionstr:
+                    fw.write(versionstr)
+                lines = fr
+                if droppedtests:
+                    lines = _pruned_tests(lines, droppedtests)
+                for l in lines:
+                    fw.write(l.replace(macroincludestr, '').replace(angledinclstr, quotedinclstr))
+            counts['bytes_out'] = fw.tell()
+
+
+def order_files(cinfns, callgraph, counts):
+    """
+    Returns the C files `cinfns` in the order of the functions they define,
+    as given by `source_parser.order_functions` for the ``(definitions,
+    calls)`` in `callgraph` and the profile `counts`.  Files that do not
+    define any function go last, in name order.
+    """
+    definitions, calls = callgraph
+    position = {}
+    for name in source_parser.order_functions(calls, counts):
+        position.setdefault(definitions[name], len(position))
+    return sorted(cinfns, key=lambda fn: (position.get(fn, len(position)),
+                                          fn))
+
+
+def read_order_profile(fn):
+    """
+    Reads a function ordering profile from the file `fn` and returns it as
+    a list of ``(name, count)`` pairs.  The file can be the JSON output of
+    `microbench.py`, a JSON object mapping function names to call counts, or
+    a text file with a function name (optionally followed by a count) per
+    line, e.g. a list of entry points, hottest first.
+
+    `microbench.py` does not count calls: its ``iterations`` are the length
+    of the timing loop, which is shorter for the slower functions.  So its
+    functions are only ranked, those with the most iterations (the
+    cheapest, which tend to be called the most) first, with counts of 0.
+    """
+    import json
 
-            if versionstr:
-                fw.write(versionstr)
-            fw.write(s.replace(macroincludestr, '').replace(angledinclstr, quotedinclstr))
+    with open(fn) as f:
+        text = f.read()
+    if fn.endswith('.json'):
+        data = json.loads(text)
+        if 'results' in data:
+            results = sorted(data['results'],
+                             key=lambda result: (-result['iterations'],
+                                                 result['name']))
+            return [(result['name'], 0) for result in results]
+        return sorted(data.items())
+
+    counts = []
+    for l in text.splitlines():
+        words = l.split()
+        if words:
+            counts.append((words[0], int(words[1]) if len(words) > 1 else 0))
+    return counts
+
+
+def parse_order_profile(value):
+    """
+    Returns the ordering profile for the command-line `value`: the name of
+    a file for `read_order_profile`, or a comma-separated list of function
+    names, hottest first.
+    """
+    import os
+
+    if os.path.isfile(value):
+        return read_order_profile(value)
+    return [(name.strip(), 0) for name in value.split(',')]
+
+
+def split_evenly(items, weights, n):
+    """
+    Splits `items` into `n` lists, keeping them in order, so that the total
+    of the `weights` of the items in each list is roughly the same.  Each
+    item goes in the list its midpoint falls in, so the result depends only
+    on the items and weights.
+    """
+    if n < 1:
+        raise ValueError('Cannot split into {0} lists'.format(n))
+    total = float(sum(weights))
+    groups = [[] for i in range(n)]
+    cumulative = 0
+    for item, weight in zip(items, weights):
+        if total:
+            idx = min(int((cumulative + weight / 2.) / total * n), n - 1)
+        else:
+            idx = 0
+        groups[idx].append(item)
+        cumulative += weight
+    return groups
+
+
+def _pruned_prototypes(lines, keep, func_prefix):
+    """
+    Yields the header `lines`, except for the prototypes of functions that
+    are not in `keep`.
+    """
+    for name, group in source_parser.iter_prototypes(lines, func_prefix):
+        if name is None or name in keep:
+            for l in group:
+                yield l
+
+
+def _pruned_tests(lines, droppedtests):
+    """
+    Yields the test program `lines`, except for the test functions in
+    `droppedtests` and the lines in main() that call them.
+    """
+    for name, group in source_parser.iter_test_functions(lines):
+        if name is None:
+            match = source_parser.TEST_CALL_RE.match(group[0])
+            if match is None or match.group(1) not in droppedtests:
+                yield group[0]
+        elif name not in droppedtests:
+            for l in group:
+                yield l
+
+
+def _iter_header_content(fn, openfile=open):
+    """
+    Yields the content lines of the header `fn` that go in the combined
+    header: those after its opening comment, and before the final
+    ``#ifdef __cplusplus`` (or, if there is none, the final ``#endif``).
+    """
+    # first find where the header comment ends and where the content stops
+    # without holding on to the lines
+    hdrendidx = lastifdefidx = lastendifidx = None
+    for idx, l in enumerate(iter_content(fn, openfile)):
+        if hdrendidx is None and l.startswith('*/'):
+            hdrendidx = idx
+        elif l.startswith('#ifdef __cplusplus'):
+            lastifdefidx = idx
+        elif l.startswith('#endif'):
+            lastendifidx = idx
+    if hdrendidx is None:
+        raise ValueError('Never found comment end in {0}'.format(fn))
+    upto = lastendifidx if lastifdefidx is None else lastifdefidx
+    if upto is None:
+        raise ValueError('Never found #ifdef __cplusplus or #endif in '
+                         '{0}'.format(fn))
+
+    for idx, l in enumerate(iter_content(fn, openfile)):
+        if idx >= upto:
+            break
+        elif idx > hdrendidx:
+            yield l
 
 
-def extract_content(fn):
+def iter_content(fn, openfile=open):
+    """
+    Yields the lines of `fn` that go in the combined file: the same as the
+    lines from `extract_content`, but without reading the license.
+    """
+    lastincl = False
+    with openfile(fn) as f:
+        for l in f:
+            if l.startswith('#include'):
+                lastincl = True
+            elif lastincl and l.strip() in ('', '**'):
+                # don't include unnecessary blank lines
+                lastincl = False
+            elif l.startswith('/*----------------------------------------------------------------------'):
+                yield '\n'
+                return
+            else:
+                yield l
+                lastincl = False
+
+
+def extract_content(fn, openfile=open):
     lastincl = False
     inlicense = False
     lines = []
     licenselines = []
-    with open(fn) as f:
+    with openfile(fn) as f:
         for l in f:
             if l.startswith('#include'):
                 lastincl = True
@@ -180,13 +464,50 @@ if __name__ == '__main__':
     parser.add_argument('--newname', '-n', default=None, help='The base name '
                         'to use for the new files.  Will default to the same '
                         'as the source directory if not given.')
+    parser.add_argument('--output', '-o', default=None,
+                        help='Where to write the combined files.  Can be a '
+                             'directory, or a .tar.gz/.zip file to write them '
+                             'into directly.  Defaults to the current '
+                             'directory.')
     parser.add_argument('--include-version', '-v', default=None, help='Gives a'
                         'version number to put at the header of the generated '
                         'files.  If not given, no version number will be '
                         'present.' )
+    parser.add_argument('--profile', '-p', nargs='?', default=None,
+                        const='-', metavar='JSONFILE',
+                        help='Record how long each stage takes.  Prints a '
+                             'summary, or writes a JSON report if a file name '
+                             'is given.')
+    parser.add_argument('--cprofile', default=None, metavar='FILE',
+                        help='Run the flattening under cProfile and dump the '
+                             'stats to this file.')
+    parser.add_argument('--split', '-s', default=None, type=int, metavar='N',
+                        help='Split the C code into N files of about the same '
+                             'size (which all use the same header), so they '
+                             'can be compiled in parallel.')
+    parser.add_argument('--split-by', default='bytes',
+                        choices=['bytes', 'files'],
+                        help='Whether --split should balance the number of '
+                             'bytes or of input files in each file.')
+    parser.add_argument('--entry-points', '-e', default=None,
+                        help='Only include these functions (a comma-separated '
+                             'list, or a file with one per line) and the '
+                             'functions they call, and only the tests of '
+                             'those.')
+    parser.add_argument('--order-profile', default=None,
+                        help='Lay the hot functions out first, callers '
+                             'before the functions they call, according '
+                             'to this profile: a microbench.py JSON output, '
+                             'a JSON object of call counts, a file with one '
+                             'function (and optionally its count) per line, '
+                             'or a comma-separated list of functions.')
+    parser.add_argument('--func-prefix', default='era',
+                        help='The prefix of the library\'s function names.')
     parser.add_argument('--quiet', '-q', default=False, action='store_true',
                         help='Print less info to the terminal.')
     args = parser.parse_args()
+    if args.split is not None and args.split < 1:
+        parser.error('--split must be at least 1')
 
     if args.srcdir is None:
         dirfns = [fn for fn in os.listdir('.') if os.path.isdir(fn)]
@@ -212,4 +533,39 @@ if __name__ == '__main__':
     else:
         srcdir = args.srcdir
 
-    flatten_source(srcdir, args.newname, not args.quiet, args.include_version)
+    profile = PipelineProfile()
+    if args.cprofile:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    entrypoints = None
+    if args.entry_points is not None:
+        if os.path.isfile(args.entry_points):
+            with open(args.entry_points) as f:
+                entrypoints = [l.strip() for l in f if l.strip()]
+        else:
+            entrypoints = [name.strip() for name in args.entry_points.split(',')]
+    orderprofile = None
+    if args.order_profile is not None:
+        orderprofile = parse_order_profile(args.order_profile)
+
+    sink = None if args.output is None else open_sink(args.output,
+                                                      verbose=not args.quiet)
+    try:
+        flatten_source(srcdir, args.newname, not args.quiet,
+                       args.include_version, profile=profile, sink=sink,
+                       split=args.split, splitby=args.split_by,
+                       entrypoints=entrypoints, func_prefix=args.func_prefix,
+                       orderprofile=orderprofile)
+    finally:
+        if sink is not None:
+            sink.close()
+    if args.cprofile:
+        profiler.disable()
+        profiler.dump_stats(args.cprofile)
+
+    if args.profile == '-':
+        print(profile.summary())
+    elif args.profile is not None:
+        profile.write_json(args.profile)
@@ -0,0 +1,227 @@
+from __future__ import print_function
+
+"""
+Lightweight parsing of the SOFA-derived C source code.  These are not a C
+parser: they rely on the very regular layout of the SOFA/ERFA sources
+(one function per file, prototypes in the header, ``t_*`` test functions in
+the test program).
+"""
+
+import re
+
+
+_COMMENT_OR_STRING_RE = re.compile(r'/\*.*?\*/|//[^\n]*|("(?:\\.|[^"\\\n])*"'
+                                   r"|'(?:\\.|[^'\\\n])*')", re.DOTALL)
+
+# matches the lines in the test program's main() that run a test function
+TEST_CALL_RE = re.compile(r'^\s*(t_\w+)\s*\(\s*&status\s*\)\s*;')
+
+
+def blank_comments_and_strings(text):
+    """
+    Returns `text` with every comment and string/character literal replaced
+    by spaces (keeping newlines), so the result has the same length and line
+    numbers but only code is left.
+    """
+    return _COMMENT_OR_STRING_RE.sub(_blank_match, text)
+
+
+def _blank_match(match):
+    return '\n'.join([' ' * len(line)
+                      for line in match.group(0).split('\n')])
+
+
+def strip_comments(text):
+    """
+    Returns `text` with every comment replaced by a space (but the string
+    and character literals left alone).
+    """
+    # the literals are matched too, so comment markers in them are skipped
+    return _COMMENT_OR_STRING_RE.sub(lambda m: m.group(1) or ' ', text)
+
+
+def _name_re(prefix):
+    return re.compile(r'\b' + re.escape(prefix) + r'[A-Z0-9]\w*')
+
+
+def referenced_names(text, prefix='era'):
+    """
+    Returns the set of identifiers starting with `prefix` (followed by an
+    upper-case letter or digit) used in the code of `text`.
+    """
+    return set(_name_re(prefix).findall(blank_comments_and_strings(text)))
+
+
+def defined_function(text, prefix='era'):
+    """
+    Returns the name of the function starting with `prefix` that is defined
+    in the source file `text`, or None if there isn't one.
+    """
+    code = blank_comments_and_strings(text)
+    match = re.search(r'^[^#\n][^\n]*?\b(' + re.escape(prefix) +
+                      r'[A-Z0-9]\w*)\s*\(', code, re.MULTILINE)
+    if match is None:
+        return None
+    return match.group(1)
+
+
+def build_call_graph(fns, openfile=open, prefix='era'):
+    """
+    Reads the source files `fns` (with ``openfile(fn)``) and returns
+    ``(definitions, calls)``: a dict mapping each function name to the file
+    defining it, and a dict mapping each function name to the sorted list of
+    other functions (defined in `fns`) that it uses.
+    """
+    definitions = {}
+    references = {}
+    for fn in fns:
+        with openfile(fn) as f:
+            text = f.read()
+        name = defined_function(text, prefix)
+        if name is not None:
+            definitions[name] = fn
+            references[name] = referenced_names(text, prefix)
+            references[name].discard(name)
+
+    calls = {}
+    for name, refs in references.items():
+        calls[name] = sorted([ref for ref in refs if ref in definitions])
+    return definitions, calls
+
+
+def reachable(calls, entrypoints):
+    """
+    Returns the set of functions in the call graph `calls` (as returned by
+    `build_call_graph`) that are `entrypoints` or are called from them,
+    directly or indirectly.
+    """
+    unknown = [name for name in entrypoints if name not in calls]
+    if unknown:
+        raise ValueError('Unknown entry point function(s): ' +
+                         ', '.join(unknown))
+
+    seen = set()
+    stack = list(entrypoints)
+    while stack:
+        name = stack.pop()
+        if name not in seen:
+            seen.add(name)
+            stack.extend(calls[name])
+    return seen
+
+
+def order_functions(calls, counts):
+    """
+    Returns the functions in the call graph `calls` (as returned by
+    `build_call_graph`) in the order to lay them out in, so that the ones
+    called together end up together.  `counts` is a list of ``(name,
+    count)`` pairs from a profile, where a higher count (or, for equal
+    counts, coming earlier) means hotter.
+
+    The hot functions (the profiled ones and everything they call) are laid
+    out callers first: a function is only placed once all of its hot
+    callers are, and then straight after the last of them, depth first, so
+    call chains stay together.  Functions (and callees) are taken hottest
+    first, where a function is as hot as the total count of the profiled
+    functions it reaches.  Cycles are broken at their hottest profiled
+    function.  The functions that are not hot come last, in name order.
+    Names that are not in `calls` are ignored, and the result only depends
+    on the arguments.
+    """
+    countof = {}
+    rank = {}
+    for i, (name, count) in enumerate(counts):
+        if name in calls and name not in rank:
+            countof[name] = count
+            rank[name] = i
+
+    hot = reachable(calls, rank)
+    hotcalls = dict([(name, set([callee for callee in calls[name]
+                                 if callee in hot and callee != name]))
+                     for name in hot])
+    hotness = {}
+    for name in hot:
+        profiled = [callee for callee in reachable(hotcalls, [name])
+                    if callee in rank]
+        hotness[name] = (-sum([countof[callee] for callee in profiled]),
+                         min([rank[callee] for callee in profiled] +
+                             [len(rank)]), name)
+
+    ncallers = dict([(name, 0) for name in hot])
+    for name in hot:
+        for callee in hotcalls[name]:
+            ncallers[callee] += 1
+
+    ordered = []
+    seen = set()
+    # coldest first, so the hottest is popped next
+    stack = sorted([name for name in hot if not ncallers[name]],
+                   key=hotness.get, reverse=True)
+    while len(seen) < len(hot):
+        if not stack:
+            # the rest are only called from cycles
+            stack.append(min(hot - seen, key=lambda name: (
+                -countof.get(name, 0), rank.get(name, len(rank)), name)))
+        name = stack.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        ordered.append(name)
+        for callee in sorted(hotcalls[name], key=hotness.get, reverse=True):
+            ncallers[callee] -= 1
+            if not ncallers[callee]:
+                stack.append(callee)
+    ordered.extend(sorted(set(calls) - seen))
+    return ordered
+
+
+def iter_prototypes(lines, prefix='era'):
+    """
+    Groups the header `lines` into ``(name, lines)`` pairs, where `name` is
+    the function declared by a (possibly multi-line) prototype, or None for
+    lines that are not part of a prototype.
+    """
+    protore = re.compile(r'^[A-Za-z_][\w \t\*]*?\b(' + re.escape(prefix) +
+                         r'[A-Z0-9]\w*)\s*\(')
+    name = None
+    group = []
+    for l in lines:
+        if name is None:
+            match = protore.match(l)
+            if match is None:
+                yield None, [l]
+                continue
+            name = match.group(1)
+        group.append(l)
+        if l.rstrip().endswith(';'):
+            yield name, group
+            name = None
+            group = []
+    if group:
+        yield name, group
+
+
+def iter_test_functions(lines):
+    """
+    Groups the lines of a SOFA-style test program into ``(name, lines)``
+    pairs, where `name` is the ``t_*`` test function defined by `lines`, or
+    None for lines outside of test functions.
+    """
+    startre = re.compile(r'^static\s+void\s+(t_\w+)\s*\(')
+    name = None
+    group = []
+    for l in lines:
+        if name is None:
+            match = startre.match(l)
+            if match is None:
+                yield None, [l]
+                continue
+            name = match.group(1)
+        group.append(l)
+        if l.startswith('}'):
+            yield name, group
+            name = None
+            group = []
+    if group:
+        yield name, group
+
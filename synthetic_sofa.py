@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+"""
+This script generates synthetic SOFA-style .tar.gz files, for benchmarking
+and exercising the tools in this repository without the real SOFA.
+
+The generated files follow the layout of the real SOFA C library that
+`sofa_deriver` expects: ``iau``-prefixed functions with SOFA-style doc
+comments and license blocks, a ``sofa.h`` with the prototypes, a ``sofam.h``
+with the macros, and a ``t_sofa_c.c`` test program.  The C code compiles and
+the test program passes, but the functions themselves are just arithmetic.
+
+Do::
+
+  python synthetic_sofa.py --help
+
+To see the options.
+"""
+
+import io
+import random
+import tarfile
+
+
+SOFA_LICENSE_STR = """/*----------------------------------------------------------------------
+**
+**  Copyright (C) {year}
+**  Standards Of Fundamental Astronomy Board
+**  of the International Astronomical Union.
+**
+**  =====================
+**  SOFA Software License
+**  =====================
+**
+**  NOTICE TO USER:
+**
+**  BY USING THIS SOFTWARE YOU ACCEPT THE FOLLOWING SIX TERMS AND
+**  CONDITIONS WHICH APPLY TO ITS USE.
+**
+**  1. The Software is owned by the IAU SOFA Board ("SOFA").
+**
+**  2. Permission is granted to anyone to use the SOFA software for any
+**     purpose, including commercial applications, free of charge and
+**     without payment of royalties, subject to the conditions and
+**     restrictions listed below.
+**
+**  Correspondence concerning SOFA software should be addressed as
+**  follows:
+**
+**      By email:  sofa@ukho.gov.uk
+**      By post:   IAU SOFA Center
+**                 HM Nautical Almanac Office
+**                 UK Hydrographic Office
+**                 Admiralty Way, Taunton
+**                 Somerset, TA1 2DN
+**                 United Kingdom
+**
+**--------------------------------------------------------------------*/
+"""
+
+SOFA_PART_OF_STR = """**  This function is part of the International Astronomical Union's
+**  SOFA (Standards of Fundamental Astronomy) software collection.
+"""
+
+SOFA_FILE_PART_OF_STR = SOFA_PART_OF_STR.replace('function', 'file')
+
+
+def _spaced(s):
+    return ' '.join(s)
+
+
+def _dashes(s):
+    return ' '.join(['-'] * ((len(_spaced(s)) + 3) // 2))
+
+
+def _doc_header(name):
+    return ('**  {dashes}\n**   {spaced}\n**  {dashes}\n'
+            '**\n').format(dashes=_dashes(name), spaced=_spaced(name))
+
+
+def _release_footer(year, release, revision='2021 May 11'):
+    return ('**  This revision:  {revision}\n'
+            '**\n'
+            '**  SOFA release {rel}\n'
+            '**\n'
+            '**  Copyright (C) {year} IAU SOFA Board.  See notes at end.\n'
+            '*/\n').format(revision=revision, year=year,
+                           rel='-'.join([release[:4], release[4:6], release[6:]]))
+
+
+class SyntheticSOFA(object):
+    """
+    A randomly-generated SOFA-like library.
+
+    `nfiles` is the number of function source files, `lines_per_file` the
+    number of statements in each function body, `nmacros` the number of
+    macros in ``sofam.h`` and `comment_density` the fraction of body lines
+    that are comments.  The same `seed` always gives the same library.
+    """
+    def __init__(self, nfiles=200, lines_per_file=30, nmacros=50,
+                 comment_density=0.2, seed=0, release='20210512'):
+        self.nfiles = nfiles
+        self.lines_per_file = lines_per_file
+        self.nmacros = nmacros
+        self.comment_density = comment_density
+        self.release = release
+        self.year = release[:4]
+
+        rng = random.Random(seed)
+        self.macros = [('DM{0:03d}'.format(i), 1.0 + rng.randint(1, 999) / 1000.0)
+                       for i in range(nmacros)]
+        self.funcs = []
+        for i in range(nfiles):
+            body = []
+            for j in range(lines_per_file):
+                if rng.random() < comment_density:
+                    body.append(('comment', rng.choice(_COMMENTS)))
+                else:
+                    body.append(('term', rng.randint(0, 2),
+                                 rng.randint(0, nmacros - 1) if nmacros else None))
+            # call one of the earlier functions half of the time
+            callee = rng.randint(0, i - 1) if i > 0 and rng.random() < 0.5 else None
+            self.funcs.append(('Fn{0:04d}'.format(i), body, callee))
+
+    def evaluate(self, i, a, b):
+        """
+        Computes in Python what function `i` returns in C.
+        """
+        name, body, callee = self.funcs[i]
+        w = a
+        for line in body:
+            if line[0] == 'term':
+                m = self.macros[line[2]][1] if line[2] is not None else 1.0
+                w = w * 0.5 + b[line[1]] * m
+        if callee is not None:
+            w += self.evaluate(callee, a, b) * 1e-3
+        return w
+
+    def c_source(self, i):
+        name, body, callee = self.funcs[i]
+        fn = 'iau' + name
+        lns = ['#include "sofa.h"\n', '#include "sofam.h"\n', '\n',
+               'double {0}(double a, double b[3])\n'.format(fn),
+               '/*\n', _doc_header(fn),
+               '**  Synthetic function number {0}.\n'.format(i), '**\n',
+               SOFA_PART_OF_STR, '**\n',
+               '**  Status:  support function.\n', '**\n',
+               '**  Given:\n',
+               '**     a      double     scalar argument\n',
+               '**     b      double[3]  vector argument\n', '**\n',
+               '**  Returned (function value):\n',
+               '**            double     the result\n', '**\n']
+        if callee is not None:
+            lns.extend(['**  Called:\n',
+                        '**     iau{0}   synthetic function\n'.format(self.funcs[callee][0]),
+                        '**\n'])
+        lns.append(_release_footer(self.year, self.release))
+        lns.extend(['{\n', '   double w;\n', '\n', '   w = a;\n'])
+        for line in body:
+            if line[0] == 'comment':
+                lns.append('\n/* {0} */\n'.format(line[1]))
+            else:
+                m = self.macros[line[2]][0] if line[2] is not None else '1.0'
+                lns.append('   w = w * 0.5 + b[{0}] * {1};\n'.format(line[1], m))
+        if callee is not None:
+            lns.append('   w += iau{0}(a, b) * 1e-3;\n'.format(self.funcs[callee][0]))
+        lns.extend(['\n', '   return w;\n', '\n', '/* Finished. */\n', '\n',
+                    SOFA_LICENSE_STR.format(year=self.year), '}\n'])
+        return ''.join(lns)
+
+    def sofa_h(self):
+        lns = ['#ifndef SOFAHDEF\n', '#define SOFAHDEF\n', '\n', '/*\n',
+               _doc_header('sofa.h'),
+               '**  Prototype function declarations for SOFA library.\n', '**\n',
+               SOFA_FILE_PART_OF_STR, '**\n', _release_footer(self.year, self.release),
+               '\n', '#include "math.h"\n', '\n',
+               '#ifdef __cplusplus\n', 'extern "C" {\n', '#endif\n', '\n',
+               '/* Star-independent astrometry parameters */\n',
+               'typedef struct {\n', '   double pmt;\n', '   double eb[3];\n',
+               '} iauASTROM;\n', '\n', '/* Synthetic functions */\n']
+        for name, body, callee in self.funcs:
+            lns.append('double iau{0}(double a, double b[3]);\n'.format(name))
+        lns.extend(['\n', '#ifdef __cplusplus\n', '}\n', '#endif\n', '\n',
+                    '#endif\n', '\n', SOFA_LICENSE_STR.format(year=self.year)])
+        return ''.join(lns)
+
+    def sofam_h(self):
+        lns = ['#ifndef SOFAMHDEF\n', '#define SOFAMHDEF\n', '\n', '/*\n',
+               _doc_header('sofam.h'), '**  Macros used by SOFA library.\n',
+               '**\n', SOFA_FILE_PART_OF_STR, '**\n',
+               _release_footer(self.year, self.release), '\n',
+               '/* Pi */\n', '#define DPI (3.141592653589793238462643)\n', '\n',
+               '/* dint(A) - truncate to nearest whole number towards zero '
+               '(double) */\n',
+               '#define dint(A) ((A)<0.0?ceil(A):floor(A))\n', '\n']
+        for macro, value in self.macros:
+            lns.append('/* Synthetic constant */\n')
+            lns.append('#define {0} ({1!r})\n'.format(macro, value))
+            lns.append('\n')
+        lns.extend(['#endif\n', '\n', SOFA_LICENSE_STR.format(year=self.year)])
+        return ''.join(lns)
+
+    def test_c(self):
+        lns = ['#include <sofa.h>\n', '#include "sofam.h"\n',
+               '#include <stdio.h>\n', '#include <stdlib.h>\n', '\n',
+               'static int verbose = 0;\n', '\n', '/*\n',
+               _doc_header('t_sofa_c'), '**  Validate the SOFA C functions.\n',
+               '**\n', _release_footer(self.year, self.release), '\n',
+               _VVD_SOURCE]
+        rng = random.Random(self.nfiles)
+        for i, (name, body, callee) in enumerate(self.funcs):
+            a = round(rng.uniform(-2, 2), 3)
+            b = [round(rng.uniform(-2, 2), 3) for _ in range(3)]
+            val = self.evaluate(i, a, b)
+            t = 't_' + name.lower()
+            lns.extend(['static void {0}(int *status)\n'.format(t), '/*\n',
+                        _doc_header(t), '**  Test iau{0} function.\n'.format(name),
+                        '**\n', '**  Returned:\n',
+                        '**     status    int         FALSE = success, TRUE = fail\n',
+                        '**\n', '**  Called:  iau{0}, vvd\n'.format(name), '**\n',
+                        '**  This revision:  2013 August 7\n', '*/\n', '{\n',
+                        '   double b[3], w;\n', '\n'])
+            for k in range(3):
+                lns.append('   b[{0}] = {1!r};\n'.format(k, b[k]))
+            lns.extend(['\n', '   w = iau{0}({1!r}, b);\n'.format(name, a), '\n',
+                        '   vvd(w, {0!r}, {1!r}, "iau{2}", "", status);\n'.format(
+                            val, 1e-9 * (abs(val) + 1), name),
+                        '\n', '}\n', '\n'])
+        lns.extend(['int main(int argc, char *argv[])\n', '/*\n',
+                    _doc_header('main'), '**  This revision:  2013 August 7\n',
+                    '*/\n', '{\n', '   int status;\n', '\n', '\n',
+                    '/* If any command-line argument, switch to verbose '
+                    'reporting. */\n',
+                    '   if (argc > 1) {\n', '      verbose = 1;\n',
+                    '      argv[0][0] += 0;    /* to avoid compiler warnings */\n',
+                    '   }\n', '\n', '/* Preset the &status to FALSE = success. */\n',
+                    '   status = 0;\n', '\n', '/* Test all of the SOFA functions. */\n'])
+        for name, body, callee in self.funcs:
+            lns.append('   t_{0}(&status);\n'.format(name.lower()))
+        lns.extend(['\n', '/* Report, set up an appropriate exit status, and '
+                    'finish. */\n',
+                    '   if (status) {\n',
+                    '      printf("t_sofa_c validation failed!\\n");\n',
+                    '   } else {\n',
+                    '      printf("t_sofa_c validation successful\\n");\n',
+                    '   }\n', '   return status;\n', '}\n',
+                    SOFA_LICENSE_STR.format(year=self.year)])
+        return ''.join(lns)
+
+    def members(self):
+        """
+        Returns a list of (name, contents) for each file in the tar file.
+        """
+        prefix = 'sofa/{0}/c/'.format(self.release)
+        members = [(prefix + '00READ.ME', 'Synthetic SOFA, for testing only.\n'),
+                   (prefix + 'src/makefile', 'all:\n\t$(CC) -c *.c\n')]
+        for i, (name, body, callee) in enumerate(self.funcs):
+            members.append((prefix + 'src/{0}.c'.format(name.lower()),
+                            self.c_source(i)))
+        members.append((prefix + 'src/t_sofa_c.c', self.test_c()))
+        members.append((prefix + 'src/sofa.h', self.sofa_h()))
+        # put the macros last, as that is the hard case for the deriver
+        members.append((prefix + 'src/sofam.h', self.sofam_h()))
+        return members
+
+    def write_tarfile(self, fn):
+        """
+        Writes the library out as a SOFA-style .tar.gz file named `fn`.
+        """
+        tf = tarfile.open(fn, 'w:gz')
+        try:
+            for name, contents in self.members():
+                data = contents.encode('ascii')
+                ti = tarfile.TarInfo(name)
+                ti.size = len(data)
+                ti.mtime = 1600000000
+                tf.addfile(ti, io.BytesIO(data))
+        finally:
+            tf.close()
+        return fn
+
+
+def make_synthetic_sofa(fn, **kwargs):
+    """
+    Writes a `SyntheticSOFA` (created with `kwargs`) to the .tar.gz file `fn`
+    and returns the `SyntheticSOFA`.
+    """
+    sofa = SyntheticSOFA(**kwargs)
+    sofa.write_tarfile(fn)
+    return sofa
+
+
+_COMMENTS = ['Scale the result.', 'Apply the correction.',
+             'Accumulate the terms.', 'Rotate into the new frame.',
+             'This is a SOFA-style comment mentioning iauAnp.',
+             'Precompute the trigonometric functions.']
+
+_VVD_SOURCE = r"""static void vvd(double val, double valok, double dval,
+                const char *func, const char *test, int *status)
+/*
+**  - - - -
+**   v v d
+**  - - - -
+**
+**  Validate a double result.
+**
+**  This revision:  2016 April 21
+*/
+{
+   double a, f;   /* absolute and fractional error */
+
+
+   a = val - valok;
+   if (a != 0.0 && fabs(a) > fabs(dval)) {
+      f = fabs(valok / a);
+      *status = 1;
+      printf("%s failed: %s want %.20g got %.20g (1/%.3g)\n",
+             func, test, valok, val, f);
+   } else if (verbose) {
+      printf("%s passed: %s want %.20g got %.20g\n",
+                    func, test, valok, val);
+   }
+
+}
+
+"""
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Generates a synthetic '
+                                                 'SOFA-style .tar.gz file.')
+    parser.add_argument('outfile', nargs='?', default='sofa_c-synthetic.tar.gz',
+                        help='The file to write.')
+    parser.add_argument('--files', '-n', type=int, default=200,
+                        help='The number of function source files.')
+    parser.add_argument('--lines', '-l', type=int, default=30,
+                        help='The number of statements in each function.')
+    parser.add_argument('--macros', '-m', type=int, default=50,
+                        help='The number of macros in sofam.h.')
+    parser.add_argument('--comment-density', '-c', type=float, default=0.2,
+                        help='The fraction of function lines that are '
+                             'comments.')
+    parser.add_argument('--seed', '-s', type=int, default=0,
+                        help='The random seed.')
+    args = parser.parse_args()
+
+    make_synthetic_sofa(args.outfile, nfiles=args.files,
+                        lines_per_file=args.lines, nmacros=args.macros,
+                        comment_density=args.comment_density, seed=args.seed)
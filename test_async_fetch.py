@@ -0,0 +1,205 @@
+"""
+Tests for `async_fetch`, against local stand-in HTTP servers.  Do::
+
+  python -m pytest test_async_fetch.py
+"""
+
+import os
+import re
+import sys
+import socket
+import asyncio
+import hashlib
+import threading
+
+import pytest
+
+if sys.version_info < (3, 7):
+    pytest.skip('async_fetch needs Python 3.7 or later',
+                allow_module_level=True)
+
+from http import server as http_server
+
+from async_fetch import AsyncFetcher, FetchError
+
+DATA = bytes(bytearray([(i * 7 + i // 251) % 256 for i in range(10000)]))
+CHUNK = 1000
+
+
+class _Handler(http_server.BaseHTTPRequestHandler):
+    # HTTP/1.1, so connections are kept alive
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        self.server.connections += 1
+        http_server.BaseHTTPRequestHandler.setup(self)
+
+    def do_GET(self):
+        rangehdr = self.headers.get('Range')
+        self.server.requests.append(rangehdr)
+        if self.path != '/sofa_c.tar.gz':
+            self.send_error(404)
+            return
+        mode = self.server.mode
+        # the first range is always served, so only the later ones fail
+        later = rangehdr is not None and not rangehdr.startswith('bytes=0-')
+        if mode == 'error' and later:
+            self.send_error(500)
+            return
+
+        match = re.match(r'bytes=(\d+)-(\d+)$', rangehdr or '')
+        if match is None or mode == 'norange':
+            self.send_response(200)
+            body = DATA
+        else:
+            start, end = [int(x) for x in match.groups()]
+            end = min(end, len(DATA) - 1)
+            body = DATA[start:end + 1]
+            if mode == 'badrange' and later:
+                start += 1
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                             start, end, len(DATA)))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _server(mode):
+    server = http_server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.daemon_threads = True
+    server.mode = mode
+    server.connections = 0
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever,
+                              kwargs={'poll_interval': 0.05})
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def _url(server):
+    return 'http://127.0.0.1:{0}'.format(server.server_port)
+
+
+@pytest.fixture
+def servers():
+    """
+    Returns a function that starts a stand-in server in one of the modes
+    'ok', 'norange' (ignores ranges), 'error' (500 for all but the first
+    range) or 'badrange' (the wrong Content-Range for them).
+    """
+    started = []
+
+    def start(mode='ok'):
+        started.append(_server(mode))
+        return started[-1]
+
+    yield start
+    for server in started:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def refused_url():
+    # a port nothing is listening on
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return 'http://127.0.0.1:{0}'.format(port)
+
+
+def _download(url, fn, mirrors=(), connections=4, sha256=None):
+    async def run():
+        fetcher = AsyncFetcher(connections, timeout=5)
+        try:
+            nbytes = await fetcher.download(url + '/sofa_c.tar.gz', fn,
+                                            mirrors, CHUNK, sha256)
+        finally:
+            await fetcher.close()
+        return fetcher, nbytes
+
+    return asyncio.run(run())
+
+
+def _read(fn):
+    with open(fn, 'rb') as f:
+        return f.read()
+
+
+def test_ranges(servers, tmp_path):
+    server = servers()
+    fn = str(tmp_path / 'sofa_c.tar.gz')
+    fetcher, nbytes = _download(_url(server), fn)
+    assert nbytes == len(DATA)
+    assert _read(fn) == DATA
+    assert sorted(server.requests) == sorted(
+        ['bytes={0}-{1}'.format(start, start + CHUNK - 1)
+         for start in range(0, len(DATA), CHUNK)])
+    assert not os.path.exists(fn + '.part')
+
+
+def test_no_ranges(servers, tmp_path):
+    # a server that ignores the Range header sends the whole file at once
+    server = servers('norange')
+    fn = str(tmp_path / 'sofa_c.tar.gz')
+    fetcher, nbytes = _download(_url(server), fn)
+    assert _read(fn) == DATA
+    assert len(server.requests) == 1
+
+
+def test_keepalive(servers, tmp_path):
+    server = servers()
+    fn = str(tmp_path / 'sofa_c.tar.gz')
+    fetcher, nbytes = _download(_url(server), fn, connections=1)
+    assert _read(fn) == DATA
+    assert len(server.requests) == len(DATA) // CHUNK
+    assert fetcher.opened == 1
+    assert server.connections == 1
+
+
+@pytest.mark.parametrize('mode', ['error', 'badrange'])
+def test_mirror_failover(servers, tmp_path, mode):
+    bad = servers(mode)
+    good = servers()
+    fn = str(tmp_path / 'sofa_c.tar.gz')
+    _download(_url(bad), fn, mirrors=[_url(good)])
+    assert _read(fn) == DATA
+    # some of the later ranges were tried on the bad server first
+    assert len(bad.requests) > 1
+
+
+def test_refused_failover(servers, refused_url, tmp_path):
+    good = servers()
+    fn = str(tmp_path / 'sofa_c.tar.gz')
+    _download(refused_url, fn, mirrors=[_url(good)])
+    assert _read(fn) == DATA
+
+    # and a refusing mirror, which is only found out about for later ranges
+    os.remove(fn)
+    _download(_url(good), fn, mirrors=[refused_url])
+    assert _read(fn) == DATA
+
+
+def test_all_refused(refused_url, tmp_path):
+    fn = str(tmp_path / 'sofa_c.tar.gz')
+    with pytest.raises(FetchError):
+        _download(refused_url, fn)
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_sha256(servers, tmp_path):
+    server = servers()
+    fn = str(tmp_path / 'sofa_c.tar.gz')
+    _download(_url(server), fn, sha256=hashlib.sha256(DATA).hexdigest())
+    assert _read(fn) == DATA
+
+    os.remove(fn)
+    with pytest.raises(FetchError):
+        _download(_url(server), fn, sha256='0' * 64)
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,102 @@
+"""
+Tests for the profile-guided function ordering (`--order-profile`) and
+`layout_benchmark`, on small call graphs and a synthetic SOFA.  Do::
+
+  python -m pytest test_layout_benchmark.py
+"""
+
+import json
+
+import pytest
+
+import api_index
+from layout_benchmark import benchmark_layout, check_results
+from output_sinks import DirectorySink
+from sofa_deriver import reprocess_sofa_tarfile
+from source_flattener import read_order_profile
+from source_parser import order_functions
+from synthetic_sofa import make_synthetic_sofa
+
+# like ERFA: the hottest functions are the small ones everything calls
+CALLS = {'eraAnp': set(),
+         'eraBp06': set(['eraPfw06', 'eraRxr']),
+         'eraCal2jd': set(),
+         'eraFw2m': set(['eraRxr']),
+         'eraPfw06': set(['eraAnp']),
+         'eraPmat06': set(['eraBp06', 'eraFw2m', 'eraPfw06']),
+         'eraPnm06a': set(['eraFw2m', 'eraPfw06']),
+         'eraRxr': set(),
+         'eraZp': set()}
+COUNTS = [('eraRxr', 300), ('eraAnp', 200), ('eraPfw06', 200),
+          ('eraFw2m', 100), ('eraBp06', 100), ('eraPmat06', 100),
+          ('eraPnm06a', 100)]
+
+
+def _callee_counts(calls, roots):
+    # the number of times each function is called, if each root is called
+    # once and each function calls each of its callees once
+    counts = {}
+    stack = list(roots)
+    while stack:
+        name = stack.pop()
+        counts[name] = counts.get(name, 0) + 1
+        stack.extend(calls[name])
+    return sorted(counts.items())
+
+
+def test_callers_first():
+    order = order_functions(CALLS, COUNTS)
+    assert sorted(order) == sorted(CALLS)
+    for name in CALLS:
+        for callee in CALLS[name]:
+            assert order.index(name) < order.index(callee), (name, callee)
+    # the functions nothing hot calls go last
+    assert order[-2:] == ['eraCal2jd', 'eraZp']
+    # and it is the same for the same profile in any order
+    assert order_functions(CALLS, COUNTS[::-1]) == order
+
+
+def test_call_chain_together():
+    order = order_functions(CALLS, [('eraPmat06', 1)])
+    assert order[:3] == ['eraPmat06', 'eraBp06', 'eraPfw06']
+
+
+def test_cycle():
+    calls = {'eraA': set(['eraB']), 'eraB': set(['eraA', 'eraC']),
+             'eraC': set(['eraC'])}
+    order = order_functions(calls, [('eraB', 5), ('eraA', 1)])
+    assert order == ['eraB', 'eraA', 'eraC']
+
+
+def test_microbench_profile_ranks_only(tmp_path):
+    fn = str(tmp_path / 'bench.json')
+    with open(fn, 'w') as f:
+        json.dump({'results': [{'name': 'eraPmat06', 'iterations': 1000},
+                               {'name': 'eraAnp', 'iterations': 100000},
+                               {'name': 'eraBp06', 'iterations': 2000}]}, f)
+    assert read_order_profile(fn) == [('eraAnp', 0), ('eraBp06', 0),
+                                      ('eraPmat06', 0)]
+
+
+@pytest.fixture(scope='module')
+def srcdir(tmp_path_factory):
+    tmpdir = tmp_path_factory.mktemp('layout')
+    tarfn = str(tmpdir / 'sofa_c-synthetic.tar.gz')
+    make_synthetic_sofa(tarfn, nfiles=80, lines_per_file=10, nmacros=10)
+    libdir = str(tmpdir / 'erfa')
+    with DirectorySink(libdir) as sink:
+        reprocess_sofa_tarfile(tarfn, verbose=False, copyrightyear=2021,
+                               sink=sink)
+    return libdir
+
+
+@pytest.mark.parametrize('roots', [['eraFn0079'],
+                                   ['eraFn0079', 'eraFn0050', 'eraFn0064'],
+                                   ['eraFn0010', 'eraFn0041', 'eraFn0077',
+                                    'eraFn0078']])
+def test_profiled_call_distance(srcdir, roots):
+    calls = api_index.call_graph(api_index.load_index(srcdir))[1]
+    for counts in (_callee_counts(calls, roots),
+                   [(name, 0) for name in roots]):
+        results = benchmark_layout(srcdir, counts, compile=False)
+        assert check_results(results) == []
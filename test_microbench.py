@@ -0,0 +1,96 @@
+"""
+Tests for `microbench`, on hand-written tests and a library derived from a
+small synthetic SOFA tar file.  Do::
+
+  python -m pytest test_microbench.py
+"""
+
+import re
+
+import pytest
+
+from microbench import bench_from_test, make_benchmark
+
+T_ANP = """static void t_anp(int *status)
+{
+   vvd(eraAnp(-0.1), 6.183185307179586477, 1e-12, "eraAnp", "", status);
+}
+"""
+
+T_GMST = """static void t_gmst00(int *status)
+{
+   double ut1, tt;
+
+
+   ut1 = 2400000.5;
+   tt = 53736.0;
+
+   vvd(eraGmst00(ut1, 53736.0, 2400000.5,
+                 tt), 1.754174972210740592, 1e-12,
+                 "eraGmst00", "", status);
+}
+"""
+
+T_CAL2JD = """static void t_cal2jd(int *status)
+{
+   double djm0, djm;
+
+
+   viv(eraCal2jd(2003, 6, 1, &djm0, &djm), 0, "eraCal2jd", "j", status);
+   vvd(djm0, 2400000.5, 0.0, "eraCal2jd", "djm0", status);
+}
+"""
+
+T_JD2CAL = """static void t_jd2cal(int *status)
+{
+   int iy, im, id, j;
+   double fd;
+
+
+   j = eraJd2cal(2400000.5, 50123.9999, &iy, &im, &id, &fd);
+
+   viv(iy, 1996, "eraJd2cal", "y", status);
+}
+"""
+
+
+def _loop_body(benchlines):
+    text = ''.join(benchlines)
+    match = re.search(r'for \(bench_i_ = 0; bench_i_ < n; bench_i_\+\+\) '
+                      r'\{\n(.*?)\n   \}\n', text, re.DOTALL)
+    return match.group(1)
+
+
+@pytest.mark.parametrize('funcname, test, call', [
+    ('eraAnp', T_ANP, 'eraAnp(-0.1)'),
+    ('eraGmst00', T_GMST, 'eraGmst00(ut1, 53736.0, 2400000.5,\n'
+                          '                 tt)'),
+    ('eraCal2jd', T_CAL2JD, 'eraCal2jd(2003, 6, 1, &djm0, &djm)')])
+def test_checker_not_timed(funcname, test, call):
+    bench = bench_from_test(funcname, test.splitlines(True), 'bench_x')
+    body = _loop_body(bench)
+    assert not re.search(r'\b(vvd|viv)\s*\(', body)
+    assert body.strip() == 'bench_sink_ = {0};'.format(call)
+    assert '   volatile double bench_sink_;\n' in bench
+
+
+def test_assignment_timed():
+    bench = bench_from_test('eraJd2cal', T_JD2CAL.splitlines(True),
+                            'bench_jd2cal')
+    assert _loop_body(bench).strip() == (
+        'j = eraJd2cal(2400000.5, 50123.9999, &iy, &im, &id, &fd);')
+    assert 'bench_sink_' not in ''.join(bench)
+
+
+def test_make_benchmark():
+    testlines = ('#include "erfa.h"\n\n' + T_ANP + '\n' + T_CAL2JD + '\n' +
+                 'int main(int argc, char *argv[])\n{\n   return 0;\n}\n')
+    headerlines = ['double eraAnp(double a);\n',
+                   'int eraCal2jd(int iy, int im, int id, double *djm0, '
+                   'double *djm);\n']
+    source, fixtures = make_benchmark(testlines.splitlines(True),
+                                      headerlines)
+    assert fixtures == {'eraAnp': 'test', 'eraCal2jd': 'test'}
+    for body in re.findall(r'bench_i_\+\+\) \{\n(.*?)\n   \}\n', source,
+                           re.DOTALL):
+        assert not re.search(r'\b(vvd|viv)\s*\(', body)
@@ -0,0 +1,67 @@
+"""
+Tests for `sofa_deriver`, run on small synthetic SOFA tar files.  Do::
+
+  python -m pytest test_sofa_deriver.py
+"""
+
+import io
+import tarfile
+
+import pytest
+
+from output_sinks import DirectorySink, MemorySink
+from sofa_deriver import reprocess_sofa_tarfile, flatten_sofa_tarfile
+from source_flattener import flatten_source
+from synthetic_sofa import make_synthetic_sofa
+
+
+@pytest.fixture
+def sofatarfn(tmp_path):
+    fn = str(tmp_path / 'sofa_c-synthetic.tar.gz')
+    make_synthetic_sofa(fn, nfiles=20, lines_per_file=10, nmacros=10)
+    return fn
+
+
+def _derive(sofatarfn, **kwargs):
+    sink = MemorySink()
+    reprocess_sofa_tarfile(sofatarfn, verbose=False, copyrightyear=2021,
+                           sink=sink, **kwargs)
+    return sink.files
+
+
+@pytest.mark.parametrize('jobs', [2, 0, None])
+def test_parallel_output_identical(sofatarfn, jobs):
+    serial = _derive(sofatarfn, jobs=1)
+    assert len(serial) > 20
+    parallel = _derive(sofatarfn, jobs=jobs)
+    assert sorted(parallel) == sorted(serial)
+    for fn in serial:
+        assert parallel[fn].encode('utf-8') == serial[fn].encode('utf-8'), fn
+
+
+def test_fused_flatten_crlf(sofatarfn, tmp_path):
+    # the same SOFA with CRLF line endings
+    crlffn = str(tmp_path / 'sofa_c-crlf.tar.gz')
+    with tarfile.open(sofatarfn) as src, tarfile.open(crlffn, 'w:gz') as dst:
+        for ti in src:
+            data = None
+            if ti.isfile():
+                data = src.extractfile(ti).read().replace(b'\n', b'\r\n')
+                ti.size = len(data)
+                data = io.BytesIO(data)
+            dst.addfile(ti, data)
+
+    libdir = str(tmp_path / 'erfa')
+    with DirectorySink(libdir) as sink:
+        reprocess_sofa_tarfile(crlffn, verbose=False, copyrightyear=2021,
+                               sink=sink)
+    twostep = MemorySink()
+    flatten_source(libdir, 'erfa', sink=twostep)
+
+    fused = MemorySink()
+    flatten_sofa_tarfile(crlffn, verbose=False, copyrightyear=2021,
+                         sink=fused)
+    assert sorted(fused.files) == sorted(twostep.files)
+    for fn in twostep.files:
+        assert '\r' not in fused.files[fn]
+        assert fused.files[fn] == twostep.files[fn], fn
@@ -0,0 +1,65 @@
+"""
+Tests for `source_flattener`, run on a library derived from a small
+synthetic SOFA tar file.  Do::
+
+  python -m pytest test_source_flattener.py
+"""
+
+import os
+import sys
+import subprocess
+
+import pytest
+
+from output_sinks import DirectorySink, MemorySink
+from sofa_deriver import reprocess_sofa_tarfile
+from source_flattener import flatten_source, split_evenly
+from synthetic_sofa import make_synthetic_sofa
+
+
+@pytest.fixture(scope='module')
+def srcdir(tmp_path_factory):
+    tmpdir = tmp_path_factory.mktemp('flatten')
+    tarfn = str(tmpdir / 'sofa_c-synthetic.tar.gz')
+    make_synthetic_sofa(tarfn, nfiles=20, lines_per_file=10, nmacros=10)
+    libdir = str(tmpdir / 'erfa')
+    with DirectorySink(libdir) as sink:
+        reprocess_sofa_tarfile(tarfn, verbose=False, copyrightyear=2021,
+                               sink=sink)
+    return libdir
+
+
+def test_split_evenly():
+    groups = split_evenly(list('abcdef'), [1, 1, 1, 1, 1, 1], 3)
+    assert groups == [['a', 'b'], ['c', 'd'], ['e', 'f']]
+    assert split_evenly(list('ab'), [1, 1], 1) == [['a', 'b']]
+    for n in (0, -2):
+        with pytest.raises(ValueError):
+            split_evenly(list('ab'), [1, 1], n)
+
+
+def test_split(srcdir):
+    whole = MemorySink()
+    flatten_source(srcdir, 'erfa', sink=whole)
+    split = MemorySink()
+    flatten_source(srcdir, 'erfa', sink=split, split=3)
+    assert 'erfa.c' not in split.files
+    assert [fn for fn in sorted(split.files) if fn.endswith('.c')] == [
+        'erfa_1.c', 'erfa_2.c', 'erfa_3.c', 'test_erfa.c']
+    assert split.files['erfa.h'] == whole.files['erfa.h']
+
+
+@pytest.mark.parametrize('n', ['0', '-2'])
+def test_split_less_than_one(srcdir, n):
+    with pytest.raises(ValueError):
+        flatten_source(srcdir, 'erfa', sink=MemorySink(), split=int(n))
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'source_flattener.py')
+    proc = subprocess.Popen([sys.executable, script, srcdir, '--split', n,
+                             '-o', srcdir + '_flat'],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    err = proc.communicate()[1].decode()
+    assert proc.returncode == 2
+    assert '--split must be at least 1' in err
+    assert 'Traceback' not in err
@@ -0,0 +1,69 @@
+"""
+Tests for `ufunc_generator`, which build the ufunc module for a library
+derived from a small synthetic SOFA tar file and check it against calling
+the C functions directly.  They need numpy and a C compiler.  Do::
+
+  python -m pytest test_ufunc_generator.py
+"""
+
+import os
+import sys
+import shutil
+import sysconfig
+import subprocess
+
+import pytest
+
+pytest.importorskip('numpy')
+
+from output_sinks import DirectorySink
+from sofa_deriver import reprocess_sofa_tarfile
+from source_flattener import flatten_source
+from synthetic_sofa import make_synthetic_sofa
+from ufunc_generator import build_ufunc_module, check_ufunc_module
+
+NFUNCS = 20
+CC = os.environ.get('CC', 'cc')
+
+if shutil.which(CC) is None:
+    pytest.skip('no C compiler ({0})'.format(CC), allow_module_level=True)
+if not os.path.isfile(os.path.join(sysconfig.get_paths()['include'],
+                                   'Python.h')):
+    pytest.skip('no Python headers', allow_module_level=True)
+
+
+@pytest.fixture(scope='module', params=['multi-file', 'flattened'])
+def srcdir(request, tmp_path_factory):
+    tmpdir = tmp_path_factory.mktemp('ufunc')
+    tarfn = str(tmpdir / 'sofa_c-synthetic.tar.gz')
+    make_synthetic_sofa(tarfn, nfiles=NFUNCS, lines_per_file=10, nmacros=10)
+    libdir = str(tmpdir / 'erfa')
+    with DirectorySink(libdir) as sink:
+        reprocess_sofa_tarfile(tarfn, verbose=False, copyrightyear=2021,
+                               sink=sink)
+    if request.param == 'multi-file':
+        return libdir
+
+    flatdir = str(tmpdir / 'flat')
+    with DirectorySink(flatdir) as sink:
+        flatten_source(libdir, 'erfa', sink=sink)
+    return flatdir
+
+
+def test_build_and_check(srcdir, tmp_path):
+    modfn, specs = build_ufunc_module(srcdir, str(tmp_path / 'build'),
+                                      cc=CC, verbose=False)
+    assert len(specs) == NFUNCS
+    assert check_ufunc_module(modfn, specs) == []
+
+
+def test_cli_check(srcdir, tmp_path):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'ufunc_generator.py')
+    proc = subprocess.Popen([sys.executable, script, srcdir, '--check', '-q',
+                             '--cc', CC, '-b', str(tmp_path / 'build')],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    assert proc.returncode == 0, err.decode()
+    assert '{0} of {0} ufuncs match the C functions'.format(NFUNCS) in \
+        out.decode()
@@ -0,0 +1,568 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+"""
+Generates the C source of a Python extension module that wraps each function
+of a SOFA-derived library as a NumPy generalized ufunc (e.g.
+``rxp(r, p) -> rp`` with signature ``(3,3),(3)->(3)``), from the prototypes
+in the library header and the argument descriptions in the source comments.
+It can also build the module and check every ufunc against calling the C
+functions directly.  Do::
+
+  python ufunc_generator.py --help
+
+To see the options.
+
+Arguments passed by value are inputs and pointers to scalars are outputs.
+Array arguments are inputs, outputs or both according to the "Given:",
+"Returned:" and "Given and returned:" sections of the function's comment; if
+the comment doesn't say, they are inputs, except the last array of a
+function returning void, which is an output.  A function's return value is
+its first output, or its last (named ``status``) if it is an int.  Functions
+with other kinds of arguments (strings, structs, ...) are skipped.
+"""
+
+import os
+import re
+import sys
+
+import source_parser
+from batch_variants import parse_prototype
+
+
+MODULE_TEMPL = """/*
+**  NumPy generalized ufuncs wrapping the {libname} functions, generated from
+**  {libname}.h by ufunc_generator.py.
+*/
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <string.h>
+#define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
+#include "numpy/ndarraytypes.h"
+#include "numpy/ufuncobject.h"
+#include "{libname}.h"
+
+{loops}
+static const struct {{
+   const char *name;
+   PyUFuncGenericFunction *funcs;
+   char *types;
+   int nin, nout;
+   const char *signature;
+   const char *doc;
+}} ufuncs[] = {{
+{table}
+}};
+
+static void *ufunc_data[] = {{NULL}};
+
+static struct PyModuleDef moduledef = {{
+   PyModuleDef_HEAD_INIT, "{modname}",
+   "NumPy ufuncs wrapping the {libname} functions.", -1, NULL
+}};
+
+PyMODINIT_FUNC PyInit_{modname}(void)
+{{
+   PyObject *m, *ufunc;
+   size_t i;
+
+   import_array();
+   import_umath();
+
+   m = PyModule_Create(&moduledef);
+   if (m == NULL) return NULL;
+
+   for (i = 0; i < sizeof ufuncs / sizeof ufuncs[0]; i++) {{
+      ufunc = PyUFunc_FromFuncAndDataAndSignature(
+         ufuncs[i].funcs, ufunc_data, ufuncs[i].types, 1,
+         ufuncs[i].nin, ufuncs[i].nout, PyUFunc_None, ufuncs[i].name,
+         ufuncs[i].doc, 0, ufuncs[i].signature);
+      if (ufunc == NULL || PyModule_AddObject(m, ufuncs[i].name, ufunc)) {{
+         Py_XDECREF(ufunc);
+         Py_DECREF(m);
+         return NULL;
+      }}
+   }}
+   return m;
+}}
+"""
+
+_NPY_TYPES = {'double': 'NPY_DOUBLE', 'int': 'NPY_INT'}
+
+_SECTION_RE = re.compile(r'^\*\*\s+(Given and returned|Given|Returned)\b'
+                         r'[^:\n]*:\s*$')
+_ARGLINE_RE = re.compile(r'^\*\*\s{3,}([\w,]+)\s')
+
+
+def argument_directions(comment):
+    """
+    Returns a dict mapping the argument names described in the "Given:",
+    "Returned:" and "Given and returned:" sections of the SOFA-style
+    function `comment` to ``'in'``, ``'out'`` or ``'inout'``.
+    """
+    directions = {}
+    section = None
+    for l in comment.splitlines():
+        match = _SECTION_RE.match(l)
+        if match:
+            section = {'Given': 'in', 'Returned': 'out',
+                       'Given and returned': 'inout'}[match.group(1)]
+            if 'function value' in l:
+                section = None
+            continue
+        if l.strip() == '**':
+            continue
+        match = _ARGLINE_RE.match(l)
+        if match is None:
+            # a section ends at the first line that is not an argument
+            if not re.match(r'^\*\*\s{6,}', l):
+                section = None
+            continue
+        if section is not None:
+            for name in match.group(1).split(','):
+                if name:
+                    directions.setdefault(name, section)
+    return directions
+
+
+def function_comments(texts, prefix='era'):
+    """
+    Returns a dict mapping each function defined in the C source `texts` to
+    the comment that follows its definition's signature (as the SOFA
+    sources have).
+    """
+    comments = {}
+    defre = re.compile(r'^[A-Za-z_][^;\n]*?\b(' + re.escape(prefix) +
+                       r'[A-Z0-9]\w*)\s*\([^;{]*?\)\s*\n(/\*.*?\*/)',
+                       re.MULTILINE | re.DOTALL)
+    for text in texts:
+        for match in defre.finditer(text):
+            comments.setdefault(match.group(1), match.group(2))
+    return comments
+
+
+def _summary(comment):
+    # the first line of the description after the name banner
+    for l in comment.splitlines()[1:]:
+        text = l.lstrip('*').strip()
+        if text and not re.match(r'^[-\s]*$', text) and ' ' in text and \
+                not re.match(r'^(\w )+\w$', text):
+            return text
+    return ''
+
+
+def ufunc_spec(rettype, name, params, comment='', prefix='era'):
+    """
+    Returns a dict describing the ufunc for the function `name` (as parsed
+    by `batch_variants.parse_prototype`), with its ``inputs`` and
+    ``outputs`` (lists of ``(argname, ctype, dims)``), ``args`` (the C
+    arguments with their direction) and ``signature``, or None if the
+    function can't be wrapped.
+    """
+    if rettype not in ('void', 'double', 'int'):
+        return None
+    directions = argument_directions(comment)
+    arrays = [p['name'] for p in params if p['dims']]
+
+    args = []
+    for param in params:
+        if param['ctype'] not in _NPY_TYPES or None in param['dims']:
+            return None
+        if param['dims']:
+            if param['name'] in directions:
+                direction = directions[param['name']]
+            elif rettype == 'void' and param['name'] == arrays[-1]:
+                direction = 'out'
+            else:
+                direction = 'in'
+            kind = 'array'
+        elif param['pointer']:
+            direction, kind = 'out', 'pointer'
+        else:
+            direction, kind = 'in', 'value'
+        args.append({'name': param['name'], 'ctype': param['ctype'],
+                     'dims': param['dims'], 'direction': direction,
+                     'kind': kind})
+
+    inputs = [(a['name'], a['ctype'], a['dims']) for a in args
+              if a['direction'] in ('in', 'inout')]
+    outputs = [(a['name'], a['ctype'], a['dims']) for a in args
+               if a['direction'] in ('out', 'inout')]
+    if rettype == 'double':
+        outputs.insert(0, ('ret_', 'double', []))
+    elif rettype == 'int':
+        outputs.append(('status', 'int', []))
+    if not inputs or not outputs:
+        return None
+
+    def core(dims):
+        return '(' + ','.join([str(d) for d in dims]) + ')'
+    signature = (','.join([core(d) for _, _, d in inputs]) + '->' +
+                 ','.join([core(d) for _, _, d in outputs]))
+
+    return {'name': name, 'ufuncname': name[len(prefix):].lower(),
+            'rettype': rettype, 'args': args, 'inputs': inputs,
+            'outputs': outputs, 'signature': signature,
+            'summary': _summary(comment)}
+
+
+def ufunc_specs(headerlines, sourcetexts=(), prefix='era'):
+    """
+    Returns ``(specs, skipped)``: the `ufunc_spec` of each function declared
+    in `headerlines` (using the comments in the C sources `sourcetexts`),
+    and the names of the functions that can't be wrapped.
+    """
+    comments = function_comments(sourcetexts, prefix)
+    specs = []
+    skipped = []
+    for name, lines in source_parser.iter_prototypes(headerlines, prefix):
+        if name is None:
+            continue
+        parsed = parse_prototype(lines, prefix)
+        spec = None
+        if parsed is not None:
+            spec = ufunc_spec(parsed[0], parsed[1], parsed[2],
+                              comments.get(name, ''), prefix)
+        if spec is None:
+            skipped.append(name)
+        else:
+            specs.append(spec)
+    return specs, skipped
+
+
+def _copy_lines(var, ctype, dims, arg, corestep, tovar):
+    # lines copying between the C variable `var` and operand `arg` of the
+    # ufunc, whose core strides start at steps[corestep]
+    ptr = 'args[{0}] + i_ * steps[{0}]'.format(arg)
+    index = ''
+    for j in range(len(dims)):
+        ptr += ' + j{0}_ * steps[{1}]'.format(j, corestep + j)
+        index += '[j{0}_]'.format(j)
+    elem = '*({0} *) ({1})'.format(ctype, ptr)
+    stmt = ('{0}{1} = {2};' if tovar else '{2} = {0}{1};').format(var, index,
+                                                                 elem)
+    lines = []
+    indent = '      '
+    for j, d in enumerate(dims):
+        lines.append('{0}for (j{1}_ = 0; j{1}_ < {2}; j{1}_++)\n'.format(
+                     indent, j, d))
+        indent += '   '
+    lines.append(indent + stmt + '\n')
+    return lines
+
+
+def ufunc_loop(spec):
+    """
+    Returns the C inner loop function for the ufunc described by `spec`.
+    """
+    decls = []
+    for a in spec['args']:
+        decls.append('   {0} {1}{2};\n'.format(
+                     a['ctype'], a['name'],
+                     ''.join(['[{0}]'.format(d) for d in a['dims']])))
+    if spec['rettype'] != 'void':
+        decls.append('   {0} ret_;\n'.format(spec['rettype']))
+    ndims = max([len(d) for _, _, d in spec['inputs'] + spec['outputs']])
+    if ndims:
+        decls.append('   npy_intp {0};\n'.format(
+                     ', '.join(['j{0}_'.format(j) for j in range(ndims)])))
+
+    nargs = len(spec['inputs']) + len(spec['outputs'])
+    corestep = nargs
+    body = []
+    for k, (name, ctype, dims) in enumerate(spec['inputs']):
+        body.extend(_copy_lines(name, ctype, dims, k, corestep, True))
+        corestep += len(dims)
+    # the functions don't set their outputs on some errors, so start them
+    # at zero rather than with the last call's values
+    for a in spec['args']:
+        if a['direction'] == 'out':
+            if a['dims']:
+                body.append('      memset({0}, 0, sizeof {0});\n'.format(
+                            a['name']))
+            else:
+                body.append('      {0} = 0;\n'.format(a['name']))
+
+    callargs = []
+    for a in spec['args']:
+        callargs.append(('&' if a['kind'] == 'pointer' else '') + a['name'])
+    call = '{0}({1});'.format(spec['name'], ', '.join(callargs))
+    if spec['rettype'] != 'void':
+        call = 'ret_ = ' + call
+    body.append('      ' + call + '\n')
+
+    for k, (name, ctype, dims) in enumerate(spec['outputs']):
+        var = 'ret_' if name in ('ret_', 'status') else name
+        body.extend(_copy_lines(var, ctype, dims, len(spec['inputs']) + k,
+                                corestep, False))
+        corestep += len(dims)
+
+    return ('static void {0}_loop(char **args, const npy_intp *dimensions,\n'
+            '{1}const npy_intp *steps, void *data)\n'
+            '{{\n'
+            '{2}'
+            '   npy_intp i_, n_ = dimensions[0];\n'
+            '\n'
+            '   (void) data;\n'
+            '   for (i_ = 0; i_ < n_; i_++) {{\n'
+            '{3}'
+            '   }}\n'
+            '}}\n'
+            '\n'
+            'static PyUFuncGenericFunction {0}_funcs[] = {{{0}_loop}};\n'
+            'static char {0}_types[] = {{{4}}};\n'
+            '\n').format(spec['ufuncname'],
+                         ' ' * len('static void {0}_loop('.format(
+                                   spec['ufuncname'])),
+                         ''.join(decls), ''.join(body),
+                         ', '.join([_NPY_TYPES[ctype] for _, ctype, _ in
+                                    spec['inputs'] + spec['outputs']]))
+
+
+def _c_string(text):
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def make_ufunc_module(headerlines, sourcetexts=(), libname='erfa',
+                      modname=None, prefix='era'):
+    """
+    Generates the C source of the extension module `modname` (by default
+    ``_<libname>_ufunc``) from the library header `headerlines` and the C
+    sources `sourcetexts`.  Returns ``(source, specs, skipped)``, with
+    `specs` and `skipped` as from `ufunc_specs`.
+    """
+    if modname is None:
+        modname = '_{0}_ufunc'.format(libname)
+    specs, skipped = ufunc_specs(headerlines, sourcetexts, prefix)
+
+    loops = []
+    table = []
+    for spec in specs:
+        loops.append(ufunc_loop(spec))
+        doc = '{0}({1}) -> {2}\n\nWraps {3}.'.format(
+              spec['ufuncname'], ', '.join([n for n, _, _ in spec['inputs']]),
+              ', '.join([n.rstrip('_') for n, _, _ in spec['outputs']]),
+              spec['name'])
+        if spec['summary']:
+            doc += '  ' + spec['summary']
+        table.append('   {{"{0}", {0}_funcs, {0}_types, {1}, {2}, "{3}",\n'
+                     '    {4}}}'.format(spec['ufuncname'], len(spec['inputs']),
+                                        len(spec['outputs']),
+                                        spec['signature'], _c_string(doc)
+                                        .replace('\n', '\\n')))
+
+    source = MODULE_TEMPL.format(libname=libname, modname=modname,
+                                 loops=''.join(loops),
+                                 table=',\n'.join(table))
+    return source, specs, skipped
+
+
+def guess_libname(srcdir):
+    """
+    Returns the name of the library in `srcdir`: the name of the directory
+    if there is a header named after it, or else the name of the only header
+    that isn't the macro header (``*m.h``).
+    """
+    import glob
+
+    libname = os.path.basename(os.path.abspath(srcdir))
+    if os.path.isfile(os.path.join(srcdir, libname + '.h')):
+        return libname
+    headers = [os.path.basename(fn)[:-2]
+               for fn in glob.glob(os.path.join(srcdir, '*.h'))
+               if not fn.endswith('m.h')]
+    if len(headers) != 1:
+        raise ValueError('Could not tell which header in {0} is the library '
+                         'header'.format(srcdir))
+    return headers[0]
+
+
+def build_ufunc_module(srcdir, builddir='build', libname=None, modname=None,
+                       cc='cc', cflags=('-O2',), prefix='era', verbose=True):
+    """
+    Generates the extension module for the library in `srcdir` (multi-file
+    or flattened) and compiles it, with the library, into `builddir`.
+    Returns the path of the built module and the specs of its ufuncs.
+    """
+    import glob
+    import sysconfig
+    import subprocess
+
+    import numpy
+
+    if libname is None:
+        libname = guess_libname(srcdir)
+    if modname is None:
+        modname = '_{0}_ufunc'.format(libname)
+
+    cfns = [fn for fn in sorted(glob.glob(os.path.join(srcdir, '*.c')))
+            if not re.match(r't_.*?_c\.c$|test_.*\.c$', os.path.basename(fn))]
+    sourcetexts = []
+    for fn in cfns:
+        with open(fn) as f:
+            sourcetexts.append(f.read())
+    with open(os.path.join(srcdir, libname + '.h')) as f:
+        source, specs, skipped = make_ufunc_module(f, sourcetexts, libname,
+                                                   modname, prefix)
+    if verbose and skipped:
+        print('Not wrapped: ' + ', '.join(skipped))
+
+    if not os.path.isdir(builddir):
+        os.makedirs(builddir)
+    modsrcfn = os.path.join(builddir, modname + '.c')
+    with open(modsrcfn, 'w') as f:
+        f.write(source)
+
+    modfn = os.path.join(builddir,
+                         modname + sysconfig.get_config_var('EXT_SUFFIX'))
+    cmd = ([cc] + list(cflags) +
+           ['-shared', '-fPIC',
+            '-I' + sysconfig.get_paths()['include'],
+            '-I' + numpy.get_include(), '-I' + srcdir,
+            '-o', modfn, modsrcfn] + cfns + ['-lm'])
+    if verbose:
+        print('Compiling', modfn)
+    subprocess.check_call(cmd)
+    return modfn, specs
+
+
+def check_ufunc_module(modfn, specs, n=7, seed=1):
+    """
+    Calls each ufunc of the built module `modfn` on `n` sets of arguments
+    and checks the results are identical to calling the wrapped C function
+    directly (via ctypes) on each set.  Returns the list of the names of the
+    ufuncs that don't match.
+    """
+    import ctypes
+    import importlib.util
+
+    import numpy as np
+
+    modname = os.path.basename(modfn).split('.')[0]
+    module = importlib.util.module_from_spec(
+        importlib.util.spec_from_file_location(modname, modfn))
+    module.__spec__.loader.exec_module(module)
+    lib = ctypes.CDLL(modfn)
+    rng = np.random.RandomState(seed)
+    ctypesof = {'double': ctypes.c_double, 'int': ctypes.c_int}
+    dtypeof = {'double': np.double, 'int': np.intc}
+
+    def values(ctype, shape):
+        if ctype == 'int':
+            return rng.randint(1, 13, size=shape).astype(np.intc)
+        return rng.uniform(0.1, 1.1, size=shape)
+
+    failed = []
+    for spec in specs:
+        inputs = dict([(name, values(ctype, (n,) + tuple(dims)))
+                       for name, ctype, dims in spec['inputs']])
+        results = getattr(module, spec['ufuncname'])(
+            *[inputs[name] for name, _, _ in spec['inputs']])
+        if len(spec['outputs']) == 1:
+            results = (results,)
+        results = dict(zip([name for name, _, _ in spec['outputs']], results))
+
+        cfunc = getattr(lib, spec['name'])
+        cfunc.restype = ctypesof.get(spec['rettype'])
+        ok = True
+        for i in range(n):
+            argvals = {}
+            cargs = []
+            for a in spec['args']:
+                if a['name'] in inputs:
+                    val = np.array(inputs[a['name']][i])
+                else:
+                    val = np.zeros(a['dims'], dtype=dtypeof[a['ctype']])
+                val = np.array(val, dtype=dtypeof[a['ctype']], order='C')
+                argvals[a['name']] = val
+                if a['kind'] == 'value':
+                    cargs.append(ctypesof[a['ctype']](val.item()))
+                else:
+                    cargs.append(val.ctypes.data_as(
+                                 ctypes.POINTER(ctypesof[a['ctype']])))
+            ret = cfunc(*cargs)
+            for name, ctype, dims in spec['outputs']:
+                expected = ret if name in ('ret_', 'status') else argvals[name]
+                if not np.array_equal(np.asarray(results[name][i]),
+                                      np.asarray(expected),
+                                      equal_nan=ctype == 'double'):
+                    ok = False
+        if not ok:
+            failed.append(spec['ufuncname'])
+    return failed
+
+
+if __name__ == '__main__':
+    import shlex
+    import argparse
+
+    from sofa_deriver import find_sourcedir
+
+    parser = argparse.ArgumentParser(description='Generates a NumPy ufunc '
+                                                 'extension module wrapping '
+                                                 'a SOFA-derived library.')
+    parser.add_argument('srcdir', nargs='?', default=None, help='The '
+                        'directory with the source code (multi-file or '
+                        'flattened).  If not given, one that looks '
+                        'SOFA-derived is searched for.')
+    parser.add_argument('--output', '-o', default=None,
+                        help='Where to write the module source.  Defaults '
+                             'to _<libname>_ufunc.c.')
+    parser.add_argument('--libname', '-l', default=None,
+                        help='The name of the library.  Defaults to the '
+                             'name of srcdir.')
+    parser.add_argument('--func-prefix', default='era',
+                        help='The prefix of the function names.')
+    parser.add_argument('--check', default=False, action='store_true',
+                        help='Build the module (needs numpy) and check '
+                             'each ufunc against calling the C function '
+                             'directly.')
+    parser.add_argument('--build-dir', '-b', default='build',
+                        help='Where to build the module with --check.')
+    parser.add_argument('--cc', default=os.environ.get('CC', 'cc'),
+                        help='The C compiler (defaults to $CC or cc).')
+    parser.add_argument('--cflags', default=os.environ.get('CFLAGS', '-O2'),
+                        help='Flags for the C compiler (defaults to $CFLAGS '
+                             'or -O2).')
+    parser.add_argument('--quiet', '-q', default=False, action='store_true',
+                        help='Print less info to the terminal.')
+    args = parser.parse_args()
+
+    srcdir = args.srcdir if args.srcdir is not None else find_sourcedir()
+    libname = args.libname
+    if libname is None:
+        libname = guess_libname(srcdir)
+
+    if args.check:
+        modfn, specs = build_ufunc_module(srcdir, args.build_dir, libname,
+                                          cc=args.cc,
+                                          cflags=shlex.split(args.cflags),
+                                          prefix=args.func_prefix,
+                                          verbose=not args.quiet)
+        failed = check_ufunc_module(modfn, specs)
+        print('{0} of {1} ufuncs match the C functions'.format(
+              len(specs) - len(failed), len(specs)))
+        if failed:
+            print('Mismatched: ' + ', '.join(failed))
+            sys.exit(1)
+    else:
+        import glob
+
+        sourcetexts = []
+        for fn in sorted(glob.glob(os.path.join(srcdir, '*.c'))):
+            with open(fn) as f:
+                sourcetexts.append(f.read())
+        with open(os.path.join(srcdir, libname + '.h')) as f:
+            source, specs, skipped = make_ufunc_module(f, sourcetexts,
+                                                       libname,
+                                                       prefix=args.func_prefix)
+        output = args.output
+        if output is None:
+            output = '_{0}_ufunc.c'.format(libname)
+        with open(output, 'w') as f:
+            f.write(source)
+        if not args.quiet:
+            print('Wrote {0} ufuncs to {1}'.format(len(specs), output))
+            if skipped:
+                print('Not wrapped: ' + ', '.join(skipped))